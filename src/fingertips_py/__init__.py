@@ -1,7 +1,8 @@
 
 __version__ = '0.4.0'
 
-from fingertips_py.api_calls import get_json, get_data_in_tuple, make_request
+from fingertips_py.api_calls import get_json, get_data_in_tuple, make_request, set_cache, get_cache, \
+    FingertipsClient, get_default_client, set_default_client, use_client
 from fingertips_py.retrieve_data import get_all_data_for_profile, get_all_data_for_indicators, get_data_by_indicator_ids, \
     get_all_areas_for_all_indicators, get_data_for_indicator_at_all_available_geographies
 from fingertips_py.metadata import get_metadata_for_profile_as_dataframe, get_metadata, get_metadata_for_indicator_as_dataframe, \
@@ -9,5 +10,22 @@ from fingertips_py.metadata import get_metadata_for_profile_as_dataframe, get_me
     get_domains_in_profile, get_all_profiles, get_area_types_as_dict, get_age_from_id, get_area_type_ids_for_profile, \
     get_profile_by_id, get_age_id, get_all_ages, get_all_sexes, get_areas_for_area_type, get_metadata_for_indicator, \
     get_multiplier_and_calculation_for_indicator, get_sex_from_id, get_sex_id, get_value_note_id, \
-    get_metadata_for_all_indicators, get_metadata_for_all_indicators_from_csv, get_all_areas
+    get_metadata_for_all_indicators, get_metadata_for_all_indicators_from_csv, get_all_areas, get_profile_by_key
 from fingertips_py.area_data import deprivation_decile
+from fingertips_py.search import search_profiles, search_indicators, get_profile_catalogue, get_indicator_catalogue, \
+    clear_search_cache
+from fingertips_py.planner import QueryPlanner, clear_planner_cache
+from fingertips_py.reshape import to_cube, DataCube
+from fingertips_py.calculations import wilson_ci, byars_ci, add_confidence_intervals, aggregate_areas, \
+    get_calculation_for_indicator
+from fingertips_py.export import export_data, DownloadJob, profile_download_job, indicator_download_job
+from fingertips_py.store import get_stored_dataset, clear_dataset_store
+from fingertips_py.cache import CacheBackend, MemoryCache, FileSystemCache, SQLiteCache, RedisCache
+from fingertips_py.urls import build_url
+from fingertips_py.incremental import get_watermarks, read_incremental_store, clear_incremental_store
+from fingertips_py.availability import AvailabilityMatrix, get_availability_matrix, clear_availability_cache
+from fingertips_py.transport import Transport, LiveTransport, RecordTransport, ReplayTransport
+from fingertips_py.normalize import normalize, get_lookup_table, clear_lookup_cache
+from fingertips_py.diff import diff, DatasetDiff, hash_rows
+from fingertips_py.autotune import AutoTuner, get_autotune_metrics, reset_tuners
+from fingertips_py.profiling import profile, ProfileSession
@@ -1,12 +1,473 @@
 """
 A group of functions to query the Fingertips api and retrieve data in a variety of formats.
+
+The functions use a default FingertipsClient, which owns the HTTP sessions, response cache, concurrency limit and
+request metrics. Use set_default_client to configure it, or create further clients to isolate workers from each other
+and use them for a block of code with use_client.
 """
 
 
-import requests
+import io
+import os
 import json
+import time
+import hashlib
+import weakref
+import warnings
+import threading
+import contextlib
+import contextvars
+import requests
+import urllib3
 import pandas as pd
-from io import StringIO
+from io import BytesIO
+from urllib.error import HTTPError, URLError
+from concurrent.futures import ThreadPoolExecutor
+from fingertips_py.cache import CacheBackend, cache_key, ttl_for_url
+from fingertips_py.transport import Transport, transport_from_environment
+from fingertips_py.profiling import record_cost, timed
+
+
+metric_names = ['requests', 'errors', 'cache_hits', 'cache_misses', 'not_modified', 'ssl_fallbacks',
+                'bytes_received', 'request_seconds', 'autotune_increases', 'autotune_decreases']
+
+
+class FingertipsClient:
+    """
+    A client for the Fingertips API. A client can be shared between threads: each thread gets its own requests session
+    from the client's pool and the cache, limiter and metrics are safe to use concurrently. After os.fork the child
+    process starts with new sessions and locks, so connections are never shared with the parent.
+
+    :param base_url: [OPTIONAL] Root url of the API. Defaults to api_calls.base_url.
+    :param cache: [OPTIONAL] A CacheBackend for API responses. Default no cache.
+    :param max_workers: [OPTIONAL] Number of threads used for concurrent requests. Defaults to api_calls.max_workers.
+    :param max_concurrent_requests: [OPTIONAL] Maximum number of requests sent at once by all threads using the
+        client. A streamed CSV counts as a request until it is closed. Default no limit.
+    :param http_store_dir: [OPTIONAL] Directory for conditional CSV downloads. Defaults to api_calls.http_store_dir.
+    :param verify: [OPTIONAL] Whether to verify SSL certificates. Default True.
+    :param ssl_fallback: [OPTIONAL] Whether to retry a request without SSL verification if verification fails. A
+        warning is given each time this happens. Default True.
+    :param timeout: [OPTIONAL] Timeout in seconds for connecting and for each read. Default no timeout.
+    :param transport: [OPTIONAL] A Transport that sends the requests, eg. RecordTransport(directory) or
+        ReplayTransport(directory). Defaults to the transport set by the FINGERTIPS_PY_TRANSPORT environment variable,
+        which is live requests if it is not set.
+    """
+
+    def __init__(self, base_url=None, cache=None, max_workers=None, max_concurrent_requests=None,
+                 http_store_dir=None, verify=True, ssl_fallback=True, timeout=None, transport=None):
+        self._base_url = base_url
+        self.cache = cache
+        self._max_workers = max_workers
+        self.max_concurrent_requests = max_concurrent_requests
+        self._http_store_dir = http_store_dir
+        self.verify = verify
+        self.ssl_fallback = ssl_fallback
+        self.timeout = timeout
+        if transport is not None and not isinstance(transport, Transport):
+            raise TypeError('A transport must have a get method')
+        self.transport = transport or transport_from_environment()
+        self._reset()
+        _clients.add(self)
+
+    @property
+    def base_url(self):
+        return self._base_url or base_url
+
+    @property
+    def max_workers(self):
+        return self._max_workers or max_workers
+
+    @property
+    def http_store_dir(self):
+        return self._http_store_dir if self._http_store_dir is not None else http_store_dir
+
+    def _reset(self):
+        """
+        Creates the per-process state of the client: the session pool, locks, limiter and metrics.
+
+        :meta private:
+        """
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+        self._limiter = (threading.BoundedSemaphore(self.max_concurrent_requests) if self.max_concurrent_requests
+                         else None)
+        self._metrics = dict.fromkeys(metric_names, 0)
+
+    def _session(self):
+        """
+        :return: The requests session of the current thread, so connections are reused between calls
+
+        :meta private:
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def record(self, **counts):
+        """
+        Adds to the client's metrics.
+
+        :param counts: Amounts to add to metrics, eg. requests=1
+
+        :meta private:
+        """
+        with self._lock:
+            for name, count in counts.items():
+                self._metrics[name] = self._metrics.get(name, 0) + count
+
+    def get_metrics(self):
+        """
+        :return: A dictionary of the client's request metrics since it was created or last reset
+        """
+        with self._lock:
+            return dict(self._metrics)
+
+    def reset_metrics(self):
+        """
+        Sets all of the client's metrics back to zero.
+        """
+        with self._lock:
+            self._metrics = dict.fromkeys(metric_names, 0)
+
+    def _acquire_slot(self):
+        """
+        Waits for a free slot in the client's limiter, if it has one.
+
+        :meta private:
+        """
+        if self._limiter is not None:
+            self._limiter.acquire()
+
+    def _release_slot(self):
+        """
+        Frees a slot taken by _acquire_slot.
+
+        :meta private:
+        """
+        if self._limiter is not None:
+            self._limiter.release()
+
+    def _send(self, url, headers, stream):
+        """
+        Sends a GET request through the client's transport and SSL settings.
+
+        :meta private:
+        """
+        try:
+            return self.transport.get(self._session(), url, headers=headers, stream=stream, verify=self.verify,
+                                      timeout=self.timeout)
+        except requests.exceptions.SSLError:
+            if not (self.verify and self.ssl_fallback):
+                raise
+            warnings.warn(f'SSL certificate verification failed for {url}, retrying without verification. '
+                          f'Create the FingertipsClient with ssl_fallback=False to raise an error instead.')
+            self.record(ssl_fallbacks=1)
+            return self.transport.get(self._session(), url, headers=headers, stream=stream, verify=False,
+                                      timeout=self.timeout)
+
+    def request(self, url, headers=None, stream=False):
+        """
+        Sends a GET request through the client's session, limiter and SSL settings.
+
+        :param url: A url to make a request
+        :param headers: [OPTIONAL] Dictionary of request headers
+        :param stream: [OPTIONAL] Whether to stream the response body. A streamed request keeps its slot in the
+            limiter, and the caller must call _release_slot once the body has been read. Default False.
+        :return: A requests Response
+
+        :meta private:
+        """
+        self._acquire_slot()
+        start = time.perf_counter()
+        try:
+            response = self._send(url, headers, stream)
+        except requests.exceptions.RequestException:
+            self._release_slot()
+            self.record(requests=1, errors=1)
+            record_cost(requests=1, network_seconds=time.perf_counter() - start)
+            raise
+        except BaseException:
+            self._release_slot()
+            raise
+        if not stream:
+            self._release_slot()
+        seconds = time.perf_counter() - start
+        size = 0 if stream else len(response.content)
+        self.record(requests=1, errors=int(response.status_code >= 400), request_seconds=seconds, bytes_received=size)
+        record_cost(requests=1, network_seconds=seconds, bytes_received=size)
+        return response
+
+    def get_content(self, url):
+        """
+        Returns the body of a response, from the client's cache if it has one.
+
+        :param url: A url to make a request
+        :return: The response body as bytes
+
+        :meta private:
+        """
+        key = None
+        if self.cache is not None:
+            key = cache_key(url)
+            content = self.cache.get(key)
+            if content is not None:
+                self.record(cache_hits=1)
+                return content
+            self.record(cache_misses=1)
+        req = self.request(url)
+        if key is not None and req.ok:
+            self.cache.set(key, req.content, ttl_for_url(url))
+        return req.content
+
+    def _store_paths(self, url):
+        """
+        :param url: A url to look up in the HTTP store
+        :return: A tuple of the paths of the stored body and of its validators
+
+        :meta private:
+        """
+        name = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.http_store_dir, name + '.csv'), os.path.join(self.http_store_dir, name + '.json')
+
+    def _stored_validators(self, url):
+        """
+        :param url: A url to look up in the HTTP store
+        :return: A dictionary of the stored ETag and Last-Modified headers, or None if the url is not stored
+
+        :meta private:
+        """
+        if not self.http_store_dir:
+            return None
+        body_path, validators_path = self._store_paths(url)
+        try:
+            with open(validators_path, encoding='utf-8') as validators_file:
+                validators = json.load(validators_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not os.path.exists(body_path):
+            return None
+        return validators
+
+    def open_csv(self, url):
+        """
+        Requests a CSV with compression negotiated through Accept-Encoding. If http_store_dir is set, responses with an
+        ETag or Last-Modified header are kept in that directory and later requests are made conditionally, so an
+        unchanged dataset costs a single 304 round trip.
+
+        :param url: A url that returns a CSV
+        :return: A binary file-like object of the decompressed CSV, to be closed by the caller. A streamed response
+            keeps its slot in the client's limiter until it is closed. HTTP errors are raised as urllib HTTPError and
+            other connection errors as URLError.
+
+        :meta private:
+        """
+        headers = {'Accept-Encoding': accept_encoding}
+        validators = self._stored_validators(url)
+        if validators:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        try:
+            req = self.request(url, headers=headers, stream=True)
+        except requests.exceptions.RequestException as error:
+            raise URLError(error)
+        streaming = False
+        try:
+            if req.status_code == 304 and validators:
+                req.close()
+                self.record(not_modified=1)
+                return open(self._store_paths(url)[0], 'rb')
+            if req.status_code >= 400:
+                req.close()
+                raise HTTPError(url, req.status_code, req.reason, req.headers, None)
+            etag = req.headers.get('ETag')
+            last_modified = req.headers.get('Last-Modified')
+            if self.http_store_dir and (etag or last_modified):
+                os.makedirs(self.http_store_dir, exist_ok=True)
+                body_path, validators_path = self._store_paths(url)
+                temp_path = f'{body_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with req, open(temp_path, 'wb') as body_file:
+                    for block in req.iter_content(chunk_size=1 << 16):
+                        body_file.write(block)
+                os.replace(temp_path, body_path)
+                self.record(bytes_received=os.path.getsize(body_path))
+                record_cost(bytes_received=os.path.getsize(body_path))
+                temp_path = f'{validators_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(temp_path, 'w', encoding='utf-8') as validators_file:
+                    json.dump({'url': url, 'etag': etag, 'last_modified': last_modified}, validators_file)
+                os.replace(temp_path, validators_path)
+                return open(body_path, 'rb')
+            req.raw.decode_content = True
+            streaming = True
+            return _CountingStream(req.raw, self)
+        finally:
+            if not streaming:
+                self._release_slot()
+
+    def open_cached_csv(self, url):
+        """
+        :param url: A url that returns a CSV
+        :return: A binary file-like object of the CSV, read from the client's cache if it has one
+
+        :meta private:
+        """
+        if self.cache is None:
+            return self.open_csv(url)
+        key = cache_key(url)
+        content = self.cache.get(key)
+        if content is None:
+            self.record(cache_misses=1)
+            with self.open_csv(url) as csv_file:
+                content = csv_file.read()
+            self.cache.set(key, content, ttl_for_url(url))
+        else:
+            self.record(cache_hits=1)
+        return BytesIO(content)
+
+    def map_concurrently(self, function, items, workers=None):
+        """
+        Calls a function on each item using a bounded pool of threads.
+
+        :param function: A function that takes a single item
+        :param items: A list of items, eg. URLs or IDs
+        :param workers: [OPTIONAL] Maximum number of concurrent calls. Defaults to the client's max_workers.
+        :return: A list of the function results in the same order as the items. Each call runs in a copy of the
+            caller's context, so context variables such as the profiling session are seen by the threads.
+
+        :meta private:
+        """
+        items = list(items)
+        workers = min(workers or self.max_workers, len(items))
+        if workers <= 1:
+            return [function(item) for item in items]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, function, item) for item in items]
+            return [future.result() for future in futures]
+
+    def close(self):
+        """
+        Closes the sessions of every thread that has used the client.
+        """
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+            self._local = threading.local()
+        for session in sessions:
+            session.close()
+
+
+class _CountingStream(io.RawIOBase):
+    """
+    A streamed response body that counts the bytes read from it and adds them to the client metrics when closed.
+    Closing it frees the request's slot in the client's limiter.
+
+    :param raw: The urllib3 response
+    :param client: The FingertipsClient that made the request
+
+    :meta private:
+    """
+
+    def __init__(self, raw, client):
+        self._raw = raw
+        self._client = client
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._raw.read(len(buffer))
+        buffer[:len(data)] = data
+        self.bytes_read += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._raw.close()
+            finally:
+                self._client._release_slot()
+            self._client.record(bytes_received=self.bytes_read)
+            record_cost(bytes_received=self.bytes_read)
+        super().close()
+
+
+def _reinit_clients_after_fork():
+    """
+    Gives every client new sessions and locks in a forked child process.
+
+    :meta private:
+    """
+    for client in list(_clients):
+        client._reset()
+    global _default_client_lock
+    _default_client_lock = threading.Lock()
+
+
+def get_default_client():
+    """
+    :return: The FingertipsClient used by the functions in this package: the client set by use_client in the
+        current thread or task if there is one, otherwise the process wide default client, created on first use
+    """
+    client = _context_client.get()
+    if client is not None:
+        return client
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = FingertipsClient()
+    return _default_client
+
+
+def set_default_client(client):
+    """
+    Sets the FingertipsClient used by the functions in this package in every thread, except within use_client.
+
+    :param client: A FingertipsClient, or None to go back to a new client with the default settings
+    """
+    global _default_client
+    with _default_client_lock:
+        _default_client = client
+
+
+@contextlib.contextmanager
+def use_client(client):
+    """
+    Uses a FingertipsClient for the functions in this package called within the block, without affecting other
+    threads or asyncio tasks. The client is also used by the threads started by map_concurrently and autotuned
+    downloads within the block::
+
+        with fingertips_py.use_client(FingertipsClient(max_concurrent_requests=2)):
+            fingertips_py.get_all_data_for_profile(19)
+
+    :param client: A FingertipsClient
+    :return: The client
+    """
+    if not isinstance(client, FingertipsClient):
+        raise TypeError('use_client requires a FingertipsClient')
+    token = _context_client.set(client)
+    try:
+        yield client
+    finally:
+        _context_client.reset(token)
+
+
+def get_content(url):
+    """
+    Returns the body of a response, from the cache if one has been set with set_cache.
+
+    :param url: A url to make a request
+    :return: The response body as bytes
+
+    :meta private:
+    """
+    return get_default_client().get_content(url)
 
 
 def make_request(url, attr=None):
@@ -16,11 +477,9 @@ def make_request(url, attr=None):
     :return: a dict of the attribute and associated data
 
     """
-    try:
-        req = requests.get(url)
-    except requests.exceptions.SSLError:
-        req = requests.get(url, verify=False)
-    json_response = json.loads(req.content.decode('utf-8'))
+    content = get_content(url)
+    with timed('parse_seconds'):
+        json_response = json.loads(content.decode('utf-8'))
     data = {}
     for item in json_response:
         name = item.pop(attr)
@@ -33,11 +492,9 @@ def get_json(url):
     :param url: A url to make a request
     :return: A parsed JSON object
     """
-    try:
-        req = requests.get(url)
-    except requests.exceptions.SSLError:
-        req = requests.get(url, verify=False)
-    json_resp = json.loads(req.content.decode('utf-8'))
+    content = get_content(url)
+    with timed('parse_seconds'):
+        json_resp = json.loads(content.decode('utf-8'))
     return json_resp
 
 
@@ -49,16 +506,14 @@ def get_json_return_df(url, transpose=True):
 
     :meta private:
     """
-    try:
-        req = requests.get(url)
-    except requests.exceptions.SSLError:
-        req = requests.get(url, verify=False)
-    try:
-        df = pd.read_json(req.content, encoding='utf-8')
-    except TypeError:
-        df = pd.DataFrame.from_dict([req.json()])
-    if transpose:
-        df = df.transpose()
+    content = get_content(url)
+    with timed('parse_seconds'):
+        try:
+            df = pd.read_json(content, encoding='utf-8')
+        except TypeError:
+            df = pd.DataFrame.from_dict([json.loads(content.decode('utf-8'))])
+        if transpose:
+            df = df.transpose()
     return df
 
 
@@ -67,11 +522,9 @@ def get_data_in_tuple(url):
     :param url: A url to make a request
     :return: A list of returned data in tuples
     """
-    try:
-        req = requests.get(url)
-    except requests.exceptions.SSLError:
-        req = requests.get(url, verify=False)
-    json_resp = json.loads(req.content.decode('utf-8'))
+    content = get_content(url)
+    with timed('parse_seconds'):
+        json_resp = json.loads(content.decode('utf-8'))
     tup_list = []
     for item in json_resp:
         tup_list.append([(k, v) for k, v in item.items()])
@@ -79,8 +532,8 @@ def get_data_in_tuple(url):
         return [(t[1], t[0]) for t in tup_list]
     else:
         return tup_list
-    
-    
+
+
 def get_data_in_dict(url, key = None, value = None):
     """
     :param url: A url to make a request
@@ -103,20 +556,121 @@ def get_data_in_dict(url, key = None, value = None):
     return json_dict
 
 
-def deal_with_url_error(url):
+def open_csv(url):
     """
-    :param url: A url that returns a URL Error based on SSL errors
-    :return: A dataframe from the URL with varify set to false.
+    Requests a CSV with compression negotiated through Accept-Encoding, using conditional requests if http_store_dir
+    is set. See FingertipsClient.open_csv.
+
+    :param url: A url that returns a CSV
+    :return: A binary file-like object of the decompressed CSV, to be closed by the caller
 
     :meta private:
     """
-    req = requests.get(url, verify=False)
-    s = str(req.content, 'utf-8')
-    data = StringIO(s)
-    df = pd.read_csv(data)
-    return df
+    return get_default_client().open_csv(url)
 
 
-base_url = 'http://fingertips.phe.org.uk/api/'
+def _open_cached_csv(url):
+    """
+    :param url: A url that returns a CSV
+    :return: A binary file-like object of the CSV, read from the cache if one has been set with set_cache
+
+    :meta private:
+    """
+    return get_default_client().open_cached_csv(url)
 
 
+def _empty_data_frame():
+    """
+    :return: A dataframe with the columns of the all_data endpoints and no rows, returned when no data is requested
+
+    :meta private:
+    """
+    return pd.read_csv(io.StringIO(','.join(data_columns) + '\n'), dtype=text_column_types)
+
+
+def get_csv_return_df(url):
+    """
+    :param url: A url that returns a CSV
+    :return: Dataframe generated from the CSV response, decompressed as it streams. HTTP errors are raised.
+
+    :meta private:
+    """
+    with _open_cached_csv(url) as csv_file, timed('parse_seconds'):
+        return pd.read_csv(csv_file, dtype=text_column_types)
+
+
+def iter_csv_chunks(url, chunksize=100000):
+    """
+    Streams a CSV response as a series of dataframes so large downloads can be processed while they arrive. The
+    text columns of text_column_types are read as strings in every chunk, so chunks have the same types as a whole
+    download.
+
+    :param url: A url that returns a CSV
+    :param chunksize: [OPTIONAL] Number of rows in each dataframe. Default 100000.
+    :return: A generator of dataframes
+
+    :meta private:
+    """
+    with _open_cached_csv(url) as csv_file:
+        with pd.read_csv(csv_file, chunksize=chunksize, dtype=text_column_types) as reader:
+            while True:
+                with timed('parse_seconds'):
+                    chunk = next(reader, None)
+                if chunk is None:
+                    return
+                yield chunk
+
+
+def set_cache(backend):
+    """
+    Sets the cache used for all API responses by the default client.
+
+    :param backend: A CacheBackend, eg. MemoryCache(), FileSystemCache(directory), SQLiteCache(path) or
+        RedisCache(client). None turns caching off.
+    """
+    if backend is not None and not isinstance(backend, CacheBackend):
+        raise TypeError('A cache backend must have get, set, delete and clear methods')
+    get_default_client().cache = backend
+
+
+def get_cache():
+    """
+    :return: The CacheBackend used for API responses by the default client, or None if caching is off
+    """
+    return get_default_client().cache
+
+
+def map_concurrently(function, items, workers=None):
+    """
+    Calls a function on each item using a bounded pool of threads.
+
+    :param function: A function that takes a single item
+    :param items: A list of items, eg. URLs or IDs
+    :param workers: [OPTIONAL] Maximum number of concurrent calls. Defaults to max_workers.
+    :return: A list of the function results in the same order as the items
+
+    :meta private:
+    """
+    return get_default_client().map_concurrently(function, items, workers)
+
+
+base_url = 'http://fingertips.phe.org.uk/api/'
+max_workers = 8
+data_columns = ['Indicator ID', 'Indicator Name', 'Parent Code', 'Parent Name', 'Area Code', 'Area Name', 'Area Type',
+                'Sex', 'Age', 'Category Type', 'Category', 'Time period', 'Value', 'Lower CI 95.0 limit',
+                'Upper CI 95.0 limit', 'Lower CI 99.8 limit', 'Upper CI 99.8 limit', 'Count', 'Denominator',
+                'Value note', 'Recent Trend', 'Compared to England value or percentiles', 'Compared to percentiles',
+                'Time period Sortable', 'New data', 'Compared to goal', 'Time period range']
+text_columns = ['Indicator Name', 'Parent Code', 'Parent Name', 'Area Code', 'Area Name', 'Area Type', 'Sex', 'Age',
+                'Category Type', 'Category', 'Time period', 'Value note', 'Recent Trend',
+                'Compared to England value or percentiles', 'Compared to percentiles', 'Compared to goal',
+                'Time period range', 'New data']
+text_column_types = dict.fromkeys(text_columns, str)
+http_store_dir = os.environ.get('FINGERTIPS_PY_HTTP_STORE')
+accept_encoding = urllib3.util.make_headers(accept_encoding=True)['accept-encoding']
+_clients = weakref.WeakSet()
+_default_client = None
+_default_client_lock = threading.Lock()
+_context_client = contextvars.ContextVar('fingertips_py_client', default=None)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reinit_clients_after_fork)
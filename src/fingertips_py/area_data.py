@@ -6,6 +6,7 @@ Functions to retrieve data that are specific to areas and relevant to all indica
 import pandas as pd
 import warnings
 from fingertips_py.retrieve_data import get_data_by_indicator_ids
+from fingertips_py.profiling import profile_functions
 
 def defined_qcut(df, value_series, number_of_bins, bins_for_extras, labels=False):
     """
@@ -115,4 +116,4 @@ def deprivation_decile(area_type_id, year='2015', area_code=None):
     return area_dep_dec['bins']
 
 
-
+profile_functions(globals())
@@ -0,0 +1,243 @@
+"""
+An adaptive download scheduler for the all_data endpoints. The best number of concurrent requests and of indicators
+per request depend on the area type (a request for England is small, one for GP practices is large) and on how busy
+the server is. An AutoTuner watches the latency, bytes per second and errors of each completed request and adjusts
+both settings within configured bounds, AIMD-style: they grow additively while requests are fast and succeed, and are
+halved when a request fails, is slower than the target or the cost per byte rises sharply, a sign the server is
+saturated.
+
+There is one tuner per area type, kept for the life of the process so later downloads start from the settings that
+worked before. The settings and the recent decisions of each tuner are returned by get_autotune_metrics, and the
+number of increases and decreases is counted in the client metrics as autotune_increases and autotune_decreases.
+"""
+
+
+import time
+import threading
+import contextvars
+import pandas as pd
+from io import BytesIO
+from collections import deque
+from urllib.error import HTTPError, URLError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fingertips_py.api_calls import get_default_client, text_column_types
+from fingertips_py.profiling import timed
+
+
+min_workers = 1
+max_workers = None
+min_chunk_size = 1
+max_chunk_size = 200
+chunk_size_step = 10
+target_seconds = 30.0
+max_attempts = 3
+
+_tuners = {}
+_tuners_lock = threading.Lock()
+
+
+class AutoTuner:
+    """
+    Tunes the concurrency and the indicator chunk size of downloads.
+
+    :param min_workers: [OPTIONAL] Fewest concurrent requests. Default 1.
+    :param max_workers: [OPTIONAL] Most concurrent requests. Defaults to the max_workers of the default client.
+    :param min_chunk_size: [OPTIONAL] Fewest indicators in a request. Default 1.
+    :param max_chunk_size: [OPTIONAL] Most indicators in a request. Default 200.
+    :param workers: [OPTIONAL] Starting number of concurrent requests. Default 2, within the bounds.
+    :param chunk_size: [OPTIONAL] Starting number of indicators in a request. Default 20, within the bounds.
+    :param chunk_size_step: [OPTIONAL] Indicators added to the chunk size after a fast request. Once the chunk size
+        has been halved, it grows by one indicator at a time past its halved size. Default 10.
+    :param target_seconds: [OPTIONAL] Requests slower than this halve the chunk size. Default 30.
+    :param congestion_factor: [OPTIONAL] Concurrency is halved when the seconds per byte of a request are this many
+        times the lowest seen. Default 2.
+    :param smoothing: [OPTIONAL] Weight of the latest request in the moving averages. Default 0.3.
+    """
+
+    def __init__(self, min_workers=1, max_workers=None, min_chunk_size=1, max_chunk_size=200, workers=2,
+                 chunk_size=20, chunk_size_step=10, target_seconds=30.0, congestion_factor=2.0, smoothing=0.3):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers or get_default_client().max_workers)
+        self.min_chunk_size = max(1, min_chunk_size)
+        self.max_chunk_size = max(self.min_chunk_size, max_chunk_size)
+        self.workers = min(max(workers, self.min_workers), self.max_workers)
+        self.chunk_size = min(max(chunk_size, self.min_chunk_size), self.max_chunk_size)
+        self.chunk_size_step = chunk_size_step
+        self.target_seconds = target_seconds
+        self.congestion_factor = congestion_factor
+        self.smoothing = smoothing
+        self.latency = None
+        self.bytes_per_second = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.decisions = deque(maxlen=100)
+        self._chunk_threshold = self.max_chunk_size
+        self._best_cost = None
+        self._lock = threading.Lock()
+
+    def _average(self, current, value):
+        """
+        :return: The exponentially weighted moving average of a measure after a new value
+
+        :meta private:
+        """
+        return value if current is None else current + self.smoothing * (value - current)
+
+    def _decide(self, workers, chunk_size, reason):
+        """
+        Applies new settings within the bounds and records the decision if they changed.
+
+        :meta private:
+        """
+        workers = min(max(int(workers), self.min_workers), self.max_workers)
+        chunk_size = min(max(int(chunk_size), self.min_chunk_size), self.max_chunk_size)
+        if (workers, chunk_size) == (self.workers, self.chunk_size):
+            return
+        increased = workers + chunk_size > self.workers + self.chunk_size
+        self.decisions.append({'time': time.time(), 'workers': workers, 'chunk_size': chunk_size, 'reason': reason})
+        self.workers, self.chunk_size = workers, chunk_size
+        get_default_client().record(**{'autotune_increases' if increased else 'autotune_decreases': 1})
+
+    def observe(self, seconds, size=0, error=False):
+        """
+        Updates the settings after a request.
+
+        :param seconds: Time the request took, including parsing
+        :param size: [OPTIONAL] Number of bytes received
+        :param error: [OPTIONAL] Whether the request failed. Default False.
+        """
+        with self._lock:
+            self.requests += 1
+            self.error_rate = self._average(self.error_rate, float(error))
+            if error:
+                self._chunk_threshold = max(self.min_chunk_size, self.chunk_size // 2)
+                self._decide(self.workers / 2, self.chunk_size / 2, 'error')
+                return
+            self.latency = self._average(self.latency, seconds)
+            if size:
+                self.bytes_per_second = self._average(self.bytes_per_second, size / max(seconds, 1e-6))
+                cost = max(seconds, 1e-6) / size
+                self._best_cost = cost if self._best_cost is None else min(self._best_cost, cost)
+                if cost > self.congestion_factor * self._best_cost and self.workers > self.min_workers:
+                    self._decide(self.workers / 2, self.chunk_size, 'congestion')
+                    return
+            if seconds > self.target_seconds:
+                self._chunk_threshold = max(self.min_chunk_size, self.chunk_size // 2)
+                self._decide(self.workers, self.chunk_size / 2, 'slow')
+            else:
+                step = self.chunk_size_step if self.chunk_size < self._chunk_threshold else 1
+                self._decide(self.workers + 1, self.chunk_size + step, 'fast')
+
+    def get_metrics(self):
+        """
+        :return: A dictionary of the current settings, the moving averages of latency, bytes per second and error
+            rate, and the recent decisions
+        """
+        with self._lock:
+            return {'workers': self.workers, 'chunk_size': self.chunk_size, 'requests': self.requests,
+                    'latency': self.latency, 'bytes_per_second': self.bytes_per_second,
+                    'error_rate': self.error_rate, 'decisions': list(self.decisions)}
+
+
+def get_tuner(area_type_id):
+    """
+    :param area_type_id: ID of an area type, or None for downloads spanning area types
+    :return: The AutoTuner of the area type, created with the module bounds on first use
+    """
+    with _tuners_lock:
+        if area_type_id not in _tuners:
+            _tuners[area_type_id] = AutoTuner(min_workers, max_workers, min_chunk_size, max_chunk_size,
+                                              chunk_size_step=chunk_size_step, target_seconds=target_seconds)
+        return _tuners[area_type_id]
+
+
+def get_autotune_metrics():
+    """
+    :return: A dictionary of area type IDs with the metrics of their AutoTuner
+    """
+    with _tuners_lock:
+        tuners = dict(_tuners)
+    return {area_type_id: tuner.get_metrics() for area_type_id, tuner in tuners.items()}
+
+
+def reset_tuners():
+    """
+    Removes every AutoTuner so the next downloads start from the default settings.
+    """
+    with _tuners_lock:
+        _tuners.clear()
+
+
+def read_csv_with_size(url):
+    """
+    :param url: A url that returns a CSV
+    :return: A tuple of a dataframe of the CSV and the number of bytes received
+
+    :meta private:
+    """
+    with get_default_client().open_cached_csv(url) as csv_file:
+        content = csv_file.read()
+    return pd.read_csv(BytesIO(content), dtype=text_column_types), len(content)
+
+
+def _timed(fetch, batch):
+    """
+    :return: A tuple of the result of fetch, the number of bytes, the seconds taken and any error raised
+
+    :meta private:
+    """
+    start = time.perf_counter()
+    try:
+        result, size = fetch(batch)
+        return result, size, time.perf_counter() - start, None
+    except (HTTPError, URLError) as error:
+        return None, 0, time.perf_counter() - start, error
+
+
+def run_tuned(tuner, items, fetch, chunked=True):
+    """
+    Fetches items in batches, keeping as many requests running as the tuner allows and sizing each new batch from the
+    tuner's current chunk size. Each batch is a run of consecutive items. The items of a failed batch are put back to
+    be requested again in batches of at most half its size, and its error is raised after max_attempts failures.
+
+    :param tuner: An AutoTuner
+    :param items: A list of items, eg. indicator IDs or area type IDs
+    :param fetch: A function that takes a list of items and returns a tuple of a dataframe and the bytes received
+    :param chunked: [OPTIONAL] Whether items can be batched. If False each item is fetched on its own. Default True.
+    :return: A dataframe of the results in the order of the items
+
+    :meta private:
+    """
+    pending = deque((position, item, len(items)) for position, item in enumerate(items))
+    attempts = {}
+    results = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=tuner.max_workers) as executor:
+        while pending or running:
+            while pending and len(running) < tuner.workers:
+                size = min(tuner.chunk_size, pending[0][2]) if chunked else 1
+                batch = [pending.popleft()]
+                while pending and len(batch) < size and pending[0][0] == batch[-1][0] + 1:
+                    batch.append(pending.popleft())
+                running[executor.submit(contextvars.copy_context().run, _timed, fetch,
+                                        [item for _, item, _ in batch])] = batch
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = running.pop(future)
+                result, size, seconds, error = future.result()
+                tuner.observe(seconds, size, error is not None)
+                if error is None:
+                    results.append((batch[0][0], result))
+                    continue
+                for position, item, _ in reversed(batch):
+                    attempts[position] = attempts.get(position, 0) + 1
+                    if attempts[position] >= max_attempts:
+                        for other in running:
+                            other.cancel()
+                        raise error
+                    pending.appendleft((position, item, max(1, len(batch) // 2)))
+    frames = [result for _, result in sorted(results, key=lambda pair: pair[0])]
+    if not frames:
+        return pd.DataFrame()
+    with timed('concat_seconds'):
+        return pd.concat(frames)
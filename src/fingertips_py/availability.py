@@ -0,0 +1,148 @@
+"""
+A cached matrix of which indicators have data for which area types, built from the available_data endpoint, and of
+which indicators belong to each profile, from the profile metadata. The retrieval functions consult it so that they do
+not request indicator and area type combinations that are known to return an empty CSV.
+
+The available_data endpoint does not break availability down by parent area type, so a combination listed as
+available can still be empty for some parent area types. Indicators missing from the matrix altogether, for example
+ones published since it was built, are never skipped.
+"""
+
+
+import time
+import threading
+import pandas as pd
+from fingertips_py.api_calls import get_json
+from fingertips_py.metadata import get_metadata_for_profile_as_dataframe
+from fingertips_py.urls import build_url, id_list
+
+
+use_availability = True
+max_age = 3600
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+class AvailabilityMatrix:
+    """
+    Indicator by area type availability.
+
+    :param records: A list of dictionaries with 'IndicatorId' and 'AreaTypeId', as returned by available_data
+    """
+
+    def __init__(self, records):
+        area_types = {}
+        for item in records:
+            area_types.setdefault(int(item.get('IndicatorId')), set()).add(int(item.get('AreaTypeId')))
+        self.area_types = {indicator_id: frozenset(value) for indicator_id, value in area_types.items()}
+        self.created = time.time()
+
+    def has_data(self, indicator_id, area_type_id):
+        """
+        :param indicator_id: ID of an indicator
+        :param area_type_id: ID of an area type
+        :return: False if the indicator is known to have no data for the area type, otherwise True
+        """
+        known = self.area_types.get(int(indicator_id))
+        return known is None or int(area_type_id) in known
+
+    def available_indicators(self, indicator_ids, area_type_id):
+        """
+        :param indicator_ids: ID or list of IDs of indicators
+        :param area_type_id: ID of an area type
+        :return: A sorted list of the indicators that may have data for the area type
+        """
+        return [indicator_id for indicator_id in id_list(indicator_ids) if self.has_data(indicator_id, area_type_id)]
+
+    def available_area_types(self, indicator_ids, area_type_ids):
+        """
+        :param indicator_ids: ID or list of IDs of indicators
+        :param area_type_ids: List of IDs of area types
+        :return: The area types, in the order given, for which at least one of the indicators may have data
+        """
+        indicator_ids = id_list(indicator_ids)
+        return [area_type_id for area_type_id in area_type_ids
+                if any(self.has_data(indicator_id, area_type_id) for indicator_id in indicator_ids)]
+
+    def to_frame(self):
+        """
+        :return: A boolean dataframe with indicator IDs as the index and area type IDs as the columns
+        """
+        pairs = pd.DataFrame([(indicator_id, area_type_id) for indicator_id, area_types in self.area_types.items()
+                              for area_type_id in area_types], columns=['Indicator ID', 'Area Type ID'])
+        return pd.crosstab(pairs['Indicator ID'], pairs['Area Type ID']).astype(bool)
+
+
+def _cached(key, loader, refresh=False):
+    """
+    :param key: Key of the value in the availability cache
+    :param loader: A function that returns the value if it is not cached or older than max_age
+    :param refresh: Whether to load the value again
+    :return: The cached value
+
+    :meta private:
+    """
+    item = _cache.get(key)
+    if refresh or item is None or time.time() - item[0] > max_age:
+        item = (time.time(), loader())
+        with _cache_lock:
+            _cache[key] = item
+    return item[1]
+
+
+def get_availability_matrix(refresh=False):
+    """
+    Returns the cached availability matrix, downloading it on first use and after max_age seconds.
+
+    :param refresh: [OPTIONAL] Whether to download the availability again. Default False.
+    :return: An AvailabilityMatrix
+    """
+    return _cached('matrix', lambda: AvailabilityMatrix(get_json(build_url('available_data'))), refresh)
+
+
+def get_profile_indicators(profile_id, refresh=False):
+    """
+    :param profile_id: ID used in Fingertips to identify a profile
+    :param refresh: [OPTIONAL] Whether to download the profile metadata again. Default False.
+    :return: A set of the indicator IDs within the profile
+    """
+    return _cached(('profile', int(profile_id)),
+                   lambda: set(get_metadata_for_profile_as_dataframe(profile_id)['Indicator ID'].astype(int)), refresh)
+
+
+def clear_availability_cache():
+    """
+    Removes the cached availability matrix and profile membership.
+    """
+    with _cache_lock:
+        _cache.clear()
+
+
+def filter_indicators(indicator_ids, area_type_id):
+    """
+    :param indicator_ids: ID or list of IDs of indicators
+    :param area_type_id: ID of an area type
+    :return: The indicators that may have data for the area type, or all of them if use_availability is False
+
+    :meta private:
+    """
+    if not use_availability:
+        return id_list(indicator_ids)
+    return get_availability_matrix().available_indicators(indicator_ids, area_type_id)
+
+
+def filter_profile_area_types(profile_id, area_type_ids):
+    """
+    :param profile_id: ID used in Fingertips to identify a profile
+    :param area_type_ids: List of IDs of area types
+    :return: The area types for which at least one indicator in the profile may have data
+
+    :meta private:
+    """
+    if not use_availability:
+        return list(area_type_ids)
+    profile_indicators = get_profile_indicators(profile_id)
+    if not profile_indicators:
+        return list(area_type_ids)
+    return get_availability_matrix().available_area_types(list(profile_indicators), area_type_ids)
@@ -0,0 +1,302 @@
+"""
+Cache backends for API responses. Every backend stores bytes under a string key with an optional time to live, so the
+same interface works for an in-process LRU cache, files on disk, a SQLite database shared by processes on one host,
+or a Redis-compatible key-value store shared by a fleet of workers. CacheBackend is a protocol: third-party backends
+only need get, set, delete and clear methods and do not have to subclass it.
+"""
+
+
+import os
+import math
+import time
+import struct
+import sqlite3
+import hashlib
+import threading
+from typing import Protocol, runtime_checkable
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+default_ttl = 3600
+
+endpoint_ttls = {
+    'all_data': 3600,
+    'available_data': 3600,
+    'indicator_metadata': 86400,
+    'profiles': 86400,
+    'profile': 86400,
+    'area_types': 86400,
+    'areas': 86400,
+    'ages': 604800,
+    'sexes': 604800,
+    'value_notes': 604800,
+    'category_types': 604800,
+}
+
+
+def cache_key(url, params=None):
+    """
+    Normalises a url and its parameters into a cache key. The scheme and host are lower cased, whitespace is removed,
+    query parameters are sorted by name and comma separated lists of IDs are sorted with duplicates removed, so the
+    same logical request always has the same key.
+
+    :param url: A url to make a request
+    :param params: [OPTIONAL] Dictionary of extra query parameters
+    :return: A string key
+    """
+    parts = urlsplit(''.join(url.split()))
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    query += [(name, str(value)) for name, value in (params or {}).items()]
+    normalised = []
+    for name, value in query:
+        if ',' in value:
+            items = list(dict.fromkeys(item for item in value.split(',') if item))
+            if all(item.isdigit() for item in items):
+                items.sort(key=int)
+            value = ','.join(items)
+        normalised.append((name, value))
+    normalised.sort()
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(normalised, safe=','), ''))
+
+
+def ttl_for_url(url):
+    """
+    :param url: A url to make a request
+    :return: The time to live in seconds for responses from the url's endpoint
+
+    :meta private:
+    """
+    path = urlsplit(url).path
+    segments = [segment for segment in path.split('/') if segment]
+    if 'api' in segments:
+        segments = segments[segments.index('api') + 1:]
+    if segments:
+        return endpoint_ttls.get(segments[0], default_ttl)
+    return default_ttl
+
+
+@runtime_checkable
+class CacheBackend(Protocol):
+    """
+    Protocol of cache backends. Values are bytes; ttl is a number of seconds or None to keep the value until it is
+    evicted or deleted. isinstance(backend, CacheBackend) is True for any object with these methods.
+    """
+
+    def get(self, key):
+        """
+        :param key: A string key
+        :return: The cached bytes, or None if the key is missing or expired
+        """
+        ...
+
+    def set(self, key, value, ttl=None):
+        """
+        :param key: A string key
+        :param value: Bytes to cache
+        :param ttl: [OPTIONAL] Time to live in seconds
+        """
+        ...
+
+    def delete(self, key):
+        """
+        :param key: A string key
+        """
+        ...
+
+    def clear(self):
+        """
+        Removes every value from the cache.
+        """
+        ...
+
+
+class MemoryCache(CacheBackend):
+    """
+    An in-process least recently used cache.
+
+    :param max_entries: [OPTIONAL] Maximum number of values. Default 1024.
+    :param max_bytes: [OPTIONAL] Maximum total size of the values. Default 256 MB.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._values = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires < time.time():
+                self._remove(key)
+                return None
+            self._values.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if len(value) > self.max_bytes:
+            return
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._remove(key)
+            self._values[key] = (value, expires)
+            self._size += len(value)
+            while len(self._values) > self.max_entries or self._size > self.max_bytes:
+                self._remove(next(iter(self._values)))
+
+    def _remove(self, key):
+        """
+        :meta private:
+        """
+        item = self._values.pop(key, None)
+        if item is not None:
+            self._size -= len(item[0])
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._size = 0
+
+
+class FileSystemCache(CacheBackend):
+    """
+    A cache of one file per value in a directory. Files are written atomically so the directory can be shared by
+    processes.
+
+    :param directory: Directory to keep the cached values in
+    """
+
+    _header = struct.Struct('>d')
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        """
+        :meta private:
+        """
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.cache')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as cache_file:
+                expires, = self._header.unpack(cache_file.read(self._header.size))
+                if expires and expires < time.time():
+                    return None
+                return cache_file.read()
+        except (FileNotFoundError, struct.error):
+            return None
+
+    def set(self, key, value, ttl=None):
+        path = self._path(key)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as cache_file:
+            cache_file.write(self._header.pack(time.time() + ttl if ttl is not None else 0))
+            cache_file.write(value)
+        os.replace(temp_path, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                os.remove(os.path.join(self.directory, name))
+
+
+class SQLiteCache(CacheBackend):
+    """
+    A cache in a SQLite database, suitable for sharing between processes on one host.
+
+    :param path: Path of the database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+
+    def _connection(self):
+        """
+        :return: A connection for the current thread and process
+
+        :meta private:
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return bytes(row[0])
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                               (key, sqlite3.Binary(value), expires))
+
+    def delete(self, key):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache')
+
+
+class RedisCache(CacheBackend):
+    """
+    A cache in a Redis-compatible key-value store. Any client with the get, set (with an ex argument), delete and
+    scan_iter methods of redis-py can be used.
+
+    :param client: A Redis-compatible client, eg. redis.Redis()
+    :param prefix: [OPTIONAL] Prefix for keys in the store. Default 'fingertips_py:'.
+    """
+
+    def __init__(self, client, prefix='fingertips_py:'):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, key):
+        """
+        :meta private:
+        """
+        return self.prefix + hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        return self.client.get(self._key(key))
+
+    def set(self, key, value, ttl=None):
+        if ttl is not None and ttl <= 0:
+            self.delete(key)
+            return
+        self.client.set(self._key(key), value, ex=math.ceil(ttl) if ttl is not None else None)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
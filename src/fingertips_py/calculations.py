@@ -0,0 +1,150 @@
+"""
+Vectorised calculations on Fingertips data: Wilson and Byar's confidence intervals, and aggregation of counts and
+denominators from areas up to higher geographies. The calculation method and unit multiplier for each indicator are
+read from the indicator metadata, which is cached for the session.
+"""
+
+
+import threading
+import numpy as np
+import pandas as pd
+from statistics import NormalDist
+from fingertips_py.metadata import get_multiplier_and_calculation_for_indicator
+
+
+_method_cache = {}
+_method_cache_lock = threading.Lock()
+
+group_columns = ['Indicator ID', 'Sex', 'Age', 'Category Type', 'Category', 'Time period']
+
+
+def _z_value(confidence):
+    """
+    :param confidence: Confidence level as a proportion, eg. 0.95
+    :return: The two sided standard normal quantile for the confidence level
+
+    :meta private:
+    """
+    return NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+
+
+def wilson_ci(count, denominator, confidence=0.95, multiplier=100):
+    """
+    Calculates Wilson score confidence intervals for proportions.
+
+    :param count: Number, list or array of counts (numerators)
+    :param denominator: Number, list or array of denominators
+    :param confidence: [OPTIONAL] Confidence level as a proportion. Default 0.95.
+    :param multiplier: [OPTIONAL] Unit multiplier, eg. 100 for a percentage. Default 100.
+    :return: A tuple of arrays of lower and upper limits
+    """
+    count = np.asarray(count, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    z = _z_value(confidence)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proportion = count / denominator
+        spread = z * np.sqrt(z ** 2 + 4 * count * (1 - proportion))
+        scale = 2 * (denominator + z ** 2)
+        lower = (2 * count + z ** 2 - spread) / scale
+        upper = (2 * count + z ** 2 + spread) / scale
+    return lower * multiplier, upper * multiplier
+
+
+def byars_ci(count, denominator, confidence=0.95, multiplier=100000):
+    """
+    Calculates Byar's approximation to the Poisson confidence intervals for crude rates.
+
+    :param count: Number, list or array of counts (numerators)
+    :param denominator: Number, list or array of denominators
+    :param confidence: [OPTIONAL] Confidence level as a proportion. Default 0.95.
+    :param multiplier: [OPTIONAL] Unit multiplier, eg. 100000 for a rate per 100,000. Default 100000.
+    :return: A tuple of arrays of lower and upper limits
+    """
+    count = np.asarray(count, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    z = _z_value(confidence)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lower_count = count * (1 - 1 / (9 * count) - z / (3 * np.sqrt(count))) ** 3
+        lower_count = np.where(count == 0, 0.0, lower_count)
+        upper_count = (count + 1) * (1 - 1 / (9 * (count + 1)) + z / (3 * np.sqrt(count + 1))) ** 3
+        lower = lower_count / denominator
+        upper = upper_count / denominator
+    return lower * multiplier, upper * multiplier
+
+
+def get_calculation_for_indicator(indicator_id):
+    """
+    Returns the unit multiplier and confidence interval method for an indicator, caching the result for the session.
+
+    :param indicator_id: Number used to identify an indicator within Fingertips as integer or string
+    :return: A tuple of multiplier and calculation method ('Wilson', 'Byar' or None)
+    """
+    key = int(indicator_id)
+    if key not in _method_cache:
+        result = get_multiplier_and_calculation_for_indicator(key)
+        with _method_cache_lock:
+            _method_cache[key] = result
+    return _method_cache[key]
+
+
+def add_confidence_intervals(df, confidence=0.95, method=None, multiplier=None):
+    """
+    Recalculates the value and confidence intervals of a dataframe from its 'Count' and 'Denominator' columns. The
+    calculation is vectorised per indicator. Indicators without a Wilson or Byar's method get empty limits.
+
+    :param df: A dataframe with 'Indicator ID', 'Count' and 'Denominator' columns
+    :param confidence: [OPTIONAL] Confidence level as a proportion. Default 0.95.
+    :param method: [OPTIONAL] 'Wilson' or 'Byar' to use for all indicators. Defaults to the indicator metadata.
+    :param multiplier: [OPTIONAL] Unit multiplier to use for all indicators. Defaults to the indicator metadata.
+    :return: A copy of the dataframe with 'Value' and the lower and upper limit columns for the confidence level
+    """
+    df = df.copy()
+    count = df['Count'].to_numpy(dtype=float)
+    denominator = df['Denominator'].to_numpy(dtype=float)
+    indicator_codes, indicators = pd.factorize(df['Indicator ID'])
+    values = np.full(len(df), np.nan)
+    lower = np.full(len(df), np.nan)
+    upper = np.full(len(df), np.nan)
+    for position, indicator_id in enumerate(indicators):
+        rows = indicator_codes == position
+        indicator_multiplier, indicator_method = multiplier, method
+        if method is None or multiplier is None:
+            metadata_multiplier, metadata_method = get_calculation_for_indicator(indicator_id)
+            indicator_multiplier = multiplier or metadata_multiplier
+            indicator_method = method or metadata_method
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values[rows] = count[rows] / denominator[rows] * indicator_multiplier
+        if indicator_method == 'Wilson':
+            lower[rows], upper[rows] = wilson_ci(count[rows], denominator[rows], confidence, indicator_multiplier)
+        elif indicator_method == 'Byar':
+            lower[rows], upper[rows] = byars_ci(count[rows], denominator[rows], confidence, indicator_multiplier)
+    df['Value'] = values
+    df[f'Lower CI {confidence * 100:.1f} limit'] = lower
+    df[f'Upper CI {confidence * 100:.1f} limit'] = upper
+    return df
+
+
+def aggregate_areas(df, area_mapping=None, confidence=0.95, method=None, multiplier=None):
+    """
+    Aggregates counts and denominators from areas up to a higher geography and recalculates values and confidence
+    intervals. By default areas are aggregated to their 'Parent Code'.
+
+    :param df: A dataframe for a single area type as returned by the retrieve_data functions with 'Count' and
+        'Denominator' columns
+    :param area_mapping: [OPTIONAL] Dictionary or series of area code to higher area code. Areas not in the mapping
+        are dropped. Defaults to the 'Parent Code' column.
+    :param confidence: [OPTIONAL] Confidence level as a proportion. Default 0.95.
+    :param method: [OPTIONAL] 'Wilson' or 'Byar' to use for all indicators. Defaults to the indicator metadata.
+    :param multiplier: [OPTIONAL] Unit multiplier to use for all indicators. Defaults to the indicator metadata.
+    :return: A dataframe of summed counts and denominators with recalculated values and limits per higher area
+    """
+    if area_mapping is None:
+        target = df['Parent Code']
+    else:
+        target = df['Area Code'].map(area_mapping)
+    columns = [column for column in group_columns if column in df.columns]
+    grouped = df[columns + ['Count', 'Denominator']].assign(**{'Area Code': target.to_numpy()})
+    grouped = grouped.loc[grouped['Area Code'].notna()]
+    aggregated = grouped.groupby(['Area Code'] + columns, dropna=False, sort=False)[['Count', 'Denominator']] \
+        .sum(min_count=1).reset_index()
+    return add_confidence_intervals(aggregated, confidence=confidence, method=method, multiplier=multiplier)
@@ -0,0 +1,83 @@
+"""
+The fingertips-py command line tool for exporting Fingertips data to local files.
+
+Example::
+
+    fingertips-py export --profile 84 --area-type 102 --area-type 7 --format parquet --output ./mirror
+"""
+
+
+import sys
+import argparse
+from fingertips_py.export import export_data, file_formats
+
+
+def _id_list(value):
+    """
+    :param value: A comma separated string of IDs
+    :return: A list of integer IDs
+
+    :meta private:
+    """
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def build_parser():
+    """
+    :return: The argument parser for the fingertips-py command
+
+    :meta private:
+    """
+    parser = argparse.ArgumentParser(prog='fingertips-py', description='Tools for working with Fingertips data.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    export = subparsers.add_parser('export', help='Export profiles, domains or indicators to partitioned files.')
+    export.add_argument('--profile', dest='profile_ids', type=int, action='append',
+                        help='Profile ID to export. Can be repeated.')
+    export.add_argument('--domain', dest='domain_ids', type=int, action='append',
+                        help='Domain (group) ID to export. Can be repeated.')
+    export.add_argument('--indicators', dest='indicator_lists', type=_id_list, action='append',
+                        help='Comma separated list of indicator IDs exported together. Can be repeated.')
+    export.add_argument('--area-type', dest='area_type_ids', type=int, action='append',
+                        help='Area type ID. Can be repeated. Defaults to all area types of each profile.')
+    export.add_argument('--parent-area-type', dest='parent_area_type_id', type=int, default=15,
+                        help='Parent area type ID. Default 15 (England).')
+    export.add_argument('--format', dest='file_format', choices=list(file_formats), default='parquet',
+                        help='Output file format. Default parquet.')
+    export.add_argument('--output', dest='output_dir', required=True, help='Output directory.')
+    export.add_argument('--workers', type=int, default=None, help='Number of concurrent downloads.')
+    export.add_argument('--chunksize', type=int, default=100000, help='Rows per part file. Default 100000.')
+    export.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='Download partitions again even if they have already been written.')
+    export.add_argument('--quiet', action='store_true', help='Only print the final statistics.')
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point of the fingertips-py command.
+
+    :param argv: [OPTIONAL] List of command line arguments. Defaults to sys.argv.
+    :return: The exit code
+    """
+    args = build_parser().parse_args(argv)
+    if not (args.profile_ids or args.domain_ids or args.indicator_lists):
+        print('Nothing to export: use --profile, --domain or --indicators', file=sys.stderr)
+        return 2
+    progress = None if args.quiet else lambda partition, rows: print(f'{partition}: {rows} rows', flush=True)
+    try:
+        stats = export_data(args.output_dir, area_type_ids=args.area_type_ids, profile_ids=args.profile_ids,
+                            domain_ids=args.domain_ids, indicator_lists=args.indicator_lists,
+                            parent_area_type_id=args.parent_area_type_id, file_format=args.file_format,
+                            workers=args.workers, resume=args.resume, chunksize=args.chunksize, progress=progress)
+    except (ValueError, ImportError) as error:
+        print(error, file=sys.stderr)
+        return 2
+    print(f"{stats['written']} partitions written, {stats['skipped']} skipped, {stats['rows']} rows, "
+          f"{stats['bytes'] / 1e6:.1f} MB in {stats['seconds']:.1f}s "
+          f"({stats['rows_per_second']:.0f} rows/s, {stats['megabytes_per_second']:.2f} MB/s)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
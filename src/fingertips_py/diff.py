@@ -0,0 +1,180 @@
+"""
+Comparison of two snapshots of Fingertips data, for example two nightly pulls of a profile, to find the rows that were
+added, removed or revised. Each row is reduced to two 64-bit hashes, one of its key columns and one of its value
+columns, so the comparison is done on NumPy arrays of integers rather than by merging string columns. Snapshots can be
+read chunk by chunk, in which case only the hashes (16 bytes a row) and the differing rows are held in memory.
+"""
+
+
+import os
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+from pandas.api.types import is_numeric_dtype, is_bool_dtype
+
+
+DatasetDiff = namedtuple('DatasetDiff', ['added', 'removed', 'changed'])
+
+default_key_columns = ['Indicator ID', 'Area Code', 'Sex', 'Age', 'Category Type', 'Category', 'Time period']
+
+previous_suffix = ' (previous)'
+
+
+def _iter_chunks(snapshot, chunksize):
+    """
+    :param snapshot: A dataframe, the path of a CSV file or a function that returns an iterable of dataframes
+    :param chunksize: Number of rows in each chunk, or None to read a CSV file in chunks of 100000 rows and a
+        dataframe whole. CSV files are read with round trip float precision, so values written by to_csv are read back
+        exactly.
+    :return: An iterable of dataframes
+
+    :meta private:
+    """
+    if isinstance(snapshot, pd.DataFrame):
+        if not chunksize:
+            return [snapshot]
+        return (snapshot.iloc[start:start + chunksize] for start in range(0, len(snapshot), chunksize))
+    if isinstance(snapshot, (str, os.PathLike)):
+        return pd.read_csv(snapshot, chunksize=chunksize or 100000, float_precision='round_trip')
+    if callable(snapshot):
+        return snapshot()
+    raise TypeError('A snapshot must be a dataframe, the path of a CSV file or a function returning dataframes')
+
+
+def _labels(uniques):
+    """
+    :param uniques: Distinct values of a column
+    :return: An object array of the values as text, with numbers written the same way whether they were read as
+        integers, floats or strings
+
+    :meta private:
+    """
+    values = np.asarray(uniques, dtype=object)
+    numbers = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype='float64')
+    return np.array([(str(int(number)) if number == int(number) else repr(number)) if np.isfinite(number)
+                     else str(value) for value, number in zip(values, numbers)], dtype=object)
+
+
+def _canonical(series, as_text=False):
+    """
+    :param series: A column
+    :param as_text: Whether to write numbers as text, so that a column read as numbers in one snapshot and as text in
+        the other (eg. 'Time period') hashes the same
+    :return: The column in a form that hashes the same whatever dtype it was read with, eg. int64, float64, object or
+        Arrow backed. Missing values are None, or NaN in numeric columns.
+
+    :meta private:
+    """
+    codes, uniques = pd.factorize(series)
+    if len(uniques) == 0:
+        return np.full(len(series), None, dtype=object)
+    if is_numeric_dtype(series.dtype) and not is_bool_dtype(series.dtype) and not as_text:
+        return series.to_numpy(dtype='float64', na_value=np.nan)
+    return np.where(codes >= 0, _labels(uniques)[codes], None)
+
+
+def hash_rows(df, columns, as_text=False):
+    """
+    :param df: A dataframe
+    :param columns: The columns to hash
+    :param as_text: [OPTIONAL] Whether to hash numbers as text. Default False.
+    :return: A NumPy array with a 64-bit hash of the columns for each row
+    """
+    frame = pd.DataFrame({column: _canonical(df[column], as_text) for column in columns}, index=df.index)
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy(dtype=np.uint64)
+
+
+def _hash_snapshot(snapshot, key_columns, value_columns, chunksize):
+    """
+    :return: Sorted unique key hashes and the matching value hashes of a snapshot
+
+    :meta private:
+    """
+    keys = []
+    values = []
+    for chunk in _iter_chunks(snapshot, chunksize):
+        keys.append(hash_rows(chunk, key_columns, as_text=True))
+        values.append(hash_rows(chunk, value_columns))
+    if not keys:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64)
+    hashes = pd.DataFrame({'key': np.concatenate(keys), 'value': np.concatenate(values)}).drop_duplicates()
+    duplicated = hashes['key'].duplicated()
+    if duplicated.any():
+        raise ValueError(f'{int(duplicated.sum())} keys have more than one set of values. Add key columns so that '
+                         f'each row is identified, eg. key_columns=default_key_columns + ["Area Type"]')
+    hashes = hashes.sort_values('key')
+    return hashes['key'].to_numpy(), hashes['value'].to_numpy()
+
+
+def _select_rows(snapshot, key_columns, wanted, chunksize):
+    """
+    :return: The rows of a snapshot whose key hash is in each of the wanted arrays, with a column of the key hashes
+
+    :meta private:
+    """
+    selected = [[] for _ in wanted]
+    for chunk in _iter_chunks(snapshot, chunksize):
+        keys = hash_rows(chunk, key_columns, as_text=True)
+        for frames, wanted_keys in zip(selected, wanted):
+            mask = np.isin(keys, wanted_keys, assume_unique=False)
+            if mask.any():
+                frames.append(chunk.loc[mask].assign(_key=keys[mask]))
+    return [pd.concat(frames, ignore_index=True).drop_duplicates('_key') if frames else None for frames in selected]
+
+
+def _first_columns(snapshot, chunksize):
+    """
+    :return: The columns of a snapshot
+
+    :meta private:
+    """
+    if isinstance(snapshot, pd.DataFrame):
+        return list(snapshot.columns)
+    if isinstance(snapshot, (str, os.PathLike)):
+        return list(pd.read_csv(snapshot, nrows=0).columns)
+    for chunk in _iter_chunks(snapshot, chunksize):
+        return list(chunk.columns)
+    return []
+
+
+def diff(old, new, key_columns=None, value_columns=None, chunksize=None):
+    """
+    Compares two snapshots of data and returns the rows that were added, removed or changed. A snapshot is a
+    dataframe, the path of a CSV file (read in chunks) or a function that returns an iterable of dataframes, for
+    example lambda: pd.read_csv(path, chunksize=100000). Snapshots are read twice: once to hash every row and once to
+    pick out the differing rows.
+
+    :param old: The earlier snapshot
+    :param new: The later snapshot
+    :param key_columns: [OPTIONAL] Columns that identify a row. Defaults to those of default_key_columns in the new
+        snapshot: indicator, area, sex, age, category and time period.
+    :param value_columns: [OPTIONAL] Columns compared between the snapshots. Defaults to all the other columns in both
+        snapshots.
+    :param chunksize: [OPTIONAL] Number of rows hashed at a time. Defaults to whole dataframes and 100000 rows of CSV
+        files.
+    :return: A DatasetDiff of dataframes of added rows, removed rows and changed rows. Changed rows are the new rows
+        with the earlier values in extra columns suffixed ' (previous)'.
+    """
+    old_columns = _first_columns(old, chunksize)
+    new_columns = _first_columns(new, chunksize)
+    if key_columns is None:
+        key_columns = [column for column in default_key_columns if column in new_columns]
+    if value_columns is None:
+        value_columns = [column for column in new_columns if column in old_columns and column not in key_columns]
+    old_keys, old_values = _hash_snapshot(old, key_columns, value_columns, chunksize)
+    new_keys, new_values = _hash_snapshot(new, key_columns, value_columns, chunksize)
+    common, old_index, new_index = np.intersect1d(old_keys, new_keys, assume_unique=True, return_indices=True)
+    changed_keys = common[old_values[old_index] != new_values[new_index]]
+    added_keys = np.setdiff1d(new_keys, old_keys, assume_unique=True)
+    removed_keys = np.setdiff1d(old_keys, new_keys, assume_unique=True)
+    added, changed = _select_rows(new, key_columns, [added_keys, changed_keys], chunksize)
+    removed, previous = _select_rows(old, key_columns, [removed_keys, changed_keys], chunksize)
+    added = added if added is not None else pd.DataFrame(columns=new_columns + ['_key'])
+    removed = removed if removed is not None else pd.DataFrame(columns=old_columns + ['_key'])
+    if changed is None:
+        changed = pd.DataFrame(columns=new_columns + [column + previous_suffix for column in value_columns])
+    else:
+        previous = previous[['_key'] + value_columns].rename(
+            columns={column: column + previous_suffix for column in value_columns})
+        changed = changed.merge(previous, on='_key', how='left').drop(columns='_key')
+    return DatasetDiff(added.drop(columns='_key'), removed.drop(columns='_key'), changed)
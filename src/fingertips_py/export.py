@@ -0,0 +1,359 @@
+"""
+Functions to mirror Fingertips data to local partitioned Parquet, Feather or CSV files. Each (profile, domain or
+indicator list) x area type download is written to its own partition directory as the data streams in. Downloads are
+run as checkpointed jobs with a manifest so an interrupted job can be resumed by fetching only the missing partitions.
+"""
+
+
+import os
+import json
+import time
+import glob
+import shutil
+import hashlib
+import threading
+import pandas as pd
+from collections import namedtuple
+from fingertips_py.api_calls import iter_csv_chunks, map_concurrently, text_column_types
+from fingertips_py.metadata import get_area_type_ids_for_profile
+from fingertips_py.urls import build_url, id_list
+
+
+ExportUnit = namedtuple('ExportUnit', ['partition', 'url'])
+
+file_formats = {'parquet': '.parquet', 'feather': '.feather', 'csv': '.csv'}
+
+
+def check_file_format(file_format):
+    """
+    Checks the output format is supported and that its optional dependency is installed.
+
+    :param file_format: One of 'parquet', 'feather' or 'csv'
+    :return: None, or raises a ValueError or ImportError
+
+    :meta private:
+    """
+    if file_format not in file_formats:
+        raise ValueError(f'File format must be one of {", ".join(file_formats)}')
+    if file_format in ('parquet', 'feather'):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError(f'Writing {file_format} files requires pyarrow. Install it with '
+                              f'pip install fingertips_py[arrow]')
+
+
+def _indicator_partition(indicator_ids):
+    """
+    :param indicator_ids: A list of indicator IDs
+    :return: A short, stable partition name for the list of indicators
+
+    :meta private:
+    """
+    indicator_ids = id_list(indicator_ids)
+    if len(indicator_ids) <= 5:
+        return 'indicator_ids=' + '-'.join(map(str, indicator_ids))
+    digest = hashlib.sha1(','.join(map(str, indicator_ids)).encode('utf-8')).hexdigest()[:12]
+    return f'indicator_ids={indicator_ids[0]}-{len(indicator_ids)}-{digest}'
+
+
+def plan_export_units(area_type_ids=None, profile_ids=None, domain_ids=None, indicator_lists=None,
+                      parent_area_type_id=15):
+    """
+    Lists the downloads needed for an export. Profiles without area types use all the area types of the profile.
+
+    :param area_type_ids: [OPTIONAL] List of area type IDs. Required for domains and indicator lists.
+    :param profile_ids: [OPTIONAL] List of profile IDs
+    :param domain_ids: [OPTIONAL] List of domain IDs
+    :param indicator_lists: [OPTIONAL] List of lists of indicator IDs, each exported as one partition per area type
+    :param parent_area_type_id: [OPTIONAL] Area type of parent area - defaults to England value
+    :return: A list of ExportUnit tuples of partition path and URL
+    """
+    if (domain_ids or indicator_lists) and not area_type_ids:
+        raise ValueError('Area types must be given to export domains or indicators')
+    units = []
+    for profile_id in profile_ids or []:
+        for area_type_id in area_type_ids or get_area_type_ids_for_profile(profile_id):
+            units.append(ExportUnit(f'profile_id={profile_id}/area_type_id={area_type_id}',
+                                    build_url('all_data/csv/by_profile_id', child_area_type_id=area_type_id,
+                                              parent_area_type_id=parent_area_type_id, profile_id=profile_id)))
+    for domain_id in domain_ids or []:
+        for area_type_id in area_type_ids:
+            units.append(ExportUnit(f'group_id={domain_id}/area_type_id={area_type_id}',
+                                    build_url('all_data/csv/by_group_id', child_area_type_id=area_type_id,
+                                              parent_area_type_id=parent_area_type_id, group_id=domain_id)))
+    for indicator_ids in indicator_lists or []:
+        for area_type_id in area_type_ids:
+            units.append(ExportUnit(_indicator_partition(indicator_ids) + f'/area_type_id={area_type_id}',
+                                    build_url('all_data/csv/by_indicator_id', indicator_ids=indicator_ids,
+                                              child_area_type_id=area_type_id,
+                                              parent_area_type_id=parent_area_type_id)))
+    return list(dict.fromkeys(units))
+
+
+def write_chunk(df, path, file_format):
+    """
+    :param df: A dataframe to write
+    :param path: File path without an extension
+    :param file_format: One of 'parquet', 'feather' or 'csv'
+    :return: The path of the written file
+
+    :meta private:
+    """
+    path = path + file_formats[file_format]
+    df = df.reset_index(drop=True)
+    if file_format == 'parquet':
+        df.to_parquet(path, index=False)
+    elif file_format == 'feather':
+        df.to_feather(path)
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+
+def export_unit(unit, output_dir, file_format='parquet', chunksize=100000):
+    """
+    Downloads one export unit and writes each streamed chunk as a part file. Parts are written to a temporary
+    directory that is renamed into place once the download is complete, so a partition either exists in full or not
+    at all.
+
+    :param unit: An ExportUnit
+    :param output_dir: Root directory of the export
+    :param file_format: [OPTIONAL] One of 'parquet', 'feather' or 'csv'. Default 'parquet'.
+    :param chunksize: [OPTIONAL] Number of rows in each part file. Default 100000.
+    :return: A tuple of rows and bytes written
+
+    :meta private:
+    """
+    final_dir = os.path.join(output_dir, unit.partition)
+    temp_dir = final_dir + '.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    rows = 0
+    written = 0
+    for number, chunk in enumerate(iter_csv_chunks(unit.url, chunksize=chunksize)):
+        path = write_chunk(chunk, os.path.join(temp_dir, f'part-{number:05d}'), file_format)
+        rows += len(chunk)
+        written += os.path.getsize(path)
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(temp_dir, final_dir)
+    return rows, written
+
+
+def default_file_format():
+    """
+    :return: 'parquet' if pyarrow is installed, otherwise 'csv'
+
+    :meta private:
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return 'csv'
+    return 'parquet'
+
+
+def read_partition(path, file_format):
+    """
+    :param path: A partition directory written by export_unit
+    :param file_format: One of 'parquet', 'feather' or 'csv'
+    :return: A dataframe of all the part files in the partition
+
+    :meta private:
+    """
+    parts = sorted(glob.glob(os.path.join(path, 'part-*' + file_formats[file_format])))
+    readers = {'parquet': pd.read_parquet, 'feather': pd.read_feather,
+               'csv': lambda part: pd.read_csv(part, dtype=text_column_types)}
+    frames = [readers[file_format](part) for part in parts]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+class DownloadJob:
+    """
+    A checkpointed download of a list of export units. Each completed unit is written to its partition directory and
+    recorded in a manifest.json file in the job directory. Running the job again, for example after a crash, only
+    fetches the units that are missing. An existing job can be reopened from its directory without giving the units.
+
+    :param job_dir: Directory holding the manifest and partitions
+    :param units: [OPTIONAL] List of ExportUnit tuples. Defaults to the units in an existing manifest.
+    :param file_format: [OPTIONAL] One of 'parquet', 'feather' or 'csv'. Defaults to the manifest, or parquet if
+        pyarrow is installed and csv otherwise. Units written in another format are downloaded again.
+    :param chunksize: [OPTIONAL] Number of rows in each part file. Default 100000.
+    """
+
+    manifest_name = 'manifest.json'
+
+    def __init__(self, job_dir, units=None, file_format=None, chunksize=100000):
+        self.job_dir = job_dir
+        self.chunksize = chunksize
+        self._lock = threading.Lock()
+        manifest = self._read_manifest()
+        if units is None:
+            if manifest is None:
+                raise ValueError(f'There is no download job in {job_dir}')
+            units = [ExportUnit(partition, item['url']) for partition, item in manifest['units'].items()]
+        self.units = list(units)
+        self.file_format = file_format or (manifest or {}).get('file_format') or default_file_format()
+        check_file_format(self.file_format)
+        recorded = (manifest or {}).get('units', {})
+        self.manifest = {'file_format': self.file_format, 'units': dict(recorded)}
+        recorded_format = (manifest or {}).get('file_format')
+        for unit in self.units:
+            item = recorded.get(unit.partition, {})
+            complete = (item.get('url', unit.url) == unit.url and self.is_written(unit)
+                        and item.get('file_format', recorded_format) == self.file_format)
+            self.manifest['units'][unit.partition] = dict(item, url=unit.url, complete=complete)
+        os.makedirs(job_dir, exist_ok=True)
+        self._write_manifest()
+
+    def _read_manifest(self):
+        """
+        :return: The manifest dictionary, or None if the job directory has no manifest
+
+        :meta private:
+        """
+        try:
+            with open(os.path.join(self.job_dir, self.manifest_name), encoding='utf-8') as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return None
+
+    def _write_manifest(self):
+        """
+        Writes the manifest to a temporary file and renames it so a crash never leaves a partial manifest.
+
+        :meta private:
+        """
+        path = os.path.join(self.job_dir, self.manifest_name)
+        with open(path + '.tmp', 'w', encoding='utf-8') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def is_written(self, unit):
+        """
+        :param unit: An ExportUnit
+        :return: Whether the partition directory of the unit exists
+        """
+        return os.path.isdir(os.path.join(self.job_dir, unit.partition))
+
+    def missing(self):
+        """
+        :return: A list of the units that have not been completed
+        """
+        return [unit for unit in self.units if not self.manifest['units'][unit.partition]['complete']]
+
+    def _run_unit(self, unit, progress=None):
+        """
+        Downloads a unit and checkpoints it in the manifest.
+
+        :meta private:
+        """
+        rows, written = export_unit(unit, self.job_dir, self.file_format, self.chunksize)
+        with self._lock:
+            self.manifest['units'][unit.partition].update(complete=True, file_format=self.file_format, rows=rows,
+                                                          bytes=written, completed=time.strftime('%Y-%m-%dT%H:%M:%S'))
+            self._write_manifest()
+        if progress is not None:
+            progress(unit.partition, rows)
+        return rows, written
+
+    def run(self, workers=None, refresh=False, progress=None):
+        """
+        Downloads the missing units concurrently, checkpointing each one as it completes.
+
+        :param workers: [OPTIONAL] Maximum number of concurrent downloads. Defaults to api_calls.max_workers.
+        :param refresh: [OPTIONAL] Whether to download every unit again. Default False.
+        :param progress: [OPTIONAL] A function called with the partition path and number of rows as each one finishes
+        :return: A dictionary of throughput statistics
+        """
+        if refresh:
+            for item in self.manifest['units'].values():
+                item['complete'] = False
+            for unit in self.units:
+                shutil.rmtree(os.path.join(self.job_dir, unit.partition), ignore_errors=True)
+        to_run = self.missing()
+        start = time.perf_counter()
+        results = map_concurrently(lambda unit: self._run_unit(unit, progress), to_run, workers)
+        seconds = time.perf_counter() - start
+        rows = sum(result[0] for result in results)
+        written = sum(result[1] for result in results)
+        return {'partitions': len(self.units), 'skipped': len(self.units) - len(to_run), 'written': len(to_run),
+                'rows': rows, 'bytes': written, 'seconds': seconds,
+                'rows_per_second': rows / seconds if seconds else 0.0,
+                'megabytes_per_second': written / 1e6 / seconds if seconds else 0.0}
+
+    def load(self):
+        """
+        :return: A dataframe of all the completed units, in the order of the units
+        """
+        frames = [read_partition(os.path.join(self.job_dir, unit.partition), self.file_format)
+                  for unit in self.units if self.manifest['units'][unit.partition]['complete']]
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+
+def profile_download_job(job_dir, profile_id, parent_area_type_id=15, area_type_ids=None, file_format=None):
+    """
+    Creates, or reopens, a checkpointed job downloading all data for a profile with one unit per area type.
+
+    :param job_dir: Directory holding the manifest and partitions
+    :param profile_id: ID used in Fingertips to identify a profile as integer or string
+    :param parent_area_type_id: [OPTIONAL] Area type of parent area - defaults to England value
+    :param area_type_ids: [OPTIONAL] List of area type IDs. Defaults to all area types of the profile.
+    :param file_format: [OPTIONAL] One of 'parquet', 'feather' or 'csv'
+    :return: A DownloadJob
+    """
+    units = plan_export_units(area_type_ids, profile_ids=[profile_id], parent_area_type_id=parent_area_type_id)
+    return DownloadJob(job_dir, units, file_format)
+
+
+def indicator_download_job(job_dir, indicator_ids, area_type_ids, parent_area_type_id=15, chunk_size=50,
+                           file_format=None):
+    """
+    Creates, or reopens, a checkpointed job downloading data for a list of indicators with one unit per chunk of
+    indicators and area type.
+
+    :param job_dir: Directory holding the manifest and partitions
+    :param indicator_ids: List of indicator IDs
+    :param area_type_ids: ID or list of IDs of area types
+    :param parent_area_type_id: [OPTIONAL] Area type of parent area - defaults to England value
+    :param chunk_size: [OPTIONAL] Number of indicators in each unit. Default 50.
+    :param file_format: [OPTIONAL] One of 'parquet', 'feather' or 'csv'
+    :return: A DownloadJob
+    """
+    if not isinstance(area_type_ids, list):
+        area_type_ids = [area_type_ids]
+    indicator_ids = sorted(set(int(ind) for ind in indicator_ids))
+    chunks = [indicator_ids[start:start + chunk_size] for start in range(0, len(indicator_ids), chunk_size)]
+    units = plan_export_units(area_type_ids, indicator_lists=chunks, parent_area_type_id=parent_area_type_id)
+    return DownloadJob(job_dir, units, file_format)
+
+
+def export_data(output_dir, area_type_ids=None, profile_ids=None, domain_ids=None, indicator_lists=None,
+                parent_area_type_id=15, file_format='parquet', workers=None, resume=True, chunksize=100000,
+                progress=None):
+    """
+    Exports profiles, domains and/or lists of indicators for the chosen area types to partitioned files. Downloads run
+    concurrently as a checkpointed DownloadJob and each partition is written as its data streams in.
+
+    :param output_dir: Root directory of the export
+    :param area_type_ids: [OPTIONAL] List of area type IDs. Required for domains and indicator lists.
+    :param profile_ids: [OPTIONAL] List of profile IDs
+    :param domain_ids: [OPTIONAL] List of domain IDs
+    :param indicator_lists: [OPTIONAL] List of lists of indicator IDs
+    :param parent_area_type_id: [OPTIONAL] Area type of parent area - defaults to England value
+    :param file_format: [OPTIONAL] One of 'parquet', 'feather' or 'csv'. Default 'parquet'.
+    :param workers: [OPTIONAL] Maximum number of concurrent downloads. Defaults to api_calls.max_workers.
+    :param resume: [OPTIONAL] Whether to skip partitions that have already been written. Default True.
+    :param chunksize: [OPTIONAL] Number of rows in each part file. Default 100000.
+    :param progress: [OPTIONAL] A function called with the partition path and number of rows as each one finishes
+    :return: A dictionary of throughput statistics
+    """
+    check_file_format(file_format)
+    units = plan_export_units(area_type_ids, profile_ids, domain_ids, indicator_lists, parent_area_type_id)
+    job = DownloadJob(output_dir, units, file_format, chunksize)
+    return job.run(workers=workers, refresh=not resume, progress=progress)
@@ -0,0 +1,157 @@
+"""
+Incremental downloads that only keep the time periods published since the last download. For each parent area type
+and area type the store holds a watermark per indicator, the latest 'Time period Sortable' already downloaded, and a
+CSV file per indicator that new rows are appended to. Rows at or before an indicator's watermark are dropped chunk by
+chunk as the response streams in, so older time periods are never held in memory.
+
+A time period is only downloaded once: revisions to periods at or before the watermark are not picked up. Use
+clear_incremental_store to download everything again.
+"""
+
+
+import os
+import json
+import threading
+import pandas as pd
+from fingertips_py.api_calls import iter_csv_chunks, text_column_types
+
+
+incremental_store_dir = os.environ.get('FINGERTIPS_PY_INCREMENTAL_STORE',
+                                       os.path.join(os.path.expanduser('~'), '.cache', 'fingertips_py', 'incremental'))
+
+sortable_column = 'Time period Sortable'
+
+_directory_locks = {}
+_directory_locks_lock = threading.Lock()
+
+
+def _area_type_dir(area_type_id, parent_area_type_id, store_dir):
+    """
+    :return: The store directory of an area type within a parent area type
+
+    :meta private:
+    """
+    return os.path.join(store_dir or incremental_store_dir, f'parent_area_type_id={parent_area_type_id}',
+                        f'area_type_id={area_type_id}')
+
+
+def _lock_for(directory):
+    """
+    :return: A lock serialising updates to a store directory within this process
+
+    :meta private:
+    """
+    with _directory_locks_lock:
+        return _directory_locks.setdefault(os.path.abspath(directory), threading.Lock())
+
+
+def get_watermarks(area_type_id, parent_area_type_id=15, store_dir=None):
+    """
+    :param area_type_id: ID of area type used in Fingertips
+    :param parent_area_type_id: [OPTIONAL] Area type of parent area - defaults to England value
+    :param store_dir: [OPTIONAL] Directory of the store. Defaults to incremental_store_dir.
+    :return: A dictionary of indicator IDs with the latest sortable time period downloaded
+    """
+    path = os.path.join(_area_type_dir(area_type_id, parent_area_type_id, store_dir), 'watermarks.json')
+    try:
+        with open(path, encoding='utf-8') as watermark_file:
+            return {int(indicator_id): value for indicator_id, value in json.load(watermark_file).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def _write_watermarks(directory, watermarks):
+    """
+    Writes the watermarks to a temporary file and renames it so a crash never leaves a partial file.
+
+    :meta private:
+    """
+    path = os.path.join(directory, 'watermarks.json')
+    with open(path + '.tmp', 'w', encoding='utf-8') as watermark_file:
+        json.dump({str(indicator_id): value for indicator_id, value in sorted(watermarks.items())}, watermark_file,
+                  indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _append_rows(path, df):
+    """
+    Appends rows to a CSV file, writing the header if the file is new and matching the columns of an existing file.
+
+    :meta private:
+    """
+    if os.path.exists(path):
+        columns = pd.read_csv(path, nrows=0).columns
+        df.reindex(columns=columns).to_csv(path, mode='a', header=False, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def fetch_since(url, area_type_id, parent_area_type_id=15, store_dir=None, chunksize=100000):
+    """
+    Streams a CSV that includes the 'Time period Sortable' column and keeps only the rows newer than the watermark of
+    their indicator. The new rows are appended to the store and the watermarks moved forward.
+
+    :param url: A url that returns a CSV of data with sortable time periods
+    :param area_type_id: ID of area type of the data
+    :param parent_area_type_id: [OPTIONAL] Area type of parent area - defaults to England value
+    :param store_dir: [OPTIONAL] Directory of the store. Defaults to incremental_store_dir.
+    :param chunksize: [OPTIONAL] Number of rows filtered at a time. Text columns are read as strings in every chunk.
+        Default 100000.
+    :return: A dataframe of the new rows
+    """
+    directory = _area_type_dir(area_type_id, parent_area_type_id, store_dir)
+    with _lock_for(directory):
+        watermarks = get_watermarks(area_type_id, parent_area_type_id, store_dir)
+        frames = []
+        for chunk in iter_csv_chunks(url, chunksize):
+            if sortable_column not in chunk.columns:
+                raise ValueError(f'The response from {url} has no {sortable_column} column')
+            floor = chunk['Indicator ID'].map(watermarks).fillna(-1)
+            frames.append(chunk.loc[chunk[sortable_column] > floor])
+        if not frames:
+            return pd.DataFrame()
+        new_rows = pd.concat(frames, ignore_index=True)
+        if new_rows.empty:
+            return new_rows
+        os.makedirs(directory, exist_ok=True)
+        for indicator_id, rows in new_rows.groupby('Indicator ID', sort=False):
+            _append_rows(os.path.join(directory, f'indicator_id={indicator_id}.csv'), rows)
+        latest = new_rows.groupby('Indicator ID')[sortable_column].max()
+        watermarks.update({int(indicator_id): int(value) for indicator_id, value in latest.items()})
+        _write_watermarks(directory, watermarks)
+    return new_rows
+
+
+def read_incremental_store(area_type_id, parent_area_type_id=15, indicator_ids=None, store_dir=None):
+    """
+    Returns all the rows downloaded into the store for an area type.
+
+    :param area_type_id: ID of area type used in Fingertips
+    :param parent_area_type_id: [OPTIONAL] Area type of parent area - defaults to England value
+    :param indicator_ids: [OPTIONAL] ID or list of IDs of indicators to read. Defaults to all stored indicators.
+    :param store_dir: [OPTIONAL] Directory of the store. Defaults to incremental_store_dir.
+    :return: A dataframe of the stored rows
+    """
+    directory = _area_type_dir(area_type_id, parent_area_type_id, store_dir)
+    if indicator_ids is None:
+        indicator_ids = get_watermarks(area_type_id, parent_area_type_id, store_dir)
+    elif not isinstance(indicator_ids, list):
+        indicator_ids = [indicator_ids]
+    paths = [os.path.join(directory, f'indicator_id={indicator_id}.csv') for indicator_id in indicator_ids]
+    frames = [pd.read_csv(path, dtype=text_column_types) for path in paths if os.path.exists(path)]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True).drop_duplicates()
+
+
+def clear_incremental_store(store_dir=None):
+    """
+    Deletes the stored rows and watermarks so the next incremental download fetches every time period.
+
+    :param store_dir: [OPTIONAL] Directory of the store. Defaults to incremental_store_dir.
+    """
+    store_dir = store_dir or incremental_store_dir
+    for directory, _, names in os.walk(store_dir):
+        for name in names:
+            if name == 'watermarks.json' or (name.startswith('indicator_id=') and name.endswith('.csv')):
+                os.remove(os.path.join(directory, name))
@@ -4,8 +4,12 @@ metadata.
 """
 
 import pandas as pd
-from urllib.error import HTTPError, URLError
-from fingertips_py.api_calls import get_data_in_tuple, base_url, make_request, get_json, get_json_return_df, deal_with_url_error, get_data_in_dict
+from urllib.error import HTTPError
+from fingertips_py.api_calls import get_data_in_tuple, make_request, get_json, get_json_return_df, get_data_in_dict, \
+    get_csv_return_df, map_concurrently
+from fingertips_py.search import get_profile_catalogue
+from fingertips_py.urls import build_url, id_list
+from fingertips_py.profiling import timed, profile_functions
 
 
 def get_all_ages(is_test=False):
@@ -15,9 +19,9 @@ def get_all_ages(is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: Age codes used in Fingertips in a dictionary
     """
-    ages = get_data_in_dict(base_url + 'ages')
+    ages = get_data_in_dict(build_url('ages'))
     if is_test:
-        return ages, base_url + 'ages'
+        return ages, build_url('ages')
     return ages
 
 
@@ -28,9 +32,9 @@ def get_all_areas(is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: A dictionary of all area types used in Fingertips
     """
-    areas = make_request(base_url + 'area_types', 'Id')
+    areas = make_request(build_url('area_types'), 'Id')
     if is_test:
-        return areas, base_url + 'area_types'
+        return areas, build_url('area_types')
     return areas
 
 
@@ -42,9 +46,9 @@ def get_age_id(age, is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: Code used in Fingertips to represent the age as an integer or age range as a string
     """
-    ages = make_request(base_url + 'ages', 'Name')
+    ages = make_request(build_url('ages'), 'Name')
     if is_test:
-        return ages[age]['Id'], base_url + 'ages'
+        return ages[age]['Id'], build_url('ages')
     return ages[age]['Id']
 
 
@@ -56,9 +60,9 @@ def get_age_from_id(age_id, is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: Age, or age range, as a string
     """
-    ages = make_request(base_url + 'ages', 'Id')
+    ages = make_request(build_url('ages'), 'Id')
     if is_test:
-        return ages[age_id]['Name'], base_url + 'ages'
+        return ages[age_id]['Name'], build_url('ages')
     return ages[age_id]['Name']
 
 
@@ -69,9 +73,9 @@ def get_all_sexes(is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: Sex categories used in Fingertips with associated codes as a dictionary
     """
-    sexes = get_data_in_dict(base_url + 'sexes', value = 'Name')
+    sexes = get_data_in_dict(build_url('sexes'), value = 'Name')
     if is_test:
-        return sexes, base_url + 'sexes'
+        return sexes, build_url('sexes')
     return sexes
 
 
@@ -83,9 +87,9 @@ def get_sex_id(sex, is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: ID used in Fingertips to represent the sex as an integer
     """
-    sexes = make_request(base_url + 'sexes', 'Name')
+    sexes = make_request(build_url('sexes'), 'Name')
     if is_test:
-        return sexes[sex]['Id'], base_url + 'sexes'
+        return sexes[sex]['Id'], build_url('sexes')
     return sexes[sex]['Id']
 
 
@@ -97,9 +101,9 @@ def get_sex_from_id(sex_id, is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: Sex category as string
     """
-    sexes = make_request(base_url + 'sexes', 'Id')
+    sexes = make_request(build_url('sexes'), 'Id')
     if is_test:
-        return sexes[sex_id]['Name'], base_url + 'sexes'
+        return sexes[sex_id]['Name'], build_url('sexes')
     return sexes[sex_id]['Name']
 
 
@@ -110,9 +114,9 @@ def get_all_value_notes(is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: Data value notes and their associated codes that are used in Fingertips as a dictionary
     """
-    value_notes = get_data_in_dict(base_url + 'value_notes', value = 'Text')
+    value_notes = get_data_in_dict(build_url('value_notes'), value = 'Text')
     if is_test:
-        return value_notes, base_url + 'value_notes'
+        return value_notes, build_url('value_notes')
     return value_notes
 
 
@@ -124,9 +128,9 @@ def get_value_note_id(value_note, is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: ID used in Fingertips to represent the value note as an integer
     """
-    value_notes = make_request(base_url + 'value_notes', 'Text')
+    value_notes = make_request(build_url('value_notes'), 'Text')
     if is_test:
-        return value_notes[value_note]['Id'], base_url + 'value_notes'
+        return value_notes[value_note]['Id'], build_url('value_notes')
     return value_notes[value_note]['Id']
 
 
@@ -138,9 +142,10 @@ def get_areas_for_area_type(area_type_id, is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: A dictionary of dictionaries with area codes as the key 
     """
-    areas = make_request(base_url + 'areas/by_area_type?area_type_id=' + str(area_type_id), 'Code')
+    url = build_url('areas/by_area_type', area_type_id=area_type_id)
+    areas = make_request(url, 'Code')
     if is_test:
-        return areas, base_url + 'areas/by_area_type?area_type_id=' + str(area_type_id)
+        return areas, url
     return areas
 
 
@@ -152,10 +157,11 @@ def get_metadata_for_indicator(indicator_number, is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: A dictionary of metadata for the given indicator
     """
-    metadata = get_json(base_url + 'indicator_metadata/by_indicator_id?indicator_ids=' + str(indicator_number))
+    url = build_url('indicator_metadata/by_indicator_id', indicator_ids=indicator_number)
+    metadata = get_json(url)
     metadata_dict = metadata.get(str(indicator_number))
     if is_test:
-        return metadata, base_url + 'indicator_metadata/by_indicator_id?indicator_ids=' + str(indicator_number)
+        return metadata, url
     return metadata_dict
 
 
@@ -166,12 +172,10 @@ def get_metadata_for_all_indicators_from_csv(is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: A dataframe of all metadata for all indicators
     """
-    try:
-        metadata = pd.read_csv(base_url + 'indicator_metadata/csv/all')
-    except URLError:
-        metadata = deal_with_url_error(base_url + 'indicator_metadata/csv/all')
+    url = build_url('indicator_metadata/csv/all')
+    metadata = get_csv_return_df(url)
     if is_test:
-        return metadata, base_url + 'indicator_metadata/csv/all'
+        return metadata, url
     return metadata
 
 
@@ -184,10 +188,11 @@ def get_metadata_for_all_indicators(include_definition='no', include_system_cont
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: dictionary of all indicators
     """
-    url_suffix = f'indicator_metadata/all?include_definition={include_definition}&include_system_content={include_system_content}'
-    metadata_dict = get_json(base_url + url_suffix)
+    url = build_url('indicator_metadata/all', include_definition=include_definition,
+                    include_system_content=include_system_content)
+    metadata_dict = get_json(url)
     if is_test:
-        return metadata_dict, base_url + url_suffix
+        return metadata_dict, url
     return metadata_dict
 
 
@@ -217,9 +222,9 @@ def get_area_types_as_dict(is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: A dictionary of area types
     """
-    areas = get_data_in_dict(base_url + 'area_types')
+    areas = get_data_in_dict(build_url('area_types'))
     if is_test:
-        return areas, base_url + 'area_types'
+        return areas, build_url('area_types')
     return areas
 
 
@@ -231,10 +236,10 @@ def get_profile_by_id(profile_id, is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: A dictionary of information about the profile
     """
+    url = build_url('profile', profile_id=profile_id)
     if is_test:
-        return get_json(base_url + 'profile?profile_id=' + str(profile_id)), base_url + 'profile?profile_id=' + \
-               str(profile_id)
-    return get_json(base_url + 'profile?profile_id=' + str(profile_id))
+        return get_json(url), url
+    return get_json(url)
 
 
 def get_all_profiles(is_test=False):
@@ -244,9 +249,9 @@ def get_all_profiles(is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: A dictionary of all profiles in Fingertips including information on domains and sequencing
     """
-    profiles = get_data_in_dict(base_url + 'profiles')
+    profiles = get_data_in_dict(build_url('profiles'))
     if is_test:
-        return profiles, base_url + 'profiles'
+        return profiles, build_url('profiles')
     return profiles
 
 
@@ -269,10 +274,10 @@ def get_area_types_for_profile(profile_id, is_test=False):
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
     :return: A list of dictionaries of area types with relevant information
     """
+    url = build_url('area_types', profile_ids=profile_id)
     if is_test:
-        return get_data_in_dict(base_url + 'area_types?profile_ids=' + str(profile_id)), base_url + 'area_types?profile_ids=' + \
-               str(profile_id)
-    return get_data_in_dict(base_url + 'area_types?profile_ids=' + str(profile_id))
+        return get_data_in_dict(url), url
+    return get_data_in_dict(url)
 
 
 def get_area_type_ids_for_profile(profile_id):
@@ -289,20 +294,17 @@ def get_area_type_ids_for_profile(profile_id):
 
 def get_profile_by_name(profile_name):
     """
-    Returns a profile object given a name to search – try to be specific to get better results.
+    Returns a profile object given a name to search – try to be specific to get better results. Where several profiles
+    match, the best ranked match from the cached profile catalogue is returned.
 
     :param profile_name: A string or part of a string that is used as the profile name
     :return: A dictionary of the profile metadata including domain information or an error message
     """
-    all_profiles = get_all_profiles()
-    profile_obj = ''
-    for profile in all_profiles.values():
-        if profile_name.lower() in profile.get('Name').lower():
-            profile_obj = profile
-    if not profile_obj:
+    catalogue = get_profile_catalogue()
+    matches = catalogue.search(profile_name, limit=1, fuzzy=False)
+    if not matches or profile_name.lower() not in catalogue.records[matches[0][1]].get('Name').lower():
         return 'Profile could not be found'
-    else:
-        return profile_obj
+    return catalogue.records[matches[0][1]]
 
 
 def get_profile_by_key(profile_key):
@@ -314,11 +316,10 @@ def get_profile_by_key(profile_key):
     :param profile_key: The exact key for the profile.
     :return: A dictionary of the profile metadata including domain information or an error message
     """
-    all_profiles = get_all_profiles()
-    for profile_id, profile_object in all_profiles.items():
-        if profile_object.get('Key') == profile_key:
-            return profile_object
-    return 'Profile could not be found'
+    profile_object = get_profile_catalogue().get_by_key(profile_key)
+    if profile_object is None:
+        return 'Profile could not be found'
+    return profile_object
 
 
 def get_metadata_for_indicator_as_dataframe(indicator_ids, is_test=False):
@@ -328,107 +329,116 @@ def get_metadata_for_indicator_as_dataframe(indicator_ids, is_test=False):
     :param indicator_ids: Number or list of numbers used to identify an indicator within Fingertips as integer or string
     :return: Dataframe object with metadate for the indicator ID
     """
-    url_suffix = "indicator_metadata/csv/by_indicator_id?indicator_ids={}"
+    url = build_url('indicator_metadata/csv/by_indicator_id', indicator_ids=indicator_ids)
     if isinstance(indicator_ids, list):
         indicator_ids = ','.join(list(map(str, indicator_ids)))
     try:
-        df = pd.read_csv(base_url + url_suffix.format(str(indicator_ids)))
+        df = get_csv_return_df(url)
     except HTTPError:
         raise NameError(f'Indicator {indicator_ids} does not exist')
-    except URLError:
-        df = deal_with_url_error(base_url + url_suffix.format(str(indicator_ids)))
     if is_test:
-        return df, base_url + url_suffix.format(str(indicator_ids))
+        return df, url
     return df
 
 
+def _read_metadata_csv(endpoint, parameter, item_id, item_name):
+    """
+    :param endpoint: Metadata CSV endpoint, eg. 'indicator_metadata/csv/by_group_id'
+    :param parameter: Name of the query parameter holding the ID
+    :param item_id: The ID to request
+    :param item_name: Name of the ID type used in the error message, eg. 'Domain'
+    :return: Dataframe of metadata for the ID
+
+    :meta private:
+    """
+    try:
+        return get_csv_return_df(build_url(endpoint, **{parameter: item_id}))
+    except HTTPError:
+        raise NameError(f'{item_name} {item_id} does not exist')
+
+
+def _read_metadata_csvs(endpoint, parameter, item_ids, item_name):
+    """
+    :param endpoint: Metadata CSV endpoint, eg. 'indicator_metadata/csv/by_group_id'
+    :param parameter: Name of the query parameter holding the ID
+    :param item_ids: A list of IDs to request concurrently
+    :param item_name: Name of the ID type used in the error message, eg. 'Domain'
+    :return: Dataframe of metadata for all the IDs
+
+    :meta private:
+    """
+    frames = map_concurrently(lambda item_id: _read_metadata_csv(endpoint, parameter, item_id, item_name),
+                              id_list(item_ids))
+    if not frames:
+        return pd.DataFrame()
+    with timed('concat_seconds'):
+        return pd.concat(frames)
+
+
 def get_metadata_for_domain_as_dataframe(group_ids, is_test=False):
     """
-    Returns a dataframe of metadata for a given domain ID or list of domain IDs.
+    Returns a dataframe of metadata for a given domain ID or list of domain IDs. A list of domain IDs is requested
+    concurrently.
 
     :param group_ids: Number or list of numbers used to identify a domain within Fingertips as integer or string
     :return: Dataframe object with metadata for the indicators for a given domain ID
     """
-    url_suffix = "indicator_metadata/csv/by_group_id?group_id={}"
+    endpoint = 'indicator_metadata/csv/by_group_id'
     if isinstance(group_ids, list):
-        df = pd.DataFrame()
-        for group_id in group_ids:
-            try:
-                df = pd.concat([df, pd.read_csv(base_url + url_suffix.format(str(group_id)))])
-            except HTTPError:
-                raise NameError(f'Domain {group_id} does not exist')
-            except URLError:
-                df = deal_with_url_error(base_url + url_suffix.format(str(group_id)))
+        df = _read_metadata_csvs(endpoint, 'group_id', group_ids, 'Domain')
     else:
-        try:
-            df = pd.read_csv(base_url + url_suffix.format(str(group_ids)))
-        except HTTPError:
-            raise NameError(f'Domain {group_ids} does not exist')
-        except URLError:
-            df = deal_with_url_error(base_url + url_suffix.format(str(group_ids)))
+        df = _read_metadata_csv(endpoint, 'group_id', group_ids, 'Domain')
     if is_test:
-        return df, base_url + url_suffix.format(str(group_ids))
+        return df, build_url(endpoint, group_id=group_ids)
     return df
 
 
 def get_metadata_for_profile_as_dataframe(profile_ids):
     """
-    Returns a dataframe of metadata for a given profile ID or list of profile IDs.
+    Returns a dataframe of metadata for a given profile ID or list of profile IDs. A list of profile IDs is requested
+    concurrently.
 
     :param profile_ids: ID or list of IDs used in Fingertips to identify a profile as integer or string
     :return: Dataframe object with metadata for the indicators for a given group ID
     """
-    url_suffix = "indicator_metadata/csv/by_profile_id?profile_id={}"
+    endpoint = 'indicator_metadata/csv/by_profile_id'
     if isinstance(profile_ids, list):
-        df = pd.DataFrame()
-        for profile_id in profile_ids:
-            try:
-                df = pd.concat([df, pd.read_csv(base_url + url_suffix.format(str(profile_id)))])
-            except HTTPError:
-                raise NameError(f'Profile {profile_id} does not exist')
-            except URLError:
-                df = deal_with_url_error(base_url + url_suffix.format(str(profile_id)))
-    else:
-        try:
-            df = pd.read_csv(base_url + url_suffix.format(str(profile_ids)))
-        except HTTPError:
-            raise NameError(f'Profile {profile_ids} does not exist')
-        except URLError:
-            df = deal_with_url_error(base_url + url_suffix.format(str(profile_ids)))
-    return df
+        return _read_metadata_csvs(endpoint, 'profile_id', profile_ids, 'Profile')
+    return _read_metadata_csv(endpoint, 'profile_id', profile_ids, 'Profile')
 
 
 def get_metadata(indicator_ids=None, domain_ids=None, profile_ids=None):
     """
     Returns a dataframe object of metadata for a given indicator, domain, and/or profile given the relevant IDs. At
-    least one of these IDs has to be given otherwise an error is raised.
+    least one of these IDs has to be given otherwise an error is raised. All the profile, domain and indicator requests
+    are made concurrently and indicators that appear more than once are only returned once.
 
     :param indicator_ids: [OPTIONAL] Number used to identify an indicator within Fingertips as integer or string
     :param domain_ids: [OPTIONAL] Number used to identify a domain within Fingertips as integer or string
     :param profile_ids: [OPTIONAL] ID used in Fingertips to identify a profile as integer or string
     :return: A dataframe object with metadata for the given IDs or an error if nothing is specified
     """
-    if indicator_ids and domain_ids and profile_ids:
-        df = get_metadata_for_profile_as_dataframe(profile_ids)
-        df = pd.concat([df, get_metadata_for_domain_as_dataframe(domain_ids)])
-        df = pd.concat([df, get_metadata_for_indicator_as_dataframe(indicator_ids)])
-        return df
-    if indicator_ids and domain_ids:
-        df = get_metadata_for_domain_as_dataframe(domain_ids)
-        df = pd.concat([df, get_metadata_for_indicator_as_dataframe(indicator_ids)])
-        return df
-    if indicator_ids and profile_ids:
-        df = get_metadata_for_profile_as_dataframe(profile_ids)
-        df = pd.concat([df, get_metadata_for_profile_as_dataframe(indicator_ids)])
-        return df
-    if domain_ids and profile_ids:
-        df = get_metadata_for_profile_as_dataframe(profile_ids)
-        df = pd.concat([df, get_metadata_for_domain_as_dataframe(domain_ids)])
-        return df
+    planned = []
     if profile_ids:
-        return get_metadata_for_profile_as_dataframe(profile_ids)
+        planned += [('indicator_metadata/csv/by_profile_id', 'profile_id', profile_id, 'Profile')
+                    for profile_id in id_list(profile_ids)]
     if domain_ids:
-        return get_metadata_for_domain_as_dataframe(domain_ids)
+        planned += [('indicator_metadata/csv/by_group_id', 'group_id', domain_id, 'Domain')
+                    for domain_id in id_list(domain_ids)]
     if indicator_ids:
-        return get_metadata_for_indicator_as_dataframe(indicator_ids)
-    raise NameError('Must use a valid indicator IDs, domain IDs or profile IDs')
+        planned.append(('indicator_metadata/csv/by_indicator_id', 'indicator_ids', id_list(indicator_ids),
+                        'Indicator'))
+    if not planned:
+        raise NameError('Must use a valid indicator IDs, domain IDs or profile IDs')
+    frames = map_concurrently(lambda request: _read_metadata_csv(*request), planned)
+    with timed('concat_seconds'):
+        df = pd.concat(frames)
+    if len(frames) > 1:
+        if 'Indicator ID' in df.columns:
+            df = df.drop_duplicates(subset='Indicator ID')
+        else:
+            df = df.drop_duplicates()
+    return df
+
+
+profile_functions(globals())
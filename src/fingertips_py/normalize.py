@@ -0,0 +1,106 @@
+"""
+Bulk decoding of the free text 'Sex', 'Age', 'Value note' and 'Category Type' columns of data frames into the integer
+IDs used by Fingertips. Each column is converted in one vectorised pass: the text is made categorical, only the
+distinct labels are looked up in cached tables from the ages, sexes, value_notes and category_types endpoints, and the
+IDs are spread back to the rows through the category codes. Labels that cannot be mapped are reported rather than
+raising an error.
+"""
+
+
+import warnings
+import threading
+import numpy as np
+import pandas as pd
+from fingertips_py.api_calls import get_json
+from fingertips_py.urls import build_url
+
+
+lookup_columns = {
+    'Sex': ('sexes', ['Name']),
+    'Age': ('ages', ['Name']),
+    'Value note': ('value_notes', ['Text']),
+    'Category Type': ('category_types', ['Name', 'ShortName']),
+}
+
+_lookup_tables = {}
+_lookup_lock = threading.Lock()
+
+
+def _label_key(label):
+    """
+    :param label: A text label
+    :return: The label lower cased with runs of whitespace collapsed, so minor formatting differences still match
+
+    :meta private:
+    """
+    return ' '.join(str(label).split()).lower()
+
+
+def get_lookup_table(column, refresh=False):
+    """
+    Returns the cached table used to decode a column, downloading it on first use.
+
+    :param column: One of 'Sex', 'Age', 'Value note' or 'Category Type'
+    :param refresh: [OPTIONAL] Whether to download the table again. Default False.
+    :return: A dictionary of labels with their Fingertips IDs
+    """
+    if column not in lookup_columns:
+        raise ValueError(f'Column must be one of {", ".join(lookup_columns)}')
+    with _lookup_lock:
+        if not refresh and column in _lookup_tables:
+            return _lookup_tables[column]
+    endpoint, label_fields = lookup_columns[column]
+    table = {}
+    for item in get_json(build_url(endpoint)):
+        for field in label_fields:
+            if item.get(field):
+                table.setdefault(item[field], item['Id'])
+    with _lookup_lock:
+        _lookup_tables[column] = table
+    return table
+
+
+def clear_lookup_cache():
+    """
+    Removes the cached lookup tables so they are downloaded again on next use.
+    """
+    with _lookup_lock:
+        _lookup_tables.clear()
+
+
+def normalize(df, columns=None, lookups=None, warn=True):
+    """
+    Converts text columns to categorical labels with a matching integer ID column, eg. 'Sex' and 'Sex ID'. Missing
+    values stay missing; labels with no ID get a missing ID and are reported in df.attrs['unmapped'] as a dictionary
+    of column names with the count of rows for each unmapped label.
+
+    :param df: A dataframe from one of the all_data endpoints
+    :param columns: [OPTIONAL] List of columns to convert. Defaults to those of 'Sex', 'Age', 'Value note' and
+        'Category Type' in the dataframe.
+    :param lookups: [OPTIONAL] Dictionary of column names with their own dictionary of labels to IDs, used instead of
+        the lookup tables from the API
+    :param warn: [OPTIONAL] Whether to give a warning if any labels could not be mapped. Default True.
+    :return: A copy of the dataframe with the columns converted
+    """
+    if columns is None:
+        columns = [column for column in lookup_columns if column in df.columns]
+    lookups = lookups or {}
+    df = df.copy()
+    unmapped = {}
+    for column in columns:
+        table = lookups[column] if column in lookups else get_lookup_table(column)
+        keyed = {_label_key(label): code for label, code in table.items()}
+        labels = pd.Categorical(df[column])
+        categories = pd.Series(labels.categories)
+        ids = pd.array(categories.map(lambda label: table.get(label, keyed.get(_label_key(label)))), dtype='Int64')
+        df[column] = labels
+        df[column + ' ID'] = ids.take(labels.codes, allow_fill=True)
+        missing = np.flatnonzero(ids.isna())
+        if len(missing):
+            counts = np.bincount(labels.codes[labels.codes >= 0], minlength=len(categories))
+            unmapped[column] = {categories[index]: int(counts[index]) for index in missing}
+    df.attrs['unmapped'] = unmapped
+    if unmapped and warn:
+        summary = '; '.join(f'{column}: {", ".join(map(str, labels))}' for column, labels in unmapped.items())
+        warnings.warn(f'Some labels could not be mapped to IDs ({summary}). See df.attrs["unmapped"].')
+    return df
@@ -0,0 +1,190 @@
+"""
+A multiprocess pipeline for parsing very large CSV downloads (eg. GP or MSOA level data). The response is split into
+line-aligned blocks as it streams in, and each block is parsed and filtered in a worker process. Blocks are passed to
+the workers, and parsed chunks passed back, through shared memory.
+"""
+
+
+import io
+import os
+import pandas as pd
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from fingertips_py.api_calls import _open_cached_csv, text_column_types
+
+
+default_block_size = 8 * 1024 * 1024
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+def split_csv_blocks(stream, block_size=default_block_size):
+    """
+    Splits a binary CSV stream into its header and blocks of whole records. A block is only cut at a newline outside
+    a quoted field, so each block can be parsed on its own.
+
+    :param stream: A binary file-like object of CSV data
+    :param block_size: [OPTIONAL] Approximate number of bytes in each block. Default 8 MB.
+    :return: A tuple of the header line and a generator of blocks as bytes
+    """
+    buffer = b''
+    while b'\n' not in buffer:
+        data = stream.read(block_size)
+        if not data:
+            break
+        buffer += data
+    end_of_header = buffer.find(b'\n') + 1 if b'\n' in buffer else len(buffer)
+    header, buffer = buffer[:end_of_header], buffer[end_of_header:]
+
+    def blocks(buffer):
+        while True:
+            data = stream.read(block_size)
+            if not data:
+                if buffer:
+                    yield buffer
+                return
+            buffer += data
+            cut = buffer.rfind(b'\n')
+            while cut > 0 and buffer.count(b'"', 0, cut) % 2:
+                cut = buffer.rfind(b'\n', 0, cut)
+            if cut > 0:
+                yield buffer[:cut + 1]
+                buffer = buffer[cut + 1:]
+
+    return header, blocks(buffer)
+
+
+def _to_shared_memory(data):
+    """
+    :param data: A bytes-like object
+    :return: A tuple of the name and size of a new shared memory block holding the data
+
+    :meta private:
+    """
+    block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    block.buf[:len(data)] = memoryview(data).cast('B')
+    name = block.name
+    block.close()
+    return name, len(data)
+
+
+def _parse_block(name, size, header, filter_by_area_codes):
+    """
+    Parses a block of CSV records in a worker process. Text columns are read as strings, so every block has the
+    same column types whatever values it happens to hold.
+
+    :param name: Name of the shared memory block holding the records
+    :param size: Number of bytes of records in the shared memory block
+    :param header: The CSV header line as bytes
+    :param filter_by_area_codes: List of area codes to keep, or None
+    :return: A tuple of ('arrow', name, size) of an Arrow IPC stream in shared memory, or ('pandas', dataframe)
+
+    :meta private:
+    """
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        df = pd.read_csv(io.BytesIO(header + bytes(block.buf[:size])), dtype=text_column_types)
+    finally:
+        block.close()
+    if filter_by_area_codes:
+        df = df.loc[df['Area Code'].isin(filter_by_area_codes)]
+    if pyarrow is None:
+        return 'pandas', df
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    result_name, result_size = _to_shared_memory(sink.getvalue())
+    return ('arrow', result_name, result_size)
+
+
+def _collect(result):
+    """
+    :param result: A result returned by _parse_block
+    :return: The parsed dataframe, releasing any shared memory
+
+    :meta private:
+    """
+    if result[0] == 'pandas':
+        return result[1]
+    block = shared_memory.SharedMemory(name=result[1])
+    try:
+        df = pyarrow.ipc.open_stream(pyarrow.py_buffer(bytes(block.buf[:result[2]]))).read_all().to_pandas()
+    finally:
+        block.close()
+        block.unlink()
+    return df
+
+
+def parse_csv_parallel(url, processes=None, filter_by_area_codes=None, block_size=default_block_size,
+                       executor=None):
+    """
+    Downloads a CSV and parses it with a pool of worker processes while it streams in. If a cache has been set with
+    set_cache, the CSV is read from the cache, or downloaded and cached whole before it is parsed.
+
+    :param url: A url that returns a CSV
+    :param processes: [OPTIONAL] Number of worker processes. Defaults to the number of CPUs.
+    :param filter_by_area_codes: [OPTIONAL] Area code or list of area codes to keep, filtered in the workers
+    :param block_size: [OPTIONAL] Approximate number of bytes parsed by each task. Default 8 MB.
+    :param executor: [OPTIONAL] An existing ProcessPoolExecutor to use instead of starting one
+    :return: A dataframe of the CSV
+    """
+    if isinstance(filter_by_area_codes, str):
+        filter_by_area_codes = [filter_by_area_codes]
+    processes = processes or os.cpu_count() or 1
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=processes)
+    pending = []
+    frames = []
+    try:
+        with _open_cached_csv(url) as stream:
+            header, blocks = split_csv_blocks(stream, block_size)
+            for block in blocks:
+                name, size = _to_shared_memory(block)
+                pending.append((name, executor.submit(_parse_block, name, size, header, filter_by_area_codes)))
+                while len(pending) > 2 * processes:
+                    frames.append(_finish(*pending.pop(0)))
+        while pending:
+            frames.append(_finish(*pending.pop(0)))
+    finally:
+        for name, future in pending:
+            if not future.cancel() and future.exception() is None and future.result()[0] == 'arrow':
+                _unlink(future.result()[1])
+            _unlink(name)
+        if own_executor:
+            executor.shutdown()
+    if not frames:
+        return pd.read_csv(io.BytesIO(header), dtype=text_column_types)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _finish(name, future):
+    """
+    :param name: Name of the shared memory block holding the input records
+    :param future: The future of the _parse_block task
+    :return: The parsed dataframe
+
+    :meta private:
+    """
+    try:
+        return _collect(future.result())
+    finally:
+        _unlink(name)
+
+
+def _unlink(name):
+    """
+    :param name: Name of a shared memory block to release
+
+    :meta private:
+    """
+    try:
+        block = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
@@ -0,0 +1,163 @@
+"""
+A query planner that turns a description of the data wanted (indicators x area types x optional profile x optional
+area codes) into the fewest, smallest downloads from the Fingertips all_data endpoints.
+"""
+
+
+import threading
+import pandas as pd
+from collections import namedtuple
+from fingertips_py.api_calls import get_csv_return_df, map_concurrently, make_request, _empty_data_frame
+from fingertips_py.availability import get_availability_matrix, get_profile_indicators, clear_availability_cache
+from fingertips_py.urls import build_url
+
+
+PlannedCall = namedtuple('PlannedCall', ['endpoint', 'area_type_id', 'indicator_ids', 'url', 'estimated_rows'])
+
+_planner_cache = {}
+_planner_cache_lock = threading.Lock()
+
+
+def _cached(key, loader):
+    """
+    :param key: Key of the value in the planner cache
+    :param loader: A function that returns the value if it is not cached
+    :return: The cached value
+
+    :meta private:
+    """
+    if key not in _planner_cache:
+        value = loader()
+        with _planner_cache_lock:
+            _planner_cache.setdefault(key, value)
+    return _planner_cache[key]
+
+
+def clear_planner_cache():
+    """
+    Removes the availability, metadata and area codes cached by the query planner.
+    """
+    with _planner_cache_lock:
+        _planner_cache.clear()
+    clear_availability_cache()
+
+
+def _get_area_codes(area_type_id):
+    """
+    :param area_type_id: ID of area type used in Fingertips
+    :return: A set of the area codes within the area type
+
+    :meta private:
+    """
+    return _cached(('areas', int(area_type_id)),
+                   lambda: set(make_request(build_url('areas/by_area_type', area_type_id=area_type_id), 'Code')))
+
+
+class QueryPlanner:
+    """
+    Plans and runs a data request. The planner uses cached availability and metadata to skip area types without data,
+    combines indicators into one call per area type and uses the profile endpoint when it returns the same rows.
+
+    :param area_type_ids: ID or list of IDs of area types used in Fingertips
+    :param indicator_ids: [OPTIONAL] ID or list of IDs of indicators. Defaults to all indicators in the profile.
+    :param profile_id: [OPTIONAL] ID of profile to select by. Required if indicator_ids is not given.
+    :param area_codes: [OPTIONAL] Area code or list of area codes to limit the returned data to
+    :param parent_area_type_id: [OPTIONAL] Area type of parent area - defaults to England value
+    :param max_indicators_per_call: [OPTIONAL] Maximum number of indicators requested in one call. Default 100.
+    """
+
+    def __init__(self, area_type_ids, indicator_ids=None, profile_id=None, area_codes=None, parent_area_type_id=15,
+                 max_indicators_per_call=100):
+        if indicator_ids is None and profile_id is None:
+            raise NameError('Must use valid indicator IDs or a profile ID')
+        if not isinstance(area_type_ids, list):
+            area_type_ids = [area_type_ids]
+        if indicator_ids is not None and not isinstance(indicator_ids, list):
+            indicator_ids = [indicator_ids]
+        if isinstance(area_codes, str):
+            area_codes = [area_codes]
+        self.area_type_ids = list(dict.fromkeys(int(area_type_id) for area_type_id in area_type_ids))
+        self.indicator_ids = None if indicator_ids is None else sorted(set(int(ind) for ind in indicator_ids))
+        self.profile_id = profile_id
+        self.area_codes = area_codes
+        self.parent_area_type_id = parent_area_type_id
+        self.max_indicators_per_call = max_indicators_per_call
+        self._plan = None
+
+    def _area_type_needed(self, area_type_id):
+        """
+        :param area_type_id: ID of area type used in Fingertips
+        :return: False if none of the requested area codes can appear in the data for the area type
+
+        :meta private:
+        """
+        if not self.area_codes:
+            return True
+        candidate_codes = _get_area_codes(area_type_id) | _get_area_codes(self.parent_area_type_id)
+        return any(code in candidate_codes for code in self.area_codes)
+
+    def plan(self):
+        """
+        :return: A list of PlannedCall tuples describing each download that will be made
+        """
+        if self._plan is not None:
+            return self._plan
+        matrix = get_availability_matrix()
+        profile_indicators = None if self.profile_id is None else get_profile_indicators(self.profile_id)
+        planned = []
+        for area_type_id in self.area_type_ids:
+            if profile_indicators is not None:
+                available = set(matrix.available_indicators(list(profile_indicators), area_type_id))
+            else:
+                available = set(matrix.available_indicators(self.indicator_ids, area_type_id))
+            wanted = available if self.indicator_ids is None else available & set(self.indicator_ids)
+            if not wanted or not self._area_type_needed(area_type_id):
+                continue
+            area_count = len(_get_area_codes(area_type_id))
+            if profile_indicators is not None and wanted == available:
+                url = build_url('all_data/csv/by_profile_id', child_area_type_id=area_type_id,
+                                parent_area_type_id=self.parent_area_type_id, profile_id=self.profile_id)
+                planned.append(PlannedCall('by_profile_id', area_type_id, sorted(wanted), url,
+                                           len(wanted) * (area_count + 1)))
+                continue
+            wanted = sorted(wanted)
+            for start in range(0, len(wanted), self.max_indicators_per_call):
+                chunk = wanted[start:start + self.max_indicators_per_call]
+                url = build_url('all_data/csv/by_indicator_id', indicator_ids=chunk, child_area_type_id=area_type_id,
+                                parent_area_type_id=self.parent_area_type_id, profile_id=self.profile_id)
+                planned.append(PlannedCall('by_indicator_id', area_type_id, chunk, url, len(chunk) * (area_count + 1)))
+        self._plan = planned
+        return planned
+
+    def explain(self):
+        """
+        Describes the planned downloads. Estimated rows are the number of indicators multiplied by the number of areas
+        (plus the parent) for a single time period and category, so are a lower bound.
+
+        :return: A string with one line per planned call and a total
+        """
+        planned = self.plan()
+        lines = []
+        for number, call in enumerate(planned, 1):
+            lines.append(f'{number}. {call.endpoint} area_type_id={call.area_type_id} '
+                         f'indicators={len(call.indicator_ids)} estimated_rows={call.estimated_rows}\n   {call.url}')
+        lines.append(f'{len(planned)} calls, estimated rows {sum(call.estimated_rows for call in planned)}')
+        return '\n'.join(lines)
+
+    def execute(self, workers=None):
+        """
+        Runs the planned downloads concurrently and merges them into one dataframe.
+
+        :param workers: [OPTIONAL] Maximum number of concurrent downloads. Defaults to api_calls.max_workers.
+        :return: A dataframe of data for the request with duplicate rows and unrequested areas and indicators removed
+        """
+        planned = self.plan()
+        frames = map_concurrently(lambda call: get_csv_return_df(call.url), planned, workers)
+        if not frames:
+            return _empty_data_frame()
+        df = pd.concat(frames, ignore_index=True)
+        if self.indicator_ids is not None and 'Indicator ID' in df.columns:
+            df = df.loc[df['Indicator ID'].isin(self.indicator_ids)]
+        if self.area_codes:
+            df = df.loc[df['Area Code'].isin(self.area_codes)]
+        return df.drop_duplicates().reset_index(drop=True)
@@ -0,0 +1,218 @@
+"""
+A profiling session that attributes the cost of a piece of work to the public functions of retrieve_data, metadata and
+area_data that caused it. For each function it counts the calls, the wall time, the HTTP requests with the seconds
+spent waiting for them and the bytes received, the seconds spent parsing responses and concatenating dataframes, and
+the peak memory allocated during a call. Costs are attributed to the outermost public function, the one that was
+called by the user, so a call to get_all_data_for_profile includes the metadata it looks up. Costs incurred outside any
+public function, eg. by calling get_json directly, are reported as '<unattributed>'.
+
+The session is held in a context variable, so it follows work into the threads of FingertipsClient.map_concurrently and
+the autotuned downloads, and sessions in different threads or asyncio tasks do not see each other's calls::
+
+    with fingertips_py.profile() as session:
+        fingertips_py.get_all_data_for_profile(19)
+    print(session.report())
+    session.to_json('fingertips_profile.json')
+
+Parse time of a streamed CSV includes receiving its body, as the two overlap. Peak memory is measured with
+tracemalloc, which slows Python code down, and is shared by calls running at the same time in different threads. It
+needs Python 3.9 or later and is reported as 0 on earlier versions.
+"""
+
+
+import json
+import time
+import functools
+import threading
+import contextlib
+import contextvars
+import tracemalloc
+import pandas as pd
+
+
+unattributed = '<unattributed>'
+
+cost_names = ['calls', 'seconds', 'requests', 'network_seconds', 'bytes_received', 'parse_seconds',
+              'concat_seconds', 'peak_memory']
+
+_session = contextvars.ContextVar('fingertips_py_profile_session', default=None)
+_call = contextvars.ContextVar('fingertips_py_profile_call', default=None)
+
+
+class ProfileSession:
+    """
+    The costs recorded by profile(), by public function.
+
+    :param trace_memory: [OPTIONAL] Whether to measure the peak memory of each call with tracemalloc. Default True.
+    """
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.costs = {}
+        self.started = time.time()
+        self.seconds = None
+        self._lock = threading.Lock()
+
+    def add(self, function, **costs):
+        """
+        Adds to the costs of a function. peak_memory keeps the largest value given, other costs are summed.
+
+        :param function: Name of the function, eg. 'retrieve_data.get_data_by_indicator_ids'
+        :param costs: Amounts to add, eg. requests=1
+
+        :meta private:
+        """
+        with self._lock:
+            totals = self.costs.setdefault(function, dict.fromkeys(cost_names, 0))
+            for name, value in costs.items():
+                totals[name] = max(totals[name], value) if name == 'peak_memory' else totals[name] + value
+
+    def to_frame(self, sort_by='seconds'):
+        """
+        :param sort_by: [OPTIONAL] Cost to sort by, largest first. One of calls, seconds, requests, network_seconds,
+            bytes_received, parse_seconds, concat_seconds or peak_memory. Default seconds.
+        :return: A dataframe of the costs with a row per function
+        """
+        if sort_by not in cost_names:
+            raise ValueError(f'sort_by must be one of {", ".join(cost_names)}')
+        with self._lock:
+            rows = [dict(function=function, **totals) for function, totals in self.costs.items()]
+        df = pd.DataFrame(rows, columns=['function'] + cost_names)
+        return df.sort_values([sort_by, 'function'], ascending=[False, True], ignore_index=True)
+
+    def report(self, sort_by='seconds'):
+        """
+        :param sort_by: [OPTIONAL] Cost to sort by, largest first. Default seconds.
+        :return: The costs as a text table, for reading or attaching to a ticket
+        """
+        df = self.to_frame(sort_by)
+        if df.empty:
+            return 'No calls were profiled.'
+        df['bytes_received'] = df['bytes_received'].map(_format_bytes)
+        df['peak_memory'] = df['peak_memory'].map(_format_bytes)
+        for column in ['seconds', 'network_seconds', 'parse_seconds', 'concat_seconds']:
+            df[column] = df[column].map('{:.3f}'.format)
+        seconds = f' over {self.seconds:.3f} seconds' if self.seconds is not None else ''
+        return f'fingertips_py profile{seconds}, sorted by {sort_by}\n' + df.to_string(index=False)
+
+    def to_json(self, path=None, sort_by='seconds'):
+        """
+        :param path: [OPTIONAL] File to write the report to
+        :param sort_by: [OPTIONAL] Cost to sort by, largest first. Default seconds.
+        :return: The costs as a JSON string, with the start time and duration of the session
+        """
+        report = json.dumps({'started': self.started, 'seconds': self.seconds, 'sort_by': sort_by,
+                             'functions': self.to_frame(sort_by).to_dict(orient='records')}, indent=2)
+        if path is not None:
+            with open(path, 'w', encoding='utf-8') as report_file:
+                report_file.write(report)
+        return report
+
+
+def _format_bytes(size):
+    """
+    :return: A number of bytes as text with a unit, eg. '1.5 MB'
+
+    :meta private:
+    """
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024 or unit == 'GB':
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+
+
+@contextlib.contextmanager
+def profile(trace_memory=True):
+    """
+    Records the cost of the fingertips_py calls made within it.
+
+    :param trace_memory: [OPTIONAL] Whether to measure peak memory with tracemalloc. Default True.
+    :return: A ProfileSession, whose report is complete once the block has finished
+    """
+    session = ProfileSession(trace_memory)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    token = _session.set(session)
+    start = time.perf_counter()
+    try:
+        yield session
+    finally:
+        session.seconds = time.perf_counter() - start
+        _session.reset(token)
+        if started_tracing:
+            tracemalloc.stop()
+
+
+def record_cost(**costs):
+    """
+    Adds costs to the function being profiled, if a profiling session is active.
+
+    :param costs: Amounts to add, eg. requests=1, network_seconds=0.2
+
+    :meta private:
+    """
+    session = _session.get()
+    if session is not None:
+        session.add(_call.get() or unattributed, **costs)
+
+
+@contextlib.contextmanager
+def timed(cost):
+    """
+    Adds the seconds spent in the block to a cost of the function being profiled.
+
+    :param cost: Name of the cost, eg. 'parse_seconds'
+
+    :meta private:
+    """
+    if _session.get() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_cost(**{cost: time.perf_counter() - start})
+
+
+def _profiled(function, name):
+    """
+    :return: A function that records the costs of calls to function when it is the outermost public call of a session
+
+    :meta private:
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        session = _session.get()
+        if session is None or _call.get() is not None:
+            return function(*args, **kwargs)
+        token = _call.set(name)
+        tracing = session.trace_memory and tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')
+        if tracing:
+            tracemalloc.reset_peak()
+            memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            peak = tracemalloc.get_traced_memory()[1] - memory if tracing and tracemalloc.is_tracing() else 0
+            session.add(name, calls=1, seconds=time.perf_counter() - start, peak_memory=peak)
+            _call.reset(token)
+    return wrapper
+
+
+def profile_functions(namespace):
+    """
+    Wraps the public functions defined in a module so profiling sessions can attribute costs to them. Called at the
+    end of retrieve_data, metadata and area_data.
+
+    :param namespace: The globals() of the module
+
+    :meta private:
+    """
+    module = namespace['__name__']
+    for name, value in list(namespace.items()):
+        if callable(value) and not name.startswith('_') and getattr(value, '__module__', None) == module \
+                and not isinstance(value, type):
+            namespace[name] = _profiled(value, f'{module.rsplit(".", 1)[-1]}.{name}')
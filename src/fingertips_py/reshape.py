@@ -0,0 +1,143 @@
+"""
+Functions to reshape the long dataframes returned by the retrieve_data functions into labelled NumPy arrays with one
+axis per dimension (eg. area x indicator x sex x age x time period) without using pivot_table.
+"""
+
+
+import numpy as np
+import pandas as pd
+
+
+default_dims = ['Area Code', 'Indicator ID', 'Sex', 'Age', 'Time period']
+
+
+class DataCube:
+    """
+    A labelled array of Fingertips data, similar to an xarray DataArray. Each dimension has an index of labels and
+    the values are held either densely as a NumPy array or sparsely as integer codes with a value per populated cell.
+
+    :param dims: List of dimension names (the column names the cube was built from)
+    :param coords: Dictionary of dimension name to a pandas Index of labels
+    :param values: Dense NumPy array, or 1-D array of populated values if codes is given
+    :param codes: [OPTIONAL] For a sparse cube, a 2-D integer array with one row per dimension and one column per value
+    :param fill_value: [OPTIONAL] Value of cells without data. Default NaN.
+    """
+
+    def __init__(self, dims, coords, values, codes=None, fill_value=np.nan):
+        self.dims = list(dims)
+        self.coords = coords
+        self.values = values
+        self.codes = codes
+        self.fill_value = fill_value
+
+    @property
+    def shape(self):
+        return tuple(len(self.coords[dim]) for dim in self.dims)
+
+    @property
+    def is_sparse(self):
+        return self.codes is not None
+
+    def __repr__(self):
+        kind = 'sparse' if self.is_sparse else 'dense'
+        sizes = ', '.join(f'{dim}: {size}' for dim, size in zip(self.dims, self.shape))
+        return f'<DataCube ({kind}) {sizes}>'
+
+    def to_dense(self):
+        """
+        :return: A dense DataCube with the same labels
+        """
+        if not self.is_sparse:
+            return self
+        dense = np.full(self.shape, self.fill_value, dtype=self.values.dtype)
+        dense[tuple(self.codes)] = self.values
+        return DataCube(self.dims, self.coords, dense, fill_value=self.fill_value)
+
+    def sel(self, selection=None, **labels):
+        """
+        Selects a single label along one or more dimensions, removing those dimensions.
+
+        :param selection: [OPTIONAL] Dictionary of dimension name to label, for dimension names with spaces
+        :param labels: Dimension names and labels as keyword arguments
+        :return: A DataCube of the remaining dimensions, or a single value if every dimension is selected
+        """
+        selection = dict(selection or {}, **labels)
+        cube = self.to_dense()
+        indexer = []
+        for dim in cube.dims:
+            if dim in selection:
+                indexer.append(cube.coords[dim].get_loc(selection[dim]))
+            else:
+                indexer.append(slice(None))
+        values = cube.values[tuple(indexer)]
+        remaining = [dim for dim in cube.dims if dim not in selection]
+        if not remaining:
+            return values
+        return DataCube(remaining, {dim: cube.coords[dim] for dim in remaining}, values, fill_value=self.fill_value)
+
+    def to_frame(self, name='Value'):
+        """
+        :param name: [OPTIONAL] Name of the value column. Default 'Value'.
+        :return: A long dataframe with one column per dimension and a value column, excluding empty cells
+        """
+        if self.is_sparse:
+            codes, values = self.codes, self.values
+        else:
+            if np.isnan(self.fill_value):
+                populated = ~np.isnan(self.values)
+            else:
+                populated = self.values != self.fill_value
+            codes = np.nonzero(populated)
+            values = self.values[populated]
+        data = {dim: self.coords[dim].take(codes[axis]) for axis, dim in enumerate(self.dims)}
+        data[name] = values
+        return pd.DataFrame(data)
+
+
+def to_cube(df, value='Value', dims=None, sparse=False, fill_value=np.nan):
+    """
+    Converts a long dataframe from the retrieve_data functions into a DataCube in one pass. Each dimension column is
+    factorized into integer codes and the values are written straight into a NumPy array. Time periods are ordered by
+    'Time period Sortable' when it is present, then by label, so periods sharing a sortable value stay distinct.
+    Unless 'Category' is one of the dims, rows for category breakdowns (eg. deprivation deciles) are excluded so that
+    each cell holds a single value.
+
+    :param df: A dataframe as returned by get_all_data_for_profile or get_data_by_indicator_ids
+    :param value: [OPTIONAL] Column of values to put in the cube. Default 'Value'.
+    :param dims: [OPTIONAL] List of columns to use as dimensions. Default area code, indicator, sex, age and time period.
+    :param sparse: [OPTIONAL] Whether to store only the populated cells. Useful for GP level data. Default False.
+    :param fill_value: [OPTIONAL] Value of cells without data. Default NaN.
+    :return: A DataCube of the values
+    """
+    dims = list(dims or default_dims)
+    if 'Category' not in dims and 'Category Type' in df.columns:
+        df = df.loc[df['Category Type'].isna()]
+    coords = {}
+    codes = []
+    for dim in dims:
+        if dim == 'Time period' and 'Time period Sortable' in df.columns:
+            if df[[dim, 'Time period Sortable']].isna().any(axis=None):
+                raise ValueError(f'The {dim} column contains missing values')
+            pair_codes, pairs = pd.factorize(pd.MultiIndex.from_arrays([df['Time period Sortable'], df[dim]]))
+            order = np.lexsort((pairs.get_level_values(1).astype(str), pairs.get_level_values(0)))
+            ranks = np.empty(len(order), dtype=np.intp)
+            ranks[order] = np.arange(len(order))
+            dim_codes, dim_labels = ranks[pair_codes], pd.Index(pairs.get_level_values(1)[order], name=dim)
+        else:
+            dim_codes, dim_labels = pd.factorize(df[dim], sort=True)
+            dim_labels = pd.Index(dim_labels, name=dim)
+        if (dim_codes < 0).any():
+            raise ValueError(f'The {dim} column contains missing values')
+        coords[dim] = dim_labels
+        codes.append(dim_codes)
+    codes = np.vstack(codes) if codes else np.empty((0, len(df)), dtype=np.intp)
+    shape = tuple(len(coords[dim]) for dim in dims)
+    flat = np.ravel_multi_index(tuple(codes), shape) if len(df) else np.empty(0, dtype=np.intp)
+    if len(np.unique(flat)) != len(flat):
+        raise ValueError('More than one row maps to the same cell, add another column to dims or filter the data')
+    values = df[value].to_numpy(dtype=float)
+    if sparse:
+        return DataCube(dims, coords, values, codes=codes, fill_value=fill_value)
+    cube = np.full(shape, fill_value, dtype=float)
+    cube.reshape(-1)[flat] = values
+    return DataCube(dims, coords, cube, fill_value=fill_value)
@@ -4,13 +4,37 @@ A group of functions to retrieve data from Fingertips by indicator, profile, dom
 
 
 import pandas as pd
-from urllib.error import URLError, HTTPError
-from fingertips_py.api_calls import base_url, deal_with_url_error, get_json
+from urllib.error import HTTPError
+from concurrent.futures import ProcessPoolExecutor
+from fingertips_py.api_calls import get_csv_return_df, get_json, _empty_data_frame
+from fingertips_py.urls import build_url
 from fingertips_py.metadata import get_area_type_ids_for_profile, get_metadata_for_all_indicators, get_all_areas
+from fingertips_py.export import profile_download_job
+from fingertips_py.parallel import parse_csv_parallel
+from fingertips_py.store import get_stored_dataset
+from fingertips_py.incremental import fetch_since
+from fingertips_py.availability import filter_indicators, filter_profile_area_types
+from fingertips_py.autotune import get_tuner, run_tuned, read_csv_with_size
+from fingertips_py.profiling import timed, profile_functions
+
+
+def _read_data_csv(url, use_dataset_store=False, dataset_max_age=None):
+    """
+    :param url: A url that returns a CSV of data
+    :param use_dataset_store: Whether to read the data through the memory mapped dataset store
+    :param dataset_max_age: Maximum age in seconds of a stored dataset before it is downloaded again
+    :return: A dataframe of the data
+
+    :meta private:
+    """
+    if use_dataset_store:
+        return get_stored_dataset(url, max_age=dataset_max_age)
+    return get_csv_return_df(url)
 
 
 def get_data_by_indicator_ids(indicator_ids, area_type_id, parent_area_type_id=15, profile_id=None,
-                              include_sortable_time_periods=None, is_test=False):
+                              include_sortable_time_periods=None, use_dataset_store=False, dataset_max_age=None,
+                              since=False, autotune=False, is_test=False):
     """
     Returns a dataframe of indicator data given a list of indicators and area types.
     :param indicator_ids: Single indicator ID or list of indicator IDs, as integers or strings
@@ -18,39 +42,43 @@ def get_data_by_indicator_ids(indicator_ids, area_type_id, parent_area_type_id=1
     :param parent_area_type_id: Area type of parent area - defaults to England value
     :param profile_id: ID of profile to select by as either int or string
     :param include_sortable_time_periods: Boolean as to whether to include a sort-friendly data field
+    :param use_dataset_store: Option to keep the download in the local Arrow dataset store and return a memory mapped,
+        Arrow backed dataframe from it. Requires pyarrow.
+    :param dataset_max_age: Option to download a stored dataset again once it is older than this many seconds. 0
+        always downloads it again. Defaults to keeping stored datasets until clear_dataset_store is called.
+    :param since: Option to only return the time periods published since the last call with since=True. The new rows
+        are appended to the local incremental store (see fingertips_py.incremental) and include sortable time periods.
+    :param autotune: Option to split the indicators into chunks downloaded concurrently, with the chunk size and
+        number of concurrent requests adjusted to the area type and server load (see fingertips_py.autotune). Not
+        used with use_dataset_store or since.
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
-    :return: A dataframe of data relating to the given indicators
+    :return: A dataframe of data relating to the given indicators. Indicators known to have no data for the area type
+        are not requested. If none of them have data, a dataframe with the usual columns and no rows is returned.
     """
-
-    url_suffix = 'all_data/csv/by_indicator_id?indicator_ids={}&child_area_type_id={}&parent_area_type_id={}'
-    if profile_id and not include_sortable_time_periods:
-        url_addition = f'&profile_id={profile_id}'
-        url_suffix = url_suffix + url_addition
-    elif include_sortable_time_periods and not profile_id:
-        url_addition = '&include_sortable_time_periods=yes'
-        url_suffix = url_suffix + url_addition
-    elif profile_id and include_sortable_time_periods:
-        url_addition = f'&profile_id={profile_id}&include_sortable_time_periods=yes'
-        url_suffix = url_suffix + url_addition
-    if isinstance(indicator_ids, list):
-        if any(isinstance(ind, int) for ind in indicator_ids):
-            indicator_ids = ','.join(str(ind) for ind in indicator_ids)
-        else:
-            indicator_ids = ','.join(indicator_ids)
+    available = filter_indicators(indicator_ids, area_type_id)
+    url = build_url('all_data/csv/by_indicator_id', indicator_ids=available or indicator_ids,
+                    child_area_type_id=area_type_id, parent_area_type_id=parent_area_type_id,
+                    profile_id=profile_id or None,
+                    include_sortable_time_periods=True if include_sortable_time_periods or since else None)
+    if not available:
+        df = _empty_data_frame()
+    elif since:
+        df = fetch_since(url, area_type_id, parent_area_type_id)
+    elif autotune and not use_dataset_store:
+        df = run_tuned(get_tuner(area_type_id), available, lambda chunk: read_csv_with_size(
+            build_url('all_data/csv/by_indicator_id', indicator_ids=chunk, child_area_type_id=area_type_id,
+                      parent_area_type_id=parent_area_type_id, profile_id=profile_id or None,
+                      include_sortable_time_periods=True if include_sortable_time_periods else None)))
     else:
-        indicator_ids = str(indicator_ids)
-    populated_url = url_suffix.format(indicator_ids, str(area_type_id), parent_area_type_id)
-    try:
-        df = pd.read_csv(base_url + populated_url)
-    except URLError:
-        df = deal_with_url_error(base_url + populated_url)
+        df = _read_data_csv(url, use_dataset_store, dataset_max_age)
     if is_test:
-        return df, base_url + populated_url
+        return df, url
     return df
 
 
 def get_all_data_for_profile(profile_id, parent_area_type_id=15, area_type_id = None, filter_by_area_codes=None,
-                             is_test=False):
+                             checkpoint_dir=None, processes=None, use_dataset_store=False, dataset_max_age=None,
+                             since=False, autotune=False, is_test=False):
     """
     Returns a dataframe of data for all indicators within a profile.
 
@@ -58,8 +86,24 @@ def get_all_data_for_profile(profile_id, parent_area_type_id=15, area_type_id =
     :param parent_area_type_id: Area type of parent area - defaults to England value
     :param area_type_id: Option to only return data for a given area type. Area type ids are string, int or a list.
     :param filter_by_area_codes: Option to limit returned data to areas. Areas as either string or list of strings.
+    :param checkpoint_dir: Option to save each area type to this directory as it is downloaded. If the download is
+        interrupted, calling the function again with the same directory only downloads the missing area types.
+    :param processes: Option to parse and filter each download with this many worker processes. Useful for large area
+        types such as GP practices and MSOAs. Not used with checkpoint_dir. Takes precedence over use_dataset_store.
+    :param use_dataset_store: Option to keep the download in the local Arrow dataset store and return a memory mapped,
+        Arrow backed dataframe from it. Requires pyarrow. Not used with processes.
+    :param dataset_max_age: Option to download a stored dataset again once it is older than this many seconds. 0
+        always downloads it again. Defaults to keeping stored datasets until clear_dataset_store is called.
+    :param since: Option to only return the time periods published since the last call with since=True. The new rows
+        are appended to the local incremental store (see fingertips_py.incremental). checkpoint_dir and processes are
+        ignored when since is True.
+    :param autotune: Option to download the area types concurrently, with the number of concurrent requests adjusted
+        to the server load (see fingertips_py.autotune). Not used with checkpoint_dir, processes, use_dataset_store or
+        since.
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
-    :return: A dataframe of data for all indicators within a profile with any filters applied
+    :return: A dataframe of data for all indicators within a profile with any filters applied. Area types without
+        data for any indicator in the profile are not requested. If none of them have data, a dataframe with the usual
+        columns and no rows is returned.
     """
     if area_type_id is not None:
         if type(area_type_id) == int:
@@ -68,29 +112,62 @@ def get_all_data_for_profile(profile_id, parent_area_type_id=15, area_type_id =
             area_types = area_type_id
     else:
         area_types = get_area_type_ids_for_profile(profile_id)
-    df = pd.DataFrame()
-    for area in area_types:
-        populated_url = f'all_data/csv/by_profile_id?child_area_type_id={area}\
-            &parent_area_type_id={parent_area_type_id}&profile_id={profile_id}'
+    area_types = filter_profile_area_types(profile_id, area_types)
+    url = None
+    if not area_types:
+        df = _empty_data_frame()
+    elif checkpoint_dir is not None and not since:
+        job = profile_download_job(checkpoint_dir, profile_id, parent_area_type_id, area_types)
+        job.run()
+        df = job.load()
+        url = job.units[-1].url
+    elif autotune and not (processes or use_dataset_store or since):
+        def profile_url(area):
+            return build_url('all_data/csv/by_profile_id', child_area_type_id=area,
+                             parent_area_type_id=parent_area_type_id, profile_id=profile_id)
+
+        area_types = list(dict.fromkeys(area_types))
         try:
-            df_returned = pd.read_csv(base_url + populated_url)
+            df = run_tuned(get_tuner(None), area_types, lambda areas: read_csv_with_size(profile_url(areas[0])),
+                           chunked=False)
         except HTTPError:
             raise Exception('There has been a server error with Fingertips for this request. ')
-        except URLError:
-            df_returned = deal_with_url_error(base_url + populated_url)
-        df = pd.concat([df, df_returned])
-    if filter_by_area_codes:
+        url = profile_url(area_types[-1])
+    else:
+        df = pd.DataFrame()
+        executor = ProcessPoolExecutor(max_workers=processes) if processes and not since else None
+        try:
+            for area in dict.fromkeys(area_types):
+                url = build_url('all_data/csv/by_profile_id', child_area_type_id=area,
+                                parent_area_type_id=parent_area_type_id, profile_id=profile_id,
+                                include_sortable_time_periods=True if since else None)
+                try:
+                    if since:
+                        df_returned = fetch_since(url, area, parent_area_type_id)
+                    elif executor is not None:
+                        df_returned = parse_csv_parallel(url, processes, filter_by_area_codes,
+                                                         executor=executor)
+                    else:
+                        df_returned = _read_data_csv(url, use_dataset_store, dataset_max_age)
+                except HTTPError:
+                    raise Exception('There has been a server error with Fingertips for this request. ')
+                with timed('concat_seconds'):
+                    df = pd.concat([df, df_returned])
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    if filter_by_area_codes and not df.empty:
         if isinstance(filter_by_area_codes, list):
             df = df.loc[df['Area Code'].isin(filter_by_area_codes)]
         elif isinstance(filter_by_area_codes, str):
             df = df.loc[df['Area Code'] == filter_by_area_codes]
         df = df.reset_index()
     if is_test:
-        return df, base_url + populated_url
+        return df, url
     return df
 
 def get_all_data_for_indicators(indicators, area_type_id, parent_area_type_id=15, filter_by_area_codes=None,
-                                is_test=False):
+                                use_dataset_store=False, dataset_max_age=None, is_test=False):
     """
     Returns a dataframe of data for given indicators at an area.
 
@@ -98,32 +175,27 @@ def get_all_data_for_indicators(indicators, area_type_id, parent_area_type_id=15
     :param area_type_id: ID of area type (eg. ID of General Practice is 7 etc) used in Fingertips as integer or string
     :param parent_area_type_id: Area type of parent area - defaults to England value
     :param filter_by_area_codes: Option to limit returned data to areas. Areas as either string or list of strings
+    :param use_dataset_store: Option to keep the download in the local Arrow dataset store and return a memory mapped,
+        Arrow backed dataframe from it. Requires pyarrow.
+    :param dataset_max_age: Option to download a stored dataset again once it is older than this many seconds. 0
+        always downloads it again. Defaults to keeping stored datasets until clear_dataset_store is called.
     :param is_test: Used for testing. Returns a tuple of expected return and the URL called to retrieve the data
-    :return: Dataframe of data for given indicators at an area
+    :return: Dataframe of data for given indicators at an area. Indicators known to have no data for the area type are
+        not requested. If none of them have data, a dataframe with the usual columns and no rows is returned.
     """
-    if isinstance(indicators, list):
-        if any(isinstance(ind, int) for ind in indicators):
-            indicators = ','.join(str(ind) for ind in indicators)
-        else:
-            indicators = ','.join(indicators)
-    else:
-        indicators = str(indicators)
-        
-    populated_url = f'all_data/csv/by_indicator_id?indicator_ids={indicators}&\
-        child_area_type_id={area_type_id}&parent_area_type_id={parent_area_type_id}'
-    try:
-        df = pd.read_csv(base_url + populated_url)
-    except URLError:
-        df = deal_with_url_error(base_url + populated_url)
+    available = filter_indicators(indicators, area_type_id)
+    url = build_url('all_data/csv/by_indicator_id', indicator_ids=available or indicators,
+                    child_area_type_id=area_type_id, parent_area_type_id=parent_area_type_id)
+    df = _read_data_csv(url, use_dataset_store, dataset_max_age) if available else _empty_data_frame()
     df.reset_index()
-    if filter_by_area_codes:
+    if filter_by_area_codes and not df.empty:
         if isinstance(filter_by_area_codes, list):
             df = df.loc[df['Area Code'].isin(filter_by_area_codes)]
         elif isinstance(filter_by_area_codes, str):
             df = df.loc[df['Area Code'] == filter_by_area_codes]
         df = df.reset_index()
     if is_test:
-        return df, base_url + populated_url
+        return df, url
     return df
 
 
@@ -133,8 +205,7 @@ def get_all_areas_for_all_indicators():
 
     :return: Dictionary of all indicators (ID as key) and their geographical breakdowns
     """
-    url_suffix = 'available_data'
-    all_area_ids = get_json(base_url + url_suffix)
+    all_area_ids = get_json(build_url('available_data'))
     all_indicators = list(set([x.get('IndicatorId') for x in all_area_ids]))
     all_indicators.sort()
     area_dict = {}
@@ -159,6 +230,10 @@ def get_data_for_indicator_at_all_available_geographies(indicator_id):
     df = pd.DataFrame()
     for area in areas_to_get:
         df_temp = get_data_by_indicator_ids(indicator_id, area)
-        df = pd.concat([df, df_temp])
+        with timed('concat_seconds'):
+            df = pd.concat([df, df_temp])
     df.drop_duplicates(inplace=True)
     return df
+
+
+profile_functions(globals())
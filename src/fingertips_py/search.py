@@ -0,0 +1,228 @@
+"""
+Indexed search over the Fingertips profile and indicator catalogues. The catalogues are downloaded once per session
+and held in memory with a key index and a token index, so repeated look ups do not need to call the API again.
+"""
+
+
+import re
+import difflib
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from fingertips_py.api_calls import get_data_in_dict, get_json
+from fingertips_py.urls import build_url
+
+
+_token_pattern = re.compile(r'[a-z0-9]+')
+_catalogues = {}
+_catalogue_lock = threading.Lock()
+
+
+def _tokenise(text):
+    """
+    :param text: A string to split into search tokens
+    :return: A list of lower case alphanumeric tokens
+
+    :meta private:
+    """
+    return _token_pattern.findall(str(text).lower())
+
+
+class CatalogueIndex:
+    """
+    An in-memory index of catalogue records (eg. profiles or indicators) supporting exact key look ups and ranked
+    substring/fuzzy search on the record name.
+
+    :param records: A dictionary of records with the record ID as the dictionary key
+    :param name_getter: A function that takes a record and returns its name
+    :param key_field: [OPTIONAL] The item in each record to be used as an exact look up key
+
+    :meta private:
+    """
+
+    def __init__(self, records, name_getter, key_field=None):
+        self.records = records
+        self._names = {}
+        self._keys = {}
+        self._tokens = defaultdict(set)
+        for record_id, record in records.items():
+            name = name_getter(record) or ''
+            self._names[record_id] = name.lower()
+            for token in _tokenise(name):
+                self._tokens[token].add(record_id)
+            if key_field is not None and record.get(key_field) is not None:
+                self._keys[record.get(key_field)] = record_id
+        self._vocabulary = sorted(self._tokens)
+
+    def __len__(self):
+        return len(self.records)
+
+    def get_by_key(self, key):
+        """
+        :param key: The exact key of the record
+        :return: The record with the given key or None if there is no match
+        """
+        record_id = self._keys.get(key)
+        if record_id is None:
+            return None
+        return self.records[record_id]
+
+    def _prefix_matches(self, token):
+        """
+        :param token: A search token
+        :return: A list of indexed tokens that start with the search token
+
+        :meta private:
+        """
+        matches = []
+        position = bisect_left(self._vocabulary, token)
+        while position < len(self._vocabulary) and self._vocabulary[position].startswith(token):
+            matches.append(self._vocabulary[position])
+            position += 1
+        return matches
+
+    def _substring_candidates(self, token):
+        """
+        :param token: A search token
+        :return: A set of the IDs of records with a name token containing the search token. Any record whose name
+            contains a query has a name token containing each of the query's tokens.
+
+        :meta private:
+        """
+        candidates = set()
+        for match in self._vocabulary:
+            if token in match:
+                candidates.update(self._tokens[match])
+        return candidates
+
+    def search(self, query, limit=10, fuzzy=True, cutoff=0.75):
+        """
+        Ranks records against a search query. Records score highest when the name equals the query, then when the
+        query is a substring of the name, then by how many query tokens match a name token exactly, as a prefix or,
+        if fuzzy is True, approximately.
+
+        :param query: A string or part of a string to search for
+        :param limit: [OPTIONAL] Maximum number of records to return. Default 10. None returns all matches.
+        :param fuzzy: [OPTIONAL] Whether to match misspelt tokens. Default True.
+        :param cutoff: [OPTIONAL] Similarity between 0 and 1 required for a fuzzy token match. Default 0.75.
+        :return: A list of (score, record ID) tuples, best match first
+        """
+        query_lower = str(query).lower().strip()
+        query_tokens = _tokenise(query_lower)
+        if not query_tokens:
+            return []
+        scores = defaultdict(float)
+        for token in query_tokens:
+            token_scores = {}
+            for record_id in self._tokens.get(token, ()):
+                token_scores[record_id] = 1.0
+            for match in self._prefix_matches(token):
+                for record_id in self._tokens[match]:
+                    token_scores.setdefault(record_id, 0.9)
+            if fuzzy and not token_scores:
+                for match in difflib.get_close_matches(token, self._vocabulary, n=5, cutoff=cutoff):
+                    similarity = difflib.SequenceMatcher(None, token, match).ratio() * 0.8
+                    for record_id in self._tokens[match]:
+                        token_scores[record_id] = max(token_scores.get(record_id, 0), similarity)
+            for record_id, score in token_scores.items():
+                scores[record_id] += score / len(query_tokens)
+        for record_id in self._substring_candidates(max(query_tokens, key=len)):
+            name = self._names[record_id]
+            if name == query_lower:
+                scores[record_id] += 2
+            elif query_lower in name:
+                scores[record_id] += 1
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], len(self._names[item[0]]), str(item[0])))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [(score, record_id) for record_id, score in ranked]
+
+
+def _get_catalogue(name, loader):
+    """
+    :param name: Name of the catalogue in the session cache
+    :param loader: A function that builds the CatalogueIndex if it has not been built yet
+    :return: The cached CatalogueIndex
+
+    :meta private:
+    """
+    catalogue = _catalogues.get(name)
+    if catalogue is None:
+        with _catalogue_lock:
+            catalogue = _catalogues.get(name)
+            if catalogue is None:
+                catalogue = loader()
+                _catalogues[name] = catalogue
+    return catalogue
+
+
+def _indicator_name(record):
+    """
+    :param record: Indicator metadata as returned by the indicator_metadata/all endpoint
+    :return: The name of the indicator
+
+    :meta private:
+    """
+    descriptive = record.get('Descriptive') or {}
+    return descriptive.get('Name') or record.get('Name')
+
+
+def get_profile_catalogue(refresh=False):
+    """
+    Returns the cached, indexed catalogue of all profiles. The profiles are downloaded on first use.
+
+    :param refresh: [OPTIONAL] Whether to download the profiles again. Default False.
+    :return: A CatalogueIndex of profiles keyed by profile ID
+    """
+    if refresh:
+        _catalogues.pop('profiles', None)
+    return _get_catalogue('profiles', lambda: CatalogueIndex(get_data_in_dict(build_url('profiles')),
+                                                             lambda profile: profile.get('Name'), key_field='Key'))
+
+
+def get_indicator_catalogue(refresh=False):
+    """
+    Returns the cached, indexed catalogue of all indicators. The indicator metadata is downloaded on first use.
+
+    :param refresh: [OPTIONAL] Whether to download the indicator metadata again. Default False.
+    :return: A CatalogueIndex of indicator metadata keyed by indicator ID
+    """
+    if refresh:
+        _catalogues.pop('indicators', None)
+    url = build_url('indicator_metadata/all', include_definition=False, include_system_content=False)
+    return _get_catalogue('indicators', lambda: CatalogueIndex(get_json(url), _indicator_name))
+
+
+def clear_search_cache():
+    """
+    Removes the cached profile and indicator catalogues so they are downloaded again on next use.
+    """
+    with _catalogue_lock:
+        _catalogues.clear()
+
+
+def search_profiles(query, limit=10, fuzzy=True):
+    """
+    Returns profiles whose names best match a search term, best match first.
+
+    :param query: A string or part of a string to search for in the profile names
+    :param limit: [OPTIONAL] Maximum number of profiles to return. Default 10.
+    :param fuzzy: [OPTIONAL] Whether to match misspelt words. Default True.
+    :return: A list of dictionaries of profile metadata
+    """
+    catalogue = get_profile_catalogue()
+    return [catalogue.records[profile_id] for _, profile_id in catalogue.search(query, limit=limit, fuzzy=fuzzy)]
+
+
+def search_indicators(query, limit=10, fuzzy=True):
+    """
+    Returns indicators whose names best match a search term, best match first.
+
+    :param query: A string or part of a string to search for in the indicator names
+    :param limit: [OPTIONAL] Maximum number of indicators to return. Default 10.
+    :param fuzzy: [OPTIONAL] Whether to match misspelt words. Default True.
+    :return: A dictionary of indicator metadata with the indicator ID as the key, ordered best match first
+    """
+    catalogue = get_indicator_catalogue()
+    return {indicator_id: catalogue.records[indicator_id]
+            for _, indicator_id in catalogue.search(query, limit=limit, fuzzy=fuzzy)}
@@ -0,0 +1,116 @@
+"""
+A local store of downloaded datasets in the Arrow IPC (Feather v2) format. Datasets are read back through a memory map,
+so many processes on one host share a single page cache copy of each dataset rather than each parsing and holding its
+own. Requires pyarrow.
+"""
+
+
+import os
+import time
+import hashlib
+import threading
+import pandas as pd
+from fingertips_py.api_calls import get_csv_return_df
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+
+dataset_store_dir = os.environ.get('FINGERTIPS_PY_DATASET_STORE',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'fingertips_py', 'datasets'))
+
+
+def _check_pyarrow():
+    """
+    Raises an ImportError if pyarrow is not installed.
+
+    :meta private:
+    """
+    if pyarrow is None:
+        raise ImportError('The dataset store requires pyarrow. Install it with pip install fingertips_py[arrow]')
+
+
+def dataset_path(url, store_dir=None):
+    """
+    :param url: The url the dataset is downloaded from
+    :param store_dir: [OPTIONAL] Directory of the store. Defaults to dataset_store_dir.
+    :return: The path of the Arrow file holding the dataset
+    """
+    name = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return os.path.join(store_dir or dataset_store_dir, name + '.arrow')
+
+
+def write_dataset(df, path):
+    """
+    Writes a dataframe to an Arrow IPC file. The file is written under a temporary name and renamed into place, so
+    readers in other processes never see a partial file.
+
+    :param df: A dataframe
+    :param path: Path of the Arrow file
+
+    :meta private:
+    """
+    _check_pyarrow()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with pyarrow.OSFile(temp_path, 'wb') as sink:
+        with pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temp_path, path)
+
+
+def read_dataset(path, zero_copy=True):
+    """
+    Reads an Arrow IPC file through a memory map.
+
+    :param path: Path of the Arrow file
+    :param zero_copy: [OPTIONAL] Whether to return Arrow backed columns that point into the memory map rather than
+        copying them into NumPy arrays. Default True. Arrow backed columns need pandas 2.0 or later, earlier versions
+        always copy.
+    :return: A dataframe of the dataset
+    """
+    _check_pyarrow()
+    table = pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r')).read_all()
+    if zero_copy and hasattr(pd, 'ArrowDtype'):
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+    return table.to_pandas(split_blocks=True)
+
+
+def get_stored_dataset(url, store_dir=None, max_age=None, refresh=False, zero_copy=True):
+    """
+    Returns a dataset from the store, downloading and storing it first if it is missing or out of date.
+
+    :param url: A url that returns a CSV
+    :param store_dir: [OPTIONAL] Directory of the store. Defaults to dataset_store_dir.
+    :param max_age: [OPTIONAL] Maximum age in seconds of a stored dataset before it is downloaded again. Default no
+        limit.
+    :param refresh: [OPTIONAL] Whether to download the dataset again. Default False.
+    :param zero_copy: [OPTIONAL] Whether to return memory mapped Arrow backed columns. Default True.
+    :return: A dataframe of the dataset
+    """
+    _check_pyarrow()
+    path = dataset_path(url, store_dir)
+    stale = refresh or not os.path.exists(path)
+    if not stale and max_age is not None:
+        stale = time.time() - os.path.getmtime(path) >= max_age
+    if stale:
+        write_dataset(get_csv_return_df(url), path)
+    return read_dataset(path, zero_copy)
+
+
+def clear_dataset_store(store_dir=None):
+    """
+    Deletes all the datasets in the store.
+
+    :param store_dir: [OPTIONAL] Directory of the store. Defaults to dataset_store_dir.
+    """
+    store_dir = store_dir or dataset_store_dir
+    if not os.path.isdir(store_dir):
+        return
+    for name in os.listdir(store_dir):
+        if name.endswith('.arrow'):
+            os.remove(os.path.join(store_dir, name))
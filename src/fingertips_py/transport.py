@@ -0,0 +1,242 @@
+"""
+Transports send the HTTP requests of a FingertipsClient. The live transport uses the network. The record transport
+also uses the network and saves every response to a cassette store, a directory of gzip compressed files, and the
+replay transport serves those saved responses without any network access. Replay can inject latency and limit
+bandwidth so benchmarks and throughput tests can simulate realistic network conditions locally.
+
+The transport of the default client can be chosen with environment variables, for example to run the tests from
+cassettes::
+
+    FINGERTIPS_PY_TRANSPORT=record FINGERTIPS_PY_CASSETTE_DIR=./cassettes pytest
+    FINGERTIPS_PY_TRANSPORT=replay FINGERTIPS_PY_CASSETTE_DIR=./cassettes FINGERTIPS_PY_REPLAY_LATENCY=0.05 pytest
+"""
+
+
+import io
+import os
+import gzip
+import json
+import time
+import random
+import hashlib
+import threading
+import requests
+from typing import Protocol, runtime_checkable
+from requests.structures import CaseInsensitiveDict
+from fingertips_py.cache import cache_key
+
+
+@runtime_checkable
+class Transport(Protocol):
+    """
+    Protocol of transports: any object with a get method that sends a GET request and returns a requests Response.
+    """
+
+    def get(self, session, url, headers=None, stream=False, verify=True, timeout=None):
+        """
+        :param session: The requests session of the calling thread
+        :param url: A url to make a request
+        :param headers: [OPTIONAL] Dictionary of request headers
+        :param stream: [OPTIONAL] Whether to stream the response body
+        :param verify: [OPTIONAL] Whether to verify SSL certificates
+        :param timeout: [OPTIONAL] Timeout in seconds
+        :return: A requests Response
+        """
+        ...
+
+
+class LiveTransport(Transport):
+    """
+    Sends requests over the network.
+    """
+
+    def get(self, session, url, headers=None, stream=False, verify=True, timeout=None):
+        return session.get(url, headers=headers, stream=stream, verify=verify, timeout=timeout)
+
+
+class CassetteStore:
+    """
+    A directory of recorded responses, one gzip compressed file per url. Each file holds a JSON line with the status
+    and headers followed by the body.
+
+    :param directory: Directory of the cassettes
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, url):
+        """
+        :param url: A url
+        :return: The path of the cassette of the url. Urls that only differ in parameter order share a cassette.
+        """
+        name = hashlib.sha256(cache_key(url).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.gz')
+
+    def save(self, url, status_code, reason, headers, body):
+        """
+        Saves a response, writing to a temporary file and renaming it so a cassette is never partially written.
+
+        :param url: The url of the request
+        :param status_code: HTTP status code of the response
+        :param reason: HTTP reason phrase of the response
+        :param headers: Dictionary of response headers
+        :param body: The decoded response body as bytes
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(url)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        header = {'url': url, 'status_code': status_code, 'reason': reason, 'headers': dict(headers)}
+        with gzip.open(temp_path, 'wb') as cassette:
+            cassette.write(json.dumps(header).encode('utf-8') + b'\n')
+            cassette.write(body)
+        os.replace(temp_path, path)
+
+    def load(self, url):
+        """
+        :param url: A url
+        :return: A tuple of the header dictionary and body of the recorded response, or None if it was not recorded
+        """
+        try:
+            with gzip.open(self.path(url), 'rb') as cassette:
+                header = json.loads(cassette.readline().decode('utf-8'))
+                return header, cassette.read()
+        except FileNotFoundError:
+            return None
+
+
+class RecordTransport(Transport):
+    """
+    Sends requests over the network and saves each response to a cassette store. Conditional request headers are not
+    sent, so the full body is always recorded.
+
+    :param directory: Directory of the cassettes
+    """
+
+    def __init__(self, directory):
+        self.store = CassetteStore(directory)
+
+    def get(self, session, url, headers=None, stream=False, verify=True, timeout=None):
+        headers = {name: value for name, value in (headers or {}).items()
+                   if name.lower() not in ('if-none-match', 'if-modified-since')}
+        response = session.get(url, headers=headers, verify=verify, timeout=timeout)
+        self.store.save(url, response.status_code, response.reason, _recorded_headers(response.headers),
+                        response.content)
+        return _build_response(url, response.status_code, response.reason, _recorded_headers(response.headers),
+                               response.content, stream)
+
+
+class ReplayTransport(Transport):
+    """
+    Serves responses from a cassette store without using the network.
+
+    :param directory: Directory of the cassettes
+    :param latency: [OPTIONAL] Seconds to wait before each response. Default 0.
+    :param jitter: [OPTIONAL] Up to this many seconds are added at random to the latency. Default 0.
+    :param bandwidth: [OPTIONAL] Maximum bytes per second at which each response body is delivered. Default no limit.
+    :param seed: [OPTIONAL] Seed of the jitter, for repeatable runs
+    """
+
+    def __init__(self, directory, latency=0.0, jitter=0.0, bandwidth=None, seed=None):
+        self.store = CassetteStore(directory)
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def get(self, session, url, headers=None, stream=False, verify=True, timeout=None):
+        recorded = self.store.load(url)
+        if recorded is None:
+            raise requests.exceptions.ConnectionError(f'No recorded response for {url} in {self.store.directory}')
+        header, body = recorded
+        delay = self.latency
+        if self.jitter:
+            with self._lock:
+                delay += self._random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if self.bandwidth and not stream:
+            time.sleep(len(body) / self.bandwidth)
+        return _build_response(url, header['status_code'], header['reason'], header['headers'], body, stream,
+                               self.bandwidth)
+
+
+class ThrottledStream(io.RawIOBase):
+    """
+    A binary stream that delivers its bytes no faster than a given bandwidth.
+
+    :param data: The bytes of the stream
+    :param bandwidth: Maximum bytes per second, or None for no limit
+
+    :meta private:
+    """
+
+    def __init__(self, data, bandwidth=None):
+        self._data = io.BytesIO(data)
+        self.bandwidth = bandwidth
+        self._start = None
+        self._delivered = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._start is None:
+            self._start = time.perf_counter()
+        count = self._data.readinto(buffer)
+        if self.bandwidth and count:
+            self._delivered += count
+            wait = self._start + self._delivered / self.bandwidth - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        return count
+
+
+def _recorded_headers(headers):
+    """
+    :param headers: Response headers
+    :return: The headers without those that describe the encoding of the original body on the wire
+
+    :meta private:
+    """
+    return {name: value for name, value in headers.items()
+            if name.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')}
+
+
+def _build_response(url, status_code, reason, headers, body, stream, bandwidth=None):
+    """
+    :return: A requests Response for a recorded body
+
+    :meta private:
+    """
+    response = requests.Response()
+    response.url = url
+    response.status_code = status_code
+    response.reason = reason
+    response.headers = CaseInsensitiveDict(headers)
+    response.raw = ThrottledStream(body, bandwidth)
+    if not stream:
+        response._content = body
+    return response
+
+
+def transport_from_environment():
+    """
+    :return: The transport chosen by the FINGERTIPS_PY_TRANSPORT environment variable: 'live' (the default), 'record' or
+        'replay'. Cassettes are kept in FINGERTIPS_PY_CASSETTE_DIR and replay is slowed by FINGERTIPS_PY_REPLAY_LATENCY
+        (seconds) and FINGERTIPS_PY_REPLAY_BANDWIDTH (bytes per second).
+
+    :meta private:
+    """
+    mode = os.environ.get('FINGERTIPS_PY_TRANSPORT', 'live').lower()
+    if mode == 'live':
+        return LiveTransport()
+    directory = os.environ.get('FINGERTIPS_PY_CASSETTE_DIR', 'cassettes')
+    if mode == 'record':
+        return RecordTransport(directory)
+    if mode == 'replay':
+        bandwidth = os.environ.get('FINGERTIPS_PY_REPLAY_BANDWIDTH')
+        return ReplayTransport(directory, latency=float(os.environ.get('FINGERTIPS_PY_REPLAY_LATENCY', 0)),
+                               bandwidth=float(bandwidth) if bandwidth else None)
+    raise ValueError(f'FINGERTIPS_PY_TRANSPORT must be live, record or replay, not {mode}')
@@ -0,0 +1,91 @@
+"""
+A central builder for Fingertips API urls. Every request url is built here so that the same logical request always
+produces exactly the same url: lists of IDs are deduplicated and sorted, values are stripped of whitespace and query
+parameters are written in a fixed order for each endpoint. Identical urls let the response cache, the download store
+and the batching in the planner and export jobs recognise repeated requests.
+"""
+
+
+from urllib.parse import urlencode
+from fingertips_py import api_calls
+
+
+endpoint_parameters = {
+    'all_data/csv/by_indicator_id': ['indicator_ids', 'child_area_type_id', 'parent_area_type_id', 'profile_id',
+                                     'include_sortable_time_periods'],
+    'all_data/csv/by_profile_id': ['child_area_type_id', 'parent_area_type_id', 'profile_id',
+                                   'include_sortable_time_periods'],
+    'all_data/csv/by_group_id': ['child_area_type_id', 'parent_area_type_id', 'group_id',
+                                 'include_sortable_time_periods'],
+    'indicator_metadata/all': ['include_definition', 'include_system_content'],
+    'indicator_metadata/by_indicator_id': ['indicator_ids'],
+    'indicator_metadata/csv/by_indicator_id': ['indicator_ids'],
+    'indicator_metadata/csv/by_group_id': ['group_id'],
+    'indicator_metadata/csv/by_profile_id': ['profile_id'],
+    'areas/by_area_type': ['area_type_id'],
+    'area_types': ['profile_ids'],
+    'profile': ['profile_id'],
+}
+
+
+def id_list(ids):
+    """
+    Normalises one or more IDs to a sorted, deduplicated list. Numeric IDs are sorted as numbers and returned as
+    integers, anything else (eg. area codes) is sorted as text.
+
+    :param ids: A single ID, a comma separated string of IDs or an iterable of IDs, as integers or strings
+    :return: A list of IDs
+    """
+    if isinstance(ids, (int, str)):
+        ids = str(ids).split(',')
+    items = list(dict.fromkeys(str(item).strip() for item in ids))
+    items = [item for item in items if item]
+    if all(item.lstrip('-').isdigit() for item in items):
+        return sorted(set(int(item) for item in items))
+    return sorted(items)
+
+
+def _format_value(value):
+    """
+    :param value: A query parameter value
+    :return: The value as canonical text
+
+    :meta private:
+    """
+    if isinstance(value, bool):
+        return 'yes' if value else 'no'
+    if isinstance(value, (list, tuple, set, frozenset)) or (isinstance(value, str) and ',' in value):
+        return ','.join(map(str, id_list(value)))
+    return ''.join(str(value).split())
+
+
+def build_query(endpoint, params):
+    """
+    :param endpoint: Path of the endpoint relative to the API root, eg. 'all_data/csv/by_profile_id'
+    :param params: Dictionary of query parameters. Parameters with a value of None are left out.
+    :return: The canonical query string, without the leading '?'
+    """
+    order = endpoint_parameters.get(endpoint, [])
+    names = [name for name in order if params.get(name) is not None]
+    names += sorted(name for name in params if name not in order and params[name] is not None)
+    return urlencode([(name, _format_value(params[name])) for name in names], safe=',')
+
+
+def build_url(endpoint, **params):
+    """
+    Builds the url of an API request. For example::
+
+        build_url('all_data/csv/by_indicator_id', indicator_ids=[92998, 92949, 92949], child_area_type_id=102,
+                  parent_area_type_id=15)
+
+    returns base_url + 'all_data/csv/by_indicator_id?indicator_ids=92949,92998&child_area_type_id=102
+    &parent_area_type_id=15'.
+
+    :param endpoint: Path of the endpoint relative to the API root
+    :param params: Query parameters. Lists of IDs are sorted and deduplicated, booleans become 'yes' or 'no' and
+        parameters with a value of None are left out.
+    :return: The url
+    """
+    endpoint = endpoint.strip().strip('/')
+    query = build_query(endpoint, params)
+    return api_calls.get_default_client().base_url + endpoint + ('?' + query if query else '')
@@ -1,5 +1,15 @@
+import io
+import os
+import json
+import time
+import threading
+import fnmatch
 import pandas as pd
 import pytest
+import requests
+from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor
+from fingertips_py import api_calls, store, incremental, availability, retrieve_data, autotune
 from fingertips_py.api_calls import get_json, get_data_in_tuple, make_request, get_json_return_df, base_url
 from fingertips_py.retrieve_data import get_all_data_for_profile, get_all_data_for_indicators, get_data_by_indicator_ids, \
     get_all_areas_for_all_indicators, get_data_for_indicator_at_all_available_geographies
@@ -10,6 +20,24 @@ from fingertips_py.metadata import get_metadata_for_profile_as_dataframe, get_me
     get_multiplier_and_calculation_for_indicator, get_sex_from_id, get_sex_id, get_value_note_id, \
     get_metadata_for_all_indicators, get_metadata_for_all_indicators_from_csv, get_all_areas, get_profile_by_key
 from fingertips_py.area_data import deprivation_decile
+from fingertips_py.search import search_profiles, search_indicators, CatalogueIndex
+from fingertips_py.planner import QueryPlanner
+from fingertips_py.reshape import to_cube
+from fingertips_py.calculations import wilson_ci, byars_ci, aggregate_areas
+from fingertips_py.export import plan_export_units, export_data, DownloadJob, indicator_download_job, ExportUnit
+from fingertips_py.cli import build_parser
+from fingertips_py.parallel import split_csv_blocks, parse_csv_parallel
+from fingertips_py.store import dataset_path, write_dataset, read_dataset
+from fingertips_py.urls import build_url, id_list
+from fingertips_py.api_calls import FingertipsClient
+from fingertips_py.transport import Transport, RecordTransport, ReplayTransport
+from fingertips_py.availability import AvailabilityMatrix
+from fingertips_py.normalize import normalize
+from fingertips_py.diff import diff
+from fingertips_py.autotune import AutoTuner, run_tuned
+from fingertips_py.profiling import profile, record_cost
+from fingertips_py.incremental import get_watermarks, read_incremental_store
+from fingertips_py.cache import CacheBackend, MemoryCache, FileSystemCache, SQLiteCache, RedisCache, cache_key
 
 
 def test_get_json():
@@ -90,7 +118,7 @@ def test_get_metadata():
     data_profile = get_metadata(profile_ids=84)
     data_indicators_and_domain = get_metadata(indicator_ids=[92949, 90581], domain_ids=[1938133052, 1938132811])
     data_domain_and_profile = get_metadata(domain_ids=[1938133052, 1938132811], profile_ids=84)
-    #data_profile_and_indicators = get_metadata(indicator_ids=[92949, 90581], profile_ids=84) ####!
+    data_profile_and_indicators = get_metadata(indicator_ids=[92949, 90581], profile_ids=84)
     data_all = get_metadata(indicator_ids=[92949, 90581], domain_ids=[1938133052, 1938132811], profile_ids=84)
     assert isinstance(data_indicators, pd.DataFrame) is True
     assert data_indicators.shape[1] == 32
@@ -102,8 +130,8 @@ def test_get_metadata():
     assert data_indicators_and_domain.shape[1] == 32
     assert isinstance(data_domain_and_profile, pd.DataFrame) is True
     assert data_domain_and_profile.shape[1] == 32
-    #assert isinstance(data_profile_and_indicators, pd.DataFrame) is True
-    #assert data_profile_and_indicators.shape[1] == 32
+    assert isinstance(data_profile_and_indicators, pd.DataFrame) is True
+    assert data_profile_and_indicators.shape[1] == 32
     assert isinstance(data_all, pd.DataFrame) is True
     assert data_all.shape[1] == 32
 
@@ -251,3 +279,622 @@ def test_get_metadata_for_all_indicators_from_csv():
 def test_deprivation_decile():
     data = deprivation_decile(7)
     assert len(data.unique()) == 10
+
+
+def test_search_profiles():
+    data = search_profiles('dementia')
+    assert isinstance(data, list) is True
+    assert data[0]['Id'] == 84
+
+
+def test_search_indicators():
+    data = search_indicators('healthy life expectancy at birth', limit=5)
+    assert isinstance(data, dict) is True
+    assert len(data) <= 5
+
+
+def test_catalogue_index():
+    records = {1: {'Name': 'Dementia Profile', 'Key': 'dementia'},
+               2: {'Name': 'Mental Health and Dementia', 'Key': 'mh-dementia'},
+               3: {'Name': 'Child and Maternal Health', 'Key': 'child-health-profiles'}}
+    index = CatalogueIndex(records, lambda record: record.get('Name'), key_field='Key')
+    assert index.get_by_key('child-health-profiles')['Name'] == 'Child and Maternal Health'
+    assert index.get_by_key('missing') is None
+    assert [record_id for _, record_id in index.search('dementia')] == [1, 2]
+    assert index.search('maternel helth')[0][1] == 3
+    assert index.search('maternel', fuzzy=False) == []
+    assert [record_id for _, record_id in index.search('mentia', fuzzy=False)] == [1, 2]
+    assert index.search('health and dem', fuzzy=False)[0][1] == 2
+
+
+def test_query_planner():
+    planner = QueryPlanner(102, indicator_ids=[92949, 92998])
+    planned = planner.plan()
+    assert len(planned) == 1
+    assert planned[0].endpoint == 'by_indicator_id'
+    assert isinstance(planner.explain(), str) is True
+    data = planner.execute()
+    assert isinstance(data, pd.DataFrame) is True
+    assert set(data['Indicator ID'].unique()) <= {92949, 92998}
+
+
+def test_to_cube():
+    df = pd.DataFrame({'Area Code': ['E06000001', 'E06000002', 'E06000001'], 'Indicator ID': [90362, 90362, 92949],
+                       'Sex': 'Persons', 'Age': 'All ages', 'Time period': ['2019/20', '2019/20', '2018/19'],
+                       'Time period Sortable': [20190000, 20190000, 20180000], 'Value': [1.0, 2.0, 3.0]})
+    cube = to_cube(df)
+    assert cube.shape == (2, 2, 1, 1, 2)
+    assert list(cube.coords['Time period']) == ['2018/19', '2019/20']
+    assert cube.sel({'Area Code': 'E06000002', 'Indicator ID': 90362, 'Sex': 'Persons', 'Age': 'All ages',
+                     'Time period': '2019/20'}) == 2.0
+    sparse_cube = to_cube(df, sparse=True)
+    assert sparse_cube.is_sparse is True
+    assert len(sparse_cube.to_frame()) == 3
+    with pytest.raises(ValueError):
+        to_cube(pd.concat([df, df]))
+    shared = df.assign(**{'Time period': ['2019', '2019/20', '2018/19']})
+    shared_cube = to_cube(shared)
+    assert list(shared_cube.coords['Time period']) == ['2018/19', '2019', '2019/20']
+    assert shared_cube.to_frame().set_index('Area Code').loc['E06000002', 'Time period'] == '2019/20'
+
+
+def test_wilson_ci():
+    lower, upper = wilson_ci([50, 0], [100, 10])
+    assert round(lower[0], 2) == 40.38
+    assert round(upper[0], 2) == 59.62
+    assert lower[1] == 0
+
+
+def test_byars_ci():
+    lower, upper = byars_ci(20, 100000)
+    assert round(float(lower), 1) == 12.2
+    assert round(float(upper), 1) == 30.9
+
+
+def test_aggregate_areas():
+    df = pd.DataFrame({'Indicator ID': [247, 247, 247], 'Area Code': ['E06000001', 'E06000002', 'E06000003'],
+                       'Parent Code': ['E12000001', 'E12000001', 'E12000002'], 'Sex': 'Persons', 'Age': 'All ages',
+                       'Time period': '2020', 'Count': [10, 20, 5], 'Denominator': [100, 100, 50]})
+    data = aggregate_areas(df, method='Wilson', multiplier=100)
+    assert len(data) == 2
+    assert data.loc[data['Area Code'] == 'E12000001', 'Value'].iloc[0] == 15.0
+    assert 'Lower CI 95.0 limit' in data.columns
+
+
+def test_plan_export_units():
+    units = plan_export_units(area_type_ids=[102, 7], profile_ids=[84], indicator_lists=[[92998, 92949]])
+    assert len(units) == 4
+    assert units[0].url == base_url + 'all_data/csv/by_profile_id?child_area_type_id=102&parent_area_type_id=15&profile_id=84'
+    assert units[2].partition.startswith('indicator_ids=92949-92998')
+    with pytest.raises(ValueError):
+        plan_export_units(domain_ids=[1938133052])
+
+
+def test_export_data(tmp_path):
+    stats = export_data(str(tmp_path), area_type_ids=[102], indicator_lists=[[92949, 92998]], file_format='csv')
+    assert stats['written'] == 1
+    assert stats['rows'] > 0
+    stats = export_data(str(tmp_path), area_type_ids=[102], indicator_lists=[[92949, 92998]], file_format='csv')
+    assert stats['skipped'] == 1
+
+
+def test_cli_parser():
+    args = build_parser().parse_args(['export', '--profile', '84', '--indicators', '92949,92998', '--area-type', '102',
+                                      '--format', 'csv', '--output', 'out'])
+    assert args.profile_ids == [84]
+    assert args.indicator_lists == [[92949, 92998]]
+    assert args.resume is True
+
+
+def test_download_job(tmp_path):
+    with pytest.raises(ValueError):
+        DownloadJob(str(tmp_path))
+    job = indicator_download_job(str(tmp_path), [92949, 92998], 102, chunk_size=1, file_format='csv')
+    assert len(job.missing()) == 2
+    stats = job.run()
+    assert stats['written'] == 2
+    reopened = DownloadJob(str(tmp_path))
+    assert reopened.missing() == []
+    assert isinstance(reopened.load(), pd.DataFrame) is True
+
+
+class CSVTransport(Transport):
+    """
+    A transport that answers every request with the same CSV body.
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    def get(self, session, url, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = self.body
+        response.raw = io.BytesIO(self.body)
+        return response
+
+
+def test_chunked_csv_types(monkeypatch, tmp_path):
+    body = ('Indicator ID,Time period,Value\n' + '1,2019,1.5\n' * 5 + '1,2019/20,2.5\n' * 5).encode('utf-8')
+    monkeypatch.setattr(api_calls, '_default_client', FingertipsClient(transport=CSVTransport(body)))
+    url = base_url + 'all_data/csv/by_indicator_id?indicator_ids=1&child_area_type_id=102&parent_area_type_id=15'
+    chunks = list(api_calls.iter_csv_chunks(url, chunksize=4))
+    assert {type(value) for value in pd.concat(chunks)['Time period']} == {str}
+    job = DownloadJob(str(tmp_path), [ExportUnit('area_type_id=102', url)], file_format='csv', chunksize=4)
+    job.run()
+    assert (job.load()['Time period'] == '2019').sum() == 5
+    reopened = DownloadJob(str(tmp_path), file_format='parquet')
+    assert len(reopened.missing()) == 1
+    assert reopened.run()['written'] == 1
+    assert len(reopened.load()) == 10
+
+
+def test_get_all_data_for_profile_with_checkpoint(tmp_path):
+    data = get_all_data_for_profile(84, area_type_id=102, checkpoint_dir=str(tmp_path))
+    assert isinstance(data, pd.DataFrame) is True
+    assert (tmp_path / 'manifest.json').exists()
+
+
+class ETagTransport(Transport):
+    """
+    A transport that serves a CSV with an ETag and answers requests that send the ETag back with a 304.
+    """
+
+    body = b'Indicator ID,Indicator Name\n247,Example\n'
+
+    def __init__(self):
+        self.sent_headers = []
+
+    def get(self, session, url, headers=None, **kwargs):
+        self.sent_headers.append(dict(headers or {}))
+        response = requests.Response()
+        response.url = url
+        response.headers['ETag'] = '"v1"'
+        if (headers or {}).get('If-None-Match') == '"v1"':
+            response.status_code = 304
+            response.raw = io.BytesIO(b'')
+        else:
+            response.status_code = 200
+            response.raw = io.BytesIO(self.body)
+        return response
+
+
+def test_get_csv_return_df_with_http_store(tmp_path, monkeypatch):
+    transport = ETagTransport()
+    client = FingertipsClient(http_store_dir=str(tmp_path), transport=transport)
+    monkeypatch.setattr(api_calls, '_default_client', client)
+    url = base_url + 'indicator_metadata/csv/by_indicator_id?indicator_ids=247'
+    first = api_calls.get_csv_return_df(url)
+    second = api_calls.get_csv_return_df(url)
+    assert first.equals(second)
+    assert 'If-None-Match' not in transport.sent_headers[0]
+    assert transport.sent_headers[1]['If-None-Match'] == '"v1"'
+    assert client.get_metrics()['not_modified'] == 1
+
+
+def test_http_store_concurrent_downloads(tmp_path):
+    class UnconditionalTransport(ETagTransport):
+        def get(self, session, url, headers=None, **kwargs):
+            return super().get(session, url, headers={}, **kwargs)
+
+    client = FingertipsClient(http_store_dir=str(tmp_path), transport=UnconditionalTransport())
+    url = base_url + 'indicator_metadata/csv/by_indicator_id?indicator_ids=247'
+
+    def read(_):
+        with client.open_csv(url) as csv_file:
+            return csv_file.read()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        bodies = list(executor.map(read, range(400)))
+    assert set(bodies) == {ETagTransport.body}
+    assert not fnmatch.filter(os.listdir(tmp_path), '*.tmp')
+
+
+def test_limiter_held_until_stream_closed():
+    client = FingertipsClient(max_concurrent_requests=1, transport=CSVTransport(b'Indicator ID\n1\n'))
+    url = base_url + 'all_data/csv/by_indicator_id?indicator_ids=1'
+    stream = client.open_csv(url)
+    assert client._limiter.acquire(blocking=False) is False
+    stream.read()
+    stream.close()
+    assert client._limiter.acquire(blocking=False) is True
+    client._limiter.release()
+    client.get_content(url)
+    assert client._limiter.acquire(blocking=False) is True
+
+
+def test_use_client_is_isolated_between_threads():
+    clients = [FingertipsClient(), FingertipsClient()]
+    barrier = threading.Barrier(2)
+
+    def run(client):
+        with api_calls.use_client(client):
+            barrier.wait()
+            seen = api_calls.get_default_client()
+            barrier.wait()
+        return seen
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        seen = list(executor.map(run, clients))
+    assert seen[0] is clients[0] and seen[1] is clients[1]
+    assert api_calls.get_default_client() not in clients
+    with api_calls.use_client(clients[0]):
+        assert api_calls.map_concurrently(lambda _: api_calls.get_default_client(), [1, 2]) == clients[:1] * 2
+
+
+def test_split_csv_blocks():
+    header, blocks = split_csv_blocks(io.BytesIO(b'a,b\n1,"x\ny"\n2,z\n3,"q,\n"\n'), block_size=3)
+    assert header == b'a,b\n'
+    assert list(blocks) == [b'1,"x\ny"\n', b'2,z\n', b'3,"q,\n"\n']
+
+
+def test_parse_csv_parallel_types(monkeypatch):
+    rows = ''.join(f'1,E{number:05d},2019,{number}\n' for number in range(20000))
+    rows += ''.join(f'1,E{number:05d},2019/20,{number}\n' for number in range(20000))
+    body = ('Indicator ID,Area Code,Time period,Value\n' + rows).encode('utf-8')
+    monkeypatch.setattr(api_calls, '_default_client', FingertipsClient(transport=CSVTransport(body)))
+    parallel = parse_csv_parallel(base_url + 'all_data/csv/by_indicator_id?indicator_ids=1', processes=2,
+                                  block_size=1 << 16)
+    serial = pd.read_csv(io.BytesIO(body))
+    pd.testing.assert_frame_equal(parallel, serial)
+    assert (parallel['Time period'] == '2019').sum() == 20000
+
+
+def test_parse_csv_parallel_uses_cache(monkeypatch):
+    body = b'Indicator ID,Area Code,Value\n1,E06000001,1.5\n1,E06000002,2.5\n'
+    client = FingertipsClient(cache=MemoryCache(), transport=CSVTransport(body))
+    monkeypatch.setattr(api_calls, '_default_client', client)
+    url = base_url + 'all_data/csv/by_indicator_id?indicator_ids=1'
+    first = parse_csv_parallel(url, processes=1)
+    second = parse_csv_parallel(url, processes=1)
+    pd.testing.assert_frame_equal(first, second)
+    assert client.get_metrics()['requests'] == 1
+    assert client.get_metrics()['cache_hits'] == 1
+
+
+def test_get_all_data_for_profile_with_processes():
+    data = get_all_data_for_profile(84, area_type_id=102, processes=2)
+    assert isinstance(data, pd.DataFrame) is True
+    assert data.shape[1] == 26
+
+
+def test_dataset_store_round_trip(tmp_path):
+    pytest.importorskip('pyarrow')
+    df = pd.DataFrame({'Area Code': ['E06000001', 'E06000002'], 'Value': [1.5, 2.5]})
+    path = dataset_path(base_url + 'all_data/csv/by_indicator_id?indicator_ids=1', str(tmp_path))
+    write_dataset(df, path)
+    stored = read_dataset(path)
+    assert list(stored.columns) == ['Area Code', 'Value']
+    assert stored['Value'].sum() == 4.0
+    assert read_dataset(path, zero_copy=False)['Value'].tolist() == [1.5, 2.5]
+
+
+def test_get_data_by_indicator_ids_with_dataset_store(tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    monkeypatch.setattr(store, 'dataset_store_dir', str(tmp_path))
+    data = get_data_by_indicator_ids([92949, 92998], 102, use_dataset_store=True)
+    assert isinstance(data, pd.DataFrame) is True
+    assert data.shape[1] == 27
+
+
+def test_dataset_store_max_age(tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    monkeypatch.setattr(store, 'dataset_store_dir', str(tmp_path))
+    downloads = []
+
+    def download(url):
+        downloads.append(url)
+        return pd.DataFrame({'Area Code': ['E06000001'], 'Value': [float(len(downloads))]})
+    monkeypatch.setattr(store, 'get_csv_return_df', download)
+    url = base_url + 'all_data/csv/by_indicator_id?indicator_ids=1'
+    assert retrieve_data._read_data_csv(url, use_dataset_store=True)['Value'].tolist() == [1.0]
+    assert retrieve_data._read_data_csv(url, use_dataset_store=True)['Value'].tolist() == [1.0]
+    assert retrieve_data._read_data_csv(url, use_dataset_store=True, dataset_max_age=0)['Value'].tolist() == [2.0]
+    assert len(downloads) == 2
+
+
+class FakeRedis:
+    """
+    An in-process stand in for a Redis client, supporting the methods used by RedisCache.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, name):
+        value, expires = self.values.get(name, (None, None))
+        if expires is not None and expires < time.time():
+            return None
+        return value
+
+    def set(self, name, value, ex=None):
+        self.values[name] = (value, time.time() + ex if ex is not None else None)
+
+    def delete(self, *names):
+        for name in names:
+            self.values.pop(name, None)
+
+    def scan_iter(self, match=None):
+        return [name for name in list(self.values) if fnmatch.fnmatch(name, match or '*')]
+
+
+@pytest.mark.parametrize('backend', ['memory', 'filesystem', 'sqlite', 'redis'])
+def test_cache_backends(backend, tmp_path):
+    caches = {'memory': lambda: MemoryCache(), 'filesystem': lambda: FileSystemCache(str(tmp_path)),
+              'sqlite': lambda: SQLiteCache(str(tmp_path / 'cache.db')), 'redis': lambda: RedisCache(FakeRedis())}
+    test_cache = caches[backend]()
+    assert isinstance(test_cache, CacheBackend)
+    test_cache.set('key', b'value')
+    test_cache.set('expired', b'value', ttl=-1)
+    assert test_cache.get('key') == b'value'
+    assert test_cache.get('expired') is None
+    test_cache.delete('key')
+    assert test_cache.get('key') is None
+    test_cache.set('other', b'value', ttl=60)
+    test_cache.clear()
+    assert test_cache.get('other') is None
+
+
+def test_cache_backend_protocol(monkeypatch):
+    class DictCache:
+        def __init__(self):
+            self.values = {}
+
+        def get(self, key):
+            return self.values.get(key)
+
+        def set(self, key, value, ttl=None):
+            self.values[key] = value
+
+        def delete(self, key):
+            self.values.pop(key, None)
+
+        def clear(self):
+            self.values.clear()
+
+    monkeypatch.setattr(api_calls, '_default_client', FingertipsClient())
+    api_calls.set_cache(DictCache())
+    assert isinstance(api_calls.get_cache(), CacheBackend)
+    with pytest.raises(TypeError):
+        api_calls.set_cache(object())
+
+
+def test_memory_cache_evicts_least_recently_used():
+    test_cache = MemoryCache(max_entries=2)
+    test_cache.set('a', b'1')
+    test_cache.set('b', b'2')
+    test_cache.get('a')
+    test_cache.set('c', b'3')
+    assert test_cache.get('b') is None
+    assert test_cache.get('a') == b'1'
+
+
+def test_cache_key():
+    url = base_url + 'all_data/csv/by_profile_id?child_area_type_id=102\
+        &parent_area_type_id=15&profile_id=84'
+    assert cache_key(url) == base_url + 'all_data/csv/by_profile_id?child_area_type_id=102&parent_area_type_id=15&profile_id=84'
+    assert cache_key(base_url + 'x?indicator_ids=3,1,1&a=1') == cache_key(base_url + 'x?a=1&indicator_ids=1,3')
+
+
+def test_get_json_with_cache():
+    api_calls.set_cache(MemoryCache())
+    try:
+        first = get_json(base_url + 'ages')
+        assert api_calls.get_cache().get(cache_key(base_url + 'ages')) is not None
+        assert get_json(base_url + 'ages') == first
+    finally:
+        api_calls.set_cache(None)
+
+
+def test_build_url():
+    url = build_url('all_data/csv/by_indicator_id', indicator_ids=['92998', 92949, 92949], child_area_type_id=' 102',
+                    parent_area_type_id=15, profile_id=None, include_sortable_time_periods=True)
+    assert url == base_url + 'all_data/csv/by_indicator_id?indicator_ids=92949,92998&child_area_type_id=102' \
+                             '&parent_area_type_id=15&include_sortable_time_periods=yes'
+    assert build_url('all_data/csv/by_profile_id', profile_id=84, parent_area_type_id=15, child_area_type_id=154) == \
+        base_url + 'all_data/csv/by_profile_id?child_area_type_id=154&parent_area_type_id=15&profile_id=84'
+    assert build_url('ages') == base_url + 'ages'
+    assert id_list('E2,E1, E1') == ['E1', 'E2']
+
+
+def test_get_data_by_indicator_ids_since(monkeypatch, tmp_path):
+    responses = ['Indicator ID,Area Code,Time period Sortable,Value\n1,E1,20190000,1\n1,E1,20200000,2\n2,E1,20200000,3\n']
+    responses.append(responses[0] + '1,E1,20210000,4\n2,E2,20190000,5\n')
+    monkeypatch.setattr(incremental, 'incremental_store_dir', str(tmp_path))
+    monkeypatch.setattr(availability, 'use_availability', False)
+    monkeypatch.setattr(incremental, 'iter_csv_chunks',
+                        lambda url, chunksize: pd.read_csv(io.StringIO(responses.pop(0)), chunksize=2))
+    data, url = get_data_by_indicator_ids([1, 2], 102, since=True, is_test=True)
+    assert len(data) == 3
+    assert url.endswith('&include_sortable_time_periods=yes')
+    data = get_data_by_indicator_ids([1, 2], 102, since=True)
+    assert data['Value'].tolist() == [4]
+    assert get_watermarks(102) == {1: 20210000, 2: 20200000}
+    assert len(read_incremental_store(102)) == 4
+
+
+def test_fetch_since_types(monkeypatch, tmp_path):
+    body = ('Indicator ID,Area Code,Time period,Time period Sortable,Value\n' +
+            ''.join(f'1,E{number},2019,20190000,1\n' for number in range(3)) +
+            ''.join(f'2,E{number},2019/20,20190000,2\n' for number in range(3))).encode('utf-8')
+    monkeypatch.setattr(api_calls, '_default_client', FingertipsClient(transport=CSVTransport(body)))
+    data = incremental.fetch_since(base_url + 'all_data/csv/by_indicator_id?indicator_ids=1,2', 102,
+                                   store_dir=str(tmp_path), chunksize=2)
+    assert {type(value) for value in data['Time period']} == {str}
+    stored = read_incremental_store(102, store_dir=str(tmp_path))
+    assert (stored['Time period'] == '2019').sum() == 3
+
+
+class SSLFailingSession(requests.Session):
+    """
+    A session that fails SSL verification and returns a fixed JSON response without verification.
+    """
+
+    def get(self, url, verify=True, **kwargs):
+        if verify:
+            raise requests.exceptions.SSLError('certificate verify failed')
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'[{"Id": 1, "Name": "Persons"}]'
+        return response
+
+
+def test_fingertips_client():
+    client = FingertipsClient(ssl_fallback=True)
+    assert client.base_url == base_url
+    client._local.session = SSLFailingSession()
+    with pytest.warns(UserWarning, match='SSL certificate verification failed'):
+        assert client.get_content(base_url + 'sexes') == b'[{"Id": 1, "Name": "Persons"}]'
+    metrics = client.get_metrics()
+    assert metrics['requests'] == 1 and metrics['ssl_fallbacks'] == 1
+    strict_client = FingertipsClient(ssl_fallback=False)
+    strict_client._local.session = SSLFailingSession()
+    with pytest.raises(requests.exceptions.SSLError):
+        strict_client.get_content(base_url + 'sexes')
+    previous = api_calls.get_default_client()
+    api_calls.set_default_client(client)
+    try:
+        with pytest.warns(UserWarning):
+            assert get_json(base_url + 'sexes') == [{'Id': 1, 'Name': 'Persons'}]
+        assert client.get_metrics()['requests'] == 2
+    finally:
+        api_calls.set_default_client(previous)
+
+
+def test_availability_matrix(monkeypatch):
+    matrix = AvailabilityMatrix([{'IndicatorId': 1, 'AreaTypeId': 102}, {'IndicatorId': 2, 'AreaTypeId': 7},
+                                 {'IndicatorId': 2, 'AreaTypeId': 102}])
+    assert matrix.available_indicators([3, 2, 1], 7) == [2, 3]
+    assert matrix.available_area_types([1], [7, 102, 202]) == [102]
+    assert matrix.to_frame().loc[1].tolist() == [False, True]
+    monkeypatch.setattr(availability, 'get_availability_matrix', lambda: matrix)
+    monkeypatch.setattr(availability, 'get_profile_indicators', lambda profile_id: {1})
+
+    def no_request(url, use_dataset_store=False, dataset_max_age=None):
+        raise AssertionError(f'Unexpected request to {url}')
+    monkeypatch.setattr(retrieve_data, '_read_data_csv', no_request)
+    for df in [get_data_by_indicator_ids(1, 7), get_all_data_for_profile(84, area_type_id=[7, 202]),
+               get_all_data_for_indicators(1, 7)]:
+        assert df.empty
+        assert list(df.columns) == api_calls.data_columns
+
+
+class StaticSession(requests.Session):
+    """
+    A session that answers every request with the same CSV.
+    """
+
+    def get(self, url, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['ETag'] = '"v1"'
+        response._content = b'Indicator ID,Value\n1,2.5\n'
+        response.raw = io.BytesIO(response._content)
+        return response
+
+
+def test_record_and_replay_transport(tmp_path):
+    url = base_url + 'all_data/csv/by_indicator_id?indicator_ids=1&child_area_type_id=102&parent_area_type_id=15'
+    recorder = FingertipsClient(transport=RecordTransport(str(tmp_path)))
+    recorder._local.session = StaticSession()
+    with recorder.open_csv(url) as csv_file:
+        recorded = pd.read_csv(csv_file)
+    replayer = FingertipsClient(transport=ReplayTransport(str(tmp_path), latency=0.05, bandwidth=1000))
+    start = time.perf_counter()
+    with replayer.open_csv(url) as csv_file:
+        replayed = pd.read_csv(csv_file)
+    assert time.perf_counter() - start >= 0.05
+    pd.testing.assert_frame_equal(recorded, replayed)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        replayer.get_content(base_url + 'ages')
+    with pytest.raises(TypeError):
+        FingertipsClient(transport=object())
+
+
+def test_normalize():
+    df = pd.DataFrame({'Sex': ['Persons', 'Male', 'female ', 'Other'], 'Age': 'All ages',
+                       'Value note': [None, 'Aggregated from all known lower geography values', None, None]})
+    lookups = {'Sex': {'Persons': 4, 'Male': 1, 'Female': 2}, 'Age': {'All ages': 1},
+               'Value note': {'Aggregated from all known lower geography values': 100}}
+    with pytest.warns(UserWarning, match='could not be mapped'):
+        normalized = normalize(df, lookups=lookups)
+    assert normalized['Sex ID'].tolist()[:3] == [4, 1, 2]
+    assert normalized['Sex ID'].isna().tolist() == [False, False, False, True]
+    assert normalized['Value note ID'].tolist()[1] == 100
+    assert str(normalized['Age'].dtype) == 'category'
+    assert normalized.attrs['unmapped'] == {'Sex': {'Other': 1}}
+
+
+def test_diff(tmp_path):
+    old = pd.DataFrame({'Indicator ID': [1, 1, 1], 'Area Code': ['E1', 'E2', 'E3'], 'Time period': ['2019', '2019', '2019'],
+                        'Value': [1.5, 2.0, 3.25], 'Value note': [None, None, None]})
+    new = pd.DataFrame({'Indicator ID': [1, 1, 1], 'Area Code': ['E1', 'E2', 'E4'], 'Time period': [2019, 2019, 2019],
+                        'Value': [1.5, 2.5, 4.0], 'Value note': [None, None, None]})
+    result = diff(old, new)
+    assert result.added['Area Code'].tolist() == ['E4']
+    assert result.removed['Area Code'].tolist() == ['E3']
+    assert result.changed[['Area Code', 'Value', 'Value (previous)']].values.tolist() == [['E2', 2.5, 2.0]]
+    path = tmp_path / 'old.csv'
+    old.to_csv(path, index=False)
+    chunked = diff(path, lambda: (new.iloc[start:start + 2] for start in range(0, len(new), 2)), chunksize=1)
+    assert [len(frame) for frame in chunked] == [1, 1, 1]
+    assert len(diff(path, old).changed) == 0
+    with pytest.raises(ValueError):
+        diff(old, pd.concat([new, new.assign(Value=0)]))
+
+
+def test_autotuner(monkeypatch):
+    tuner = AutoTuner(max_workers=4, max_chunk_size=40, workers=1, chunk_size=10, target_seconds=1)
+    tuner.observe(0.1, 1000)
+    assert (tuner.workers, tuner.chunk_size) == (2, 20)
+    tuner.observe(2, 20000)
+    assert (tuner.workers, tuner.chunk_size) == (2, 10)
+    tuner.observe(0.1, error=True)
+    assert (tuner.workers, tuner.chunk_size) == (1, 5)
+    assert [decision['reason'] for decision in tuner.get_metrics()['decisions']] == ['fast', 'slow', 'error']
+
+    def fetch(chunk):
+        if len(chunk) > 3 or 1001 in chunk:
+            raise HTTPError('url', 414, 'URI Too Long', {}, None)
+        return pd.DataFrame({'Indicator ID': chunk}), 100
+
+    tuner = AutoTuner(max_workers=3, workers=2, chunk_size=8, target_seconds=10)
+    assert run_tuned(tuner, list(range(20)), fetch)['Indicator ID'].tolist() == list(range(20))
+    assert tuner.chunk_size <= 8 and tuner.get_metrics()['error_rate'] > 0
+    with pytest.raises(HTTPError):
+        run_tuned(AutoTuner(), [1001], fetch)
+    requested = []
+    monkeypatch.setattr(availability, 'use_availability', False)
+    monkeypatch.setattr(retrieve_data, 'read_csv_with_size',
+                        lambda url: requested.append(url) or (pd.DataFrame({'Value': [1]}), 10))
+    monkeypatch.setattr(autotune, '_tuners', {102: AutoTuner(chunk_size=2)})
+    assert len(get_data_by_indicator_ids([1, 2, 3, 4, 5], 102, autotune=True)) == len(requested)
+    assert requested[0].count('%2C') + requested[0].count(',') == 1
+
+
+class StaticTransport(Transport):
+    """
+    A transport that answers every request in any thread from a StaticSession.
+    """
+
+    def get(self, session, url, **kwargs):
+        return StaticSession().get(url)
+
+
+def test_profile(monkeypatch):
+    client = FingertipsClient(transport=StaticTransport())
+    monkeypatch.setattr(api_calls, '_default_client', client)
+    monkeypatch.setattr(availability, 'use_availability', False)
+    with profile() as session:
+        get_data_by_indicator_ids(1, 102)
+        get_all_data_for_profile(19, area_type_id=[102, 101], autotune=True)
+        client.map_concurrently(lambda item: record_cost(requests=1), range(4), workers=4)
+    costs = session.to_frame('requests').set_index('function')
+    assert costs.index.tolist() == ['<unattributed>', 'retrieve_data.get_all_data_for_profile',
+                                    'retrieve_data.get_data_by_indicator_ids']
+    assert costs.loc['retrieve_data.get_all_data_for_profile', ['calls', 'requests', 'bytes_received']].tolist() == \
+        [1, 2, 50]
+    assert costs.loc['retrieve_data.get_data_by_indicator_ids', 'parse_seconds'] > 0
+    assert costs.loc['<unattributed>', 'requests'] == 4
+    assert 'retrieve_data.get_all_data_for_profile' in session.report('bytes_received')
+    assert len(json.loads(session.to_json())['functions']) == 3